@@ -0,0 +1,107 @@
+"""Measure how much memory each gunicorn worker costs, with and without
+preloading.
+
+Starts the portal under captiveportal.serve with --workers, warms every
+worker up with probes from a spread of devices, then reads each worker's
+unique (USS: memory no other process shares, so what the box gets back if
+the worker goes) and proportional (PSS) set sizes from /proc. Run once with
+--no-preload and once with the default preload mode to compare. Linux only.
+
+    python benchmarks/bench_memory.py --workers 4
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# pylint: disable=wrong-import-position
+from bench_transport import PROBES, ROOT, connect, wait_for
+
+UAS = PROBES + (
+    ("/connecttest.txt", "Microsoft NCSI"),
+    ("/hotspot-detect.html",
+     "Mozilla/5.0 (iPhone; CPU iPhone OS 14_0 like Mac OS X) "
+     "AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/18A373"),
+    ("/generate_204",
+     "Mozilla/5.0 (Linux; Android 9; Pixel Build/PPR1.180610.009; wv) "
+     "AppleWebKit/537.36 (KHTML, like Gecko) Version/4.0 "
+     "Chrome/70.0.3538.64 Mobile Safari/537.36"),
+)
+
+
+def memory_kb(pid):
+    """Return (uss, pss) in kB for a process"""
+    fields = {}
+    with open("/proc/%d/smaps_rollup" % (pid,)) as rollup:
+        for line in rollup:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                fields[parts[0].rstrip(":")] = int(parts[1])
+    return fields["Private_Clean"] + fields["Private_Dirty"], fields["Pss"]
+
+
+def children(pid):
+    """Return the pids of a process's children"""
+    pids = []
+    for task in os.listdir("/proc/%d/task" % (pid,)):
+        with open("/proc/%d/task/%s/children" % (pid, task)) as child_list:
+            pids.extend(int(child) for child in child_list.read().split())
+    return pids
+
+
+def warm_up(target, requests):
+    """Send probes over new connections so that every worker sees some"""
+    for index in range(requests):
+        path, user_agent = UAS[index % len(UAS)]
+        conn = connect(target)
+        conn.request("GET", path, headers={
+            "User-Agent": user_agent,
+            "X-Forwarded-For": "10.6.%d.%d" % (index // 250, index % 250 + 1),
+            "Connection": "close",
+        })
+        conn.getresponse().read()
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=400,
+                        help="warm up requests, spread over the workers")
+    parser.add_argument("--no-preload", action="store_true")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    target = "unix:%s" % (os.path.join(tmpdir, "captiveportal.sock"),)
+    command = [sys.executable, "-m", "captiveportal.serve",
+               "--workers", str(args.workers), "--bind", target,
+               "--no-preload" if args.no_preload else "--preload"]
+    server = subprocess.Popen(command, cwd=ROOT, stderr=subprocess.DEVNULL)
+    try:
+        wait_for(target)
+        warm_up(target, args.requests)
+        # Let the workers settle after their last requests
+        time.sleep(1)
+        print("preload: %s" % ("no" if args.no_preload else "yes",))
+        print("%8s %10s %10s" % ("pid", "USS kB", "PSS kB"))
+        master_uss, master_pss = memory_kb(server.pid)
+        print("%8d %10d %10d  (master)" % (server.pid, master_uss,
+                                           master_pss))
+        total_uss = 0
+        for pid in sorted(children(server.pid)):
+            uss, pss = memory_kb(pid)
+            total_uss += uss
+            print("%8d %10d %10d" % (pid, uss, pss))
+        workers = len(children(server.pid))
+        print("mean worker USS: %d kB" % (total_uss // max(workers, 1),))
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
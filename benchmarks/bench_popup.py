@@ -0,0 +1,60 @@
+"""Measure what a portal popup costs a device: requests and bytes.
+
+Fetches the welcome page the way each kind of captive portal browser would,
+then every sub-resource it references, with and without INLINE_ASSETS.
+
+    python benchmarks/bench_popup.py
+"""
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# pylint: disable=wrong-import-position
+from captiveportal import app, settings
+
+BROWSERS = (
+    ("iOS CNA", "/hotspot-detect.html",
+     "Mozilla/5.0 (iPhone; CPU iPhone OS 14_0 like Mac OS X) "
+     "AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/18A373"),
+    ("Android webkit", "/generate_204",
+     "Mozilla/5.0 (Linux; Android 9; Pixel Build/PPR1.180610.009; wv) "
+     "AppleWebKit/537.36 (KHTML, like Gecko) Version/4.0 "
+     "Chrome/70.0.3538.64 Mobile Safari/537.36"),
+    ("Windows", "/connecttest.txt", "Microsoft NCSI"),
+)
+
+# src and stylesheet href attributes pointing back at the portal
+_SUBRESOURCE = re.compile(
+    rb'''(?:src|href)=["'](/[^"']+)["']''')
+
+
+def popup_cost(client, path, user_agent, client_ip):
+    """Return (requests, bytes) to show the welcome page and its assets"""
+    headers = {"User-Agent": user_agent}
+    environ = {"REMOTE_ADDR": client_ip}
+    page = client.get(path, headers=headers, environ_base=environ).data
+    requests = 1
+    total = len(page)
+    for url in _SUBRESOURCE.findall(page):
+        total += len(client.get(url.decode(), headers=headers,
+                                environ_base=environ).data)
+        requests += 1
+    return requests, total
+
+
+def main():
+    client = app.test_client()
+    print("%-16s %-8s %8s %10s" % ("browser", "inline", "requests", "bytes"))
+    for index, (name, path, user_agent) in enumerate(BROWSERS):
+        for inline in (False, True):
+            settings.install(settings.current._replace(INLINE_ASSETS=inline))
+            requests, total = popup_cost(
+                client, path, user_agent,
+                "10.8.%d.%d" % (index, 1 if inline else 2))
+            print("%-16s %-8s %8d %10d" % (name, inline, requests, total))
+
+
+if __name__ == "__main__":
+    main()
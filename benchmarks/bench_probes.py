@@ -0,0 +1,222 @@
+"""Replay realistic device probe sequences through the portal, in-process.
+
+The device workflows are the ones encoded in tests/test_captiveportal.py
+(iOS wispr -> browser -> wispr, Android Dalvik/X11/webkit, Kindle, Windows)
+and the Android X11 agent's back-off probe cadence from docs/android-7.1.md.
+N simulated devices with a realistic OS mix each get a schedule of probes;
+all schedules are merged in time order and replayed as fast as possible
+straight through the WSGI app, so no network or server is involved. The
+simulated clock is compressed: ordering is realistic, waiting isn't.
+
+Reports requests/sec, p50/p99 latency per endpoint, and the session store's
+memory growth per client (measured in a separate pass under tracemalloc, so
+that tracing doesn't distort the latencies).
+
+    python benchmarks/bench_probes.py --devices 1000
+"""
+import argparse
+import bisect
+import collections
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+# pylint: disable=wrong-import-position
+from werkzeug.test import EnvironBuilder
+
+from captiveportal import app
+from captiveportal.views import session_store
+
+WISPR_UA = "CaptiveNetworkSupport-346.50.1 wispr"
+IOS_UA = "Mozilla/5.0 (iPhone; CPU iPhone OS 14_0 like Mac OS X) " \
+         "AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/18A373"
+MACOS_UA = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_0) " \
+           "AppleWebKit/605.1.15 (KHTML, like Gecko)"
+X11_UA = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 " \
+         "(KHTML, like Gecko) Chrome/52.0.2743.82 Safari/537.36"
+DALVIK_UA = "Dalvik/2.1.0 (Linux; U; Android 9; Pixel Build/PPR1.180610.009)"
+ANDROID_WEBKIT_UA = "Mozilla/5.0 (Linux; Android 9; Pixel " \
+    "Build/PPR1.180610.009; wv) AppleWebKit/537.36 (KHTML, like Gecko) " \
+    "Version/4.0 Chrome/70.0.3538.64 Mobile Safari/537.36"
+DALVIK5_UA = "Dalvik/2.1.0 (Linux; U; Android 5.0.1; Lenovo TB3-710F " \
+             "Build/LRX21M)"
+ANDROID5_WEBKIT_UA = "Mozilla/5.0 (Linux; Android 5.0.1; Lenovo TB3-710F " \
+    "Build/LRX21M; wv) AppleWebKit/537.36 (KHTML, like Gecko) Version/4.0 " \
+    "Chrome/45.0.2454.95 Safari/537.36"
+WINDOWS_UA = "Microsoft NCSI"
+KINDLE_UA = "Mozilla/5.0 (Linux; U; Android 4.0.3; en-us; KFTT " \
+            "Build/IML74K) AppleWebKit/534.30 (KHTML, like Gecko) " \
+            "Silk/3.4 Mobile Safari/534.30"
+
+# X11 agent re-probe intervals, from docs/android-7.1.md
+X11_BACKOFF_SECS = (30, 30, 30, 60, 60, 60, 90, 180, 300)
+
+
+def ios_workflow():
+    """iOS/macOS: wispr, CP browser, wispr, then periodic wispr checks"""
+    browser_ua = random.choice((IOS_UA, MACOS_UA))
+    yield 0, "GET", "/hotspot-detect.html", WISPR_UA
+    yield 2, "GET", "/hotspot-detect.html", browser_ua
+    yield 1, "GET", "/hotspot-detect.html", WISPR_UA
+    for _ in range(4):
+        yield 600, "GET", "/hotspot-detect.html", WISPR_UA
+
+
+def android_workflow():
+    """Android 7.1+: X11 agent, CP browser, OK press, then X11 back-off"""
+    yield 0, "GET", "/generate_204", X11_UA
+    yield 1, "GET", "/generate_204", DALVIK_UA
+    yield 1, "GET", "/generate_204", ANDROID_WEBKIT_UA
+    # Dalvik sometimes requests its magic URL more than once per page load
+    yield 0, "GET", "/generate_204", DALVIK_UA
+    yield 5, "POST", "/generate_204", ANDROID_WEBKIT_UA
+    yield 1, "GET", "/generate_204", DALVIK_UA
+    for delay in X11_BACKOFF_SECS:
+        yield delay, "GET", random.choice(("/generate_204", "/gen_204")), \
+            X11_UA
+
+
+def android5_workflow():
+    """Android 5: Dalvik twice, then the CP browser"""
+    yield 0, "GET", "/generate_204", DALVIK5_UA
+    yield 3, "GET", "/generate_204", DALVIK5_UA
+    yield 5, "GET", "/generate_204", ANDROID5_WEBKIT_UA
+
+
+def windows_workflow():
+    yield 0, "GET", random.choice(("/ncsi.txt", "/connecttest.txt")), \
+        WINDOWS_UA
+    yield 30, "GET", "/connecttest.txt", WINDOWS_UA
+
+
+def kindle_workflow():
+    yield 0, "GET", "/kindle-wifi/wifistub.html", KINDLE_UA
+    yield 30, "GET", "/kindle-wifi/wifistub.html", KINDLE_UA
+
+
+# (workflow, share of devices)
+OS_MIX = (
+    (android_workflow, 0.50),
+    (ios_workflow, 0.35),
+    (windows_workflow, 0.07),
+    (android5_workflow, 0.05),
+    (kindle_workflow, 0.03),
+)
+
+
+def device_ip(index, base=0):
+    index += base
+    return "10.%d.%d.%d" % (index >> 16 & 0xff, index >> 8 & 0xff,
+                            index & 0xff)
+
+
+def build_schedule(devices, base=0, arrival_window=300):
+    """Return every device's probes merged in simulated time order"""
+    workflows = [workflow for workflow, _ in OS_MIX]
+    # Cumulative shares, as random.choices (3.6+) would use
+    cumulative = []
+    total = 0.0
+    for _, share in OS_MIX:
+        total += share
+        cumulative.append(total)
+    schedule = []
+    for index in range(devices):
+        pick = bisect.bisect(cumulative, random.random() * total)
+        workflow = workflows[min(pick, len(workflows) - 1)]
+        when = random.uniform(0, arrival_window)
+        for delay, method, path, user_agent in workflow():
+            when += delay
+            schedule.append(
+                (when, method, path, user_agent, device_ip(index, base)))
+    schedule.sort(key=lambda probe: probe[0])
+    return schedule
+
+
+def build_environs(schedule):
+    """Prebuild WSGI environs so that building them isn't measured"""
+    environs = []
+    for _, method, path, user_agent, client_ip in schedule:
+        builder = EnvironBuilder(
+            path=path, method=method,
+            headers={"User-Agent": user_agent},
+            environ_base={"REMOTE_ADDR": client_ip},
+        )
+        environs.append((path, builder.get_environ()))
+    return environs
+
+
+def _start_response(status, headers, exc_info=None):
+    pass
+
+
+def replay(environs):
+    """Replay the environs, returning total seconds and per-path latencies"""
+    latencies = collections.defaultdict(list)
+    wsgi_app = app.wsgi_app
+    started = time.perf_counter()
+    for path, environ in environs:
+        request_started = time.perf_counter()
+        result = wsgi_app(environ, _start_response)
+        for _ in result:
+            pass
+        if hasattr(result, "close"):
+            result.close()
+        latencies[path].append(time.perf_counter() - request_started)
+    return time.perf_counter() - started, latencies
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def measure_session_memory(devices):
+    """Return (bytes, clients) added to the session store by a fresh run"""
+    environs = build_environs(build_schedule(devices, base=devices))
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    replay(environs)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    filters = [tracemalloc.Filter(True, "*captiveportal/sessions.py"),
+               tracemalloc.Filter(True, "*captiveportal/journal.py")]
+    growth = sum(stat.size_diff for stat in after.filter_traces(filters)
+                 .compare_to(before.filter_traces(filters), "filename"))
+    return growth, devices
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--devices", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    environs = build_environs(build_schedule(args.devices))
+    # Warm the UA and response caches, as a long running server would be
+    replay(build_environs(build_schedule(10, base=1 << 20)))
+
+    elapsed, latencies = replay(environs)
+    print("%d devices, %d requests in %.3fs: %.0f requests/sec" % (
+        args.devices, len(environs), elapsed, len(environs) / elapsed))
+    print("%-30s %8s %10s %10s" % ("endpoint", "requests", "p50 us", "p99 us"))
+    for path in sorted(latencies):
+        values = latencies[path]
+        print("%-30s %8d %10.1f %10.1f" % (
+            path, len(values), percentile(values, 0.5) * 1e6,
+            percentile(values, 0.99) * 1e6))
+
+    stats = session_store.stats()
+    print("session store: %s" % (", ".join(
+        "%s=%s" % item for item in sorted(stats.items())),))
+    growth, clients = measure_session_memory(args.devices)
+    print("session store memory growth: %d bytes for %d clients "
+          "(%.0f bytes/client)" % (growth, clients, growth / clients))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Measure how long a fresh worker takes to start answering probes.
+
+Every deploy or crash leaves the portal unable to answer probes until the
+workers have imported everything. This reports where import time goes (from
+python -X importtime) and, over several fresh interpreters, the time from
+starting one to it producing its first 204 and its first welcome page, with
+and without the precompiled templates (make templates) and with ua_parser
+loaded eagerly as it used to be.
+
+    python benchmarks/bench_startup.py --runs 10 --budget 0.5
+
+exits with status 1 if the median time to the first 204 is over --budget
+seconds.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+X11_UA = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 " \
+         "(KHTML, like Gecko) Chrome/52.0.2743.82 Safari/537.36"
+
+# Run in a fresh interpreter: answer one probe, then print the time
+CHILD = """
+import sys
+import time
+if sys.argv[2] == "eager":
+    import ua_parser.user_agent_parser
+from werkzeug.test import EnvironBuilder
+from captiveportal import app
+from captiveportal.sessions import client_key
+from captiveportal.views import session_store
+if sys.argv[1] == "204":
+    session_store.touch(client_key("10.5.0.1"), time.time())
+    session_store.set_acked(client_key("10.5.0.1"))
+environ = EnvironBuilder(path="/generate_204",
+                         headers={"User-Agent": %r},
+                         environ_base={"REMOTE_ADDR": "10.5.0.1"}).get_environ()
+status = []
+body = b"".join(app.wsgi_app(environ,
+                             lambda line, headers: status.append(line)))
+sys.stdout.write("%%r %%s\\n" %% (time.time(), status[0]))
+""" % (X11_UA,)
+
+
+def import_times():
+    """Return [(self us, cumulative us, module)] for importing the portal"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import captiveportal"],
+        cwd=ROOT, stderr=subprocess.PIPE, universal_newlines=True,
+        check=True)
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        times.append((int(self_us), int(cumulative_us), module.strip()))
+    return times
+
+
+def time_to_first(response, variant, precompiled):
+    """Return seconds from starting an interpreter to its first response"""
+    env = dict(os.environ)
+    env["CAPTIVEPORTAL_PRECOMPILED_TEMPLATES"] = "1" if precompiled else "0"
+    started = time.time()
+    result = subprocess.run(
+        [sys.executable, "-c", CHILD, response, variant], cwd=ROOT, env=env,
+        stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    answered, status = result.stdout.split(" ", 1)
+    expected = "204" if response == "204" else "200"
+    if not status.startswith(expected):
+        raise RuntimeError("Expected %s, got %s" % (expected, status))
+    return float(answered) - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--top", type=int, default=10,
+                        help="Slowest top level imports to list")
+    parser.add_argument("--budget", type=float,
+                        help="Fail if the first 204 takes longer (seconds)")
+    args = parser.parse_args()
+
+    times = import_times()
+    total = [cumulative_us for _, cumulative_us, module in times
+             if module == "captiveportal"][0]
+    print("import captiveportal: %.1f ms" % (total / 1000.0,))
+    print("%10s %10s  %s" % ("self ms", "cumul ms", "module"))
+    for self_us, cumulative_us, module in sorted(
+            times, key=lambda t: t[1], reverse=True)[:args.top]:
+        print("%10.1f %10.1f  %s" % (self_us / 1000.0,
+                                     cumulative_us / 1000.0, module))
+    print()
+
+    print("%-8s %-10s %-12s %10s %10s" % ("first", "ua_parser", "templates",
+                                          "median ms", "max ms"))
+    medians = {}
+    for response in ("204", "welcome"):
+        for variant, precompiled in (("lazy", True), ("lazy", False),
+                                     ("eager", False)):
+            samples = [time_to_first(response, variant, precompiled)
+                       for _ in range(args.runs)]
+            medians[(response, variant, precompiled)] = \
+                statistics.median(samples)
+            print("%-8s %-10s %-12s %10.1f %10.1f" % (
+                response, variant,
+                "precompiled" if precompiled else "compiled",
+                statistics.median(samples) * 1000, max(samples) * 1000))
+
+    if args.budget is not None:
+        first_204 = medians[("204", "lazy", True)]
+        if first_204 > args.budget:
+            print("First 204 took %.3fs, over the %.3fs budget" %
+                  (first_204, args.budget))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
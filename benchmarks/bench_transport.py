@@ -0,0 +1,126 @@
+"""Compare probe throughput over loopback TCP and a Unix domain socket.
+
+Starts the portal under gunicorn (captiveportal.serve) listening on both, then
+has several client processes hammer the probe endpoints over each transport
+in turn, the way nginx would: over keep-alive connections, or with a new
+connection per request when given --close.
+
+    python benchmarks/bench_transport.py --clients 4 --requests 2000
+"""
+import argparse
+import http.client
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+PROBES = (
+    ("/generate_204", "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
+                      "(KHTML, like Gecko) Chrome/52.0.2743.82 "
+                      "Safari/537.36"),
+    ("/hotspot-detect.html", "CaptiveNetworkSupport-346.50.1 wispr"),
+    ("/.well-known/captive-portal", "Dalvik/2.1.0 (Linux; U; Android 11)"),
+)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path):
+        http.client.HTTPConnection.__init__(self, "localhost")
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def connect(target):
+    if target.startswith("unix:"):
+        return UnixHTTPConnection(target[len("unix:"):])
+    host, port = target.rsplit(":", 1)
+    return http.client.HTTPConnection(host, int(port))
+
+
+def run_client(target, client_index, requests, close):
+    """Send requests probes, returning the seconds taken"""
+    conn = connect(target)
+    forwarded_for = "10.4.%d.1" % (client_index,)
+    started = time.perf_counter()
+    for index in range(requests):
+        path, user_agent = PROBES[index % len(PROBES)]
+        conn.request("GET", path, headers={
+            "User-Agent": user_agent,
+            "X-Forwarded-For": forwarded_for,
+            "Connection": "close" if close else "keep-alive",
+        })
+        conn.getresponse().read()
+        if close:
+            conn.close()
+    elapsed = time.perf_counter() - started
+    conn.close()
+    return elapsed
+
+
+def wait_for(target, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = connect(target)
+            conn.request("GET", "/ncsi.txt")
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("portal didn't start listening on %s" % (target,))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=2000,
+                        help="requests per client")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--port", type=int, default=5081)
+    parser.add_argument("--close", action="store_true",
+                        help="open a new connection for every request")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    targets = ("127.0.0.1:%d" % (args.port,),
+               "unix:%s" % (os.path.join(tmpdir, "captiveportal.sock"),))
+    command = [sys.executable, "-m", "captiveportal.serve",
+               "--workers", str(args.workers)]
+    for target in targets:
+        command.extend(["--bind", target])
+    server = subprocess.Popen(command, cwd=ROOT, stderr=subprocess.DEVNULL)
+    try:
+        for target in targets:
+            wait_for(target)
+        pool = multiprocessing.Pool(args.clients)
+        for target in targets:
+            started = time.perf_counter()
+            pool.starmap(run_client, [
+                (target, index, args.requests, args.close)
+                for index in range(args.clients)])
+            elapsed = time.perf_counter() - started
+            total = args.clients * args.requests
+            print("%-6s %d requests in %.2fs: %.0f requests/sec" % (
+                "unix" if target.startswith("unix:") else "tcp",
+                total, elapsed, total / elapsed))
+        pool.close()
+    finally:
+        server.terminate()
+        server.wait()
+        for name in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir, name))
+        os.rmdir(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
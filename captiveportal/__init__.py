@@ -10,11 +10,29 @@ from werkzeug.middleware.proxy_fix import ProxyFix
 # in views.py would not work correctly.
 # -------------------------------------------------------------------------
 app = Flask(__name__)
-app.config.from_object('captiveportal.default_settings')
 app.wsgi_app = ProxyFix(app.wsgi_app)
 
+# Settings come from default_settings.py, the CAPTIVEPORTAL_SETTINGS file and
+#  the environment (see settings.py). app.config mirrors them for Flask
+import captiveportal.settings
+captiveportal.settings.install(captiveportal.settings.load())
+app.config.update(captiveportal.settings.current._asdict())
+
+# Templates compiled ahead of time, if they're there and up to date
+import captiveportal.precompiled
+if app.config["PRECOMPILED_TEMPLATES"]:
+    captiveportal.precompiled.install(app)
+
+import captiveportal.useragent
+captiveportal.useragent.ua_cache.maxsize = app.config["UA_CACHE_SIZE"]
+
 import captiveportal.views
 
+# Steady state probes are answered before they reach Flask. The middleware
+#  goes inside ProxyFix so that it sees the real client address
+from captiveportal.probes import ProbeFastPath
+app.wsgi_app.app = ProbeFastPath(app.wsgi_app.app)
+
 @app.errorhandler(404)
 def default_view(_):
     """Catch-all 404 handler — redirects every unknown URL to the welcome page.
@@ -0,0 +1,187 @@
+"""Asyncio (ASGI) serving mode for the captive portal probe endpoints.
+
+Every probe is trivial CPU work plus a session lookup, but under a
+synchronous WSGI server each slow or half-open connection from a flaky phone
+radio ties up a whole worker. Served from an ASGI server instead, a single
+process can hold thousands of idle keep-alive connections:
+
+    uvicorn --workers 1 --proxy-headers captiveportal.asgi:application
+
+The probe endpoints are answered directly on the event loop (see
+captiveportal.probes) using the same decisions as the Flask views and the
+same session store and pre-rendered responses. Every other request is
+handed to the Flask app on a small thread pool.
+"""
+import asyncio
+import io
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from captiveportal import app
+from captiveportal.probes import ENDPOINTS, answer_probe
+from captiveportal.views import metrics, start_background_tasks
+
+_NO_CONTENT_HEADERS = [(b"content-length", b"0")]
+
+
+def _header(scope, name):
+    """Return the value of the last header called name, or "" """
+    value = b""
+    for header_name, header_value in scope["headers"]:
+        if header_name == name:
+            value = header_value
+    return value.decode("latin-1")
+
+
+def _client_addr(scope):
+    """Return the client address, as ProxyFix would report it
+
+    Like ProxyFix's default of trusting one proxy, this is the last address
+    in X-Forwarded-For (added by nginx), or the peer address without one.
+    """
+    forwarded_for = _header(scope, b"x-forwarded-for")
+    if forwarded_for:
+        return forwarded_for.split(",")[-1].strip()
+    client = scope.get("client")
+    return client[0] if client else None
+
+
+def probe_response(scope):
+    """Return (status, headers, body) for a probe, or None if it isn't one"""
+    answer = answer_probe(scope["path"], scope["method"],
+                          _header(scope, b"user-agent"), _client_addr(scope),
+                          _header(scope, b"if-none-match"))
+    if answer is None:
+        return None
+    status, cached = answer
+    if cached is None:
+        return status, _NO_CONTENT_HEADERS, b""
+    if status == 304:
+        return status, cached.not_modified_raw_headers, b""
+    return status, cached.raw_headers, cached.body
+
+
+class ProbeApplication(object):
+    """ASGI application serving probes itself and everything else via Flask
+    """
+
+    def __init__(self, wsgi_app, max_threads=4):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=max_threads)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        started = time.perf_counter()
+        response = probe_response(scope)
+        if response is None:
+            await self._call_wsgi(scope, receive, send)
+            return
+        status, headers, body = response
+        metrics.observe_request(ENDPOINTS[scope["path"]], status,
+                                time.perf_counter() - started)
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": headers,
+        })
+        await send({
+            "type": "http.response.body",
+            "body": b"" if scope["method"] == "HEAD" else body,
+        })
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                start_background_tasks()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _call_wsgi(self, scope, receive, send):
+        """Run the WSGI app for this request on the thread pool"""
+        body = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            body.append(message.get("body", b""))
+            more_body = message.get("more_body", False)
+        environ = _wsgi_environ(scope, b"".join(body))
+
+        loop = asyncio.get_event_loop()
+        status, headers, chunks = await loop.run_in_executor(
+            self.executor, _run_wsgi, self.wsgi_app, environ)
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": headers,
+        })
+        await send({"type": "http.response.body", "body": b"".join(chunks)})
+
+
+def _wsgi_environ(scope, body):
+    """Build a WSGI environ for an ASGI HTTP scope"""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/%s" % (scope.get("http_version", "1.1"),),
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif name != "CONTENT_LENGTH":
+            key = "HTTP_" + name
+            if key in environ:
+                value = environ[key] + "," + value
+            environ[key] = value
+    return environ
+
+
+def _run_wsgi(wsgi_app, environ):
+    """Call wsgi_app, returning (status, headers, body chunks)"""
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = [
+            (name.lower().encode("latin-1"), value.encode("latin-1"))
+            for name, value in headers
+        ]
+
+    result = wsgi_app(environ, start_response)
+    try:
+        chunks = list(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return response["status"], response["headers"], chunks
+
+
+# pylint: disable=invalid-name
+application = ProbeApplication(app.wsgi_app)
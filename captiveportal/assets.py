@@ -0,0 +1,219 @@
+"""Fingerprinted, precompressed static assets.
+
+When the portal pops up, every device in the venue fetches the welcome
+page's assets at once over the same congested Wi-Fi link. At startup every
+file in the static folder is read into memory and given a URL containing a
+hash of its content (go-animation-safari.gif becomes
+go-animation-safari.0123456789ab.gif), and url_for('static', ...) returns
+that URL. As a fingerprinted URL's content can never change, it is served
+with a far-future, immutable Cache-Control so devices coming back to the
+portal never fetch it again. Text assets are also kept gzip compressed, and
+brotli compressed if the brotli package is installed, and served in whichever
+encoding the device accepts.
+
+    python -m captiveportal.assets
+
+re-encodes the GIF animations as animated WebP (needs Pillow). The WebP
+versions are served instead of the GIFs to devices that advertise WebP
+support in their Accept header, from the same URL. The old captive portal
+browsers that don't understand WebP carry on getting the GIFs.
+"""
+import gzip
+import hashlib
+import io
+import mimetypes
+import os
+
+from flask import request, Response, send_from_directory
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Assets worth compressing; images are compressed already
+_COMPRESSIBLE_TYPES = frozenset(("text/css", "text/html", "text/plain",
+                                 "application/javascript", "text/javascript",
+                                 "image/svg+xml"))
+
+
+def _gzip(data):
+    # A fixed mtime keeps the output, and so its ETag, the same every start
+    out = io.BytesIO()
+    with gzip.GzipFile(fileobj=out, mode="wb", compresslevel=9,
+                       mtime=0) as compressed:
+        compressed.write(data)
+    return out.getvalue()
+
+
+def _listed_quality(accept, value):
+    # Only a format the device names itself counts: old captive portal
+    #  browsers that can't show WebP still send */*
+    for item, quality in accept:
+        if item.lower() == value:
+            return quality
+    return 0
+
+
+def fingerprinted_name(filename, data):
+    """Return filename with a hash of data inserted before its extension"""
+    root, ext = os.path.splitext(filename)
+    return "%s.%s%s" % (root, hashlib.sha1(data).hexdigest()[:12], ext)
+
+
+class Asset(object):
+    """A static file's content, kept in memory in every encoding served"""
+
+    __slots__ = ("mimetype", "variants")
+
+    def __init__(self, data, mimetype):
+        self.mimetype = mimetype
+        # (content coding, mimetype) -> (body, etag)
+        self.variants = {}
+        self._add(None, mimetype, data)
+        if mimetype in _COMPRESSIBLE_TYPES:
+            self._add("gzip", mimetype, _gzip(data))
+            if brotli is not None:
+                self._add("br", mimetype, brotli.compress(data))
+
+    def _add(self, encoding, mimetype, data):
+        plain = self.variants.get((None, mimetype))
+        # Only keep encodings that actually save bytes
+        if plain is not None and len(data) >= len(plain[0]):
+            return
+        self.variants[(encoding, mimetype)] = \
+            (data, '"%s"' % (hashlib.sha1(data).hexdigest(),))
+
+    def add_alternative(self, data, mimetype):
+        """Add a smaller alternative format of the same image"""
+        if len(data) < len(self.variants[(None, self.mimetype)][0]):
+            self.variants[(None, mimetype)] = \
+                (data, '"%s"' % (hashlib.sha1(data).hexdigest(),))
+
+    def select(self, accept_encoding, accept):
+        """Return (encoding, mimetype, body, etag) best for these headers
+
+        Anything the headers give a quality of 0 (e.g. gzip;q=0) is refused.
+        """
+        accept_encoding = parse_accept_header(accept_encoding)
+        accept = parse_accept_header(accept, MIMEAccept)
+        mimetype = self.mimetype
+        for alternative in ("image/webp",):
+            if (None, alternative) in self.variants and \
+                    _listed_quality(accept, alternative) > 0:
+                mimetype = alternative
+        for encoding in ("br", "gzip"):
+            if (encoding, mimetype) in self.variants and \
+                    accept_encoding[encoding] > 0:
+                return (encoding, mimetype) + \
+                    self.variants[(encoding, mimetype)]
+        return (None, mimetype) + self.variants[(None, mimetype)]
+
+
+class StaticAssets(object):
+    """Serves the static folder from memory under fingerprinted URLs
+
+    Files that appear in the static folder after startup are still served
+    under their plain names, by Flask's usual static file handling.
+    """
+
+    def __init__(self, app, on_not_modified=None):
+        self.app = app
+        # Called with the endpoint and body size of every 304 served
+        self.on_not_modified = on_not_modified
+        self.max_age = app.config["STATIC_MAX_AGE_SECS"]
+        # plain name -> fingerprinted name
+        self.urls = {}
+        # fingerprinted name -> Asset
+        self.assets = {}
+        if app.config["STATIC_FINGERPRINT"]:
+            self.load()
+            app.url_defaults(self.fingerprint_url)
+        app.view_functions["static"] = self.serve
+
+    def load(self):
+        folder = self.app.static_folder
+        for filename in sorted(os.listdir(folder)):
+            root, ext = os.path.splitext(filename)
+            path = os.path.join(folder, filename)
+            # WebP alternatives are served in place of the GIF they came from
+            if ext == ".webp" and os.path.exists(os.path.join(folder,
+                                                              root + ".gif")):
+                continue
+            if not os.path.isfile(path):
+                continue
+            with open(path, "rb") as asset_file:
+                data = asset_file.read()
+            mimetype = mimetypes.guess_type(filename)[0] or \
+                "application/octet-stream"
+            asset = Asset(data, mimetype)
+            fingerprinted = data
+            if ext == ".gif":
+                try:
+                    with open(os.path.join(folder, root + ".webp"),
+                              "rb") as webp:
+                        webp_data = webp.read()
+                except (IOError, OSError):
+                    pass
+                else:
+                    asset.add_alternative(webp_data, "image/webp")
+                    # Both versions are served from the one URL
+                    fingerprinted += webp_data
+            name = fingerprinted_name(filename, fingerprinted)
+            self.urls[filename] = name
+            self.assets[name] = asset
+
+    def fingerprint_url(self, endpoint, values):
+        if endpoint == "static" and values.get("filename") in self.urls:
+            values["filename"] = self.urls[values["filename"]]
+
+    def serve(self, filename):
+        asset = self.assets.get(filename)
+        if asset is None:
+            return send_from_directory(self.app.static_folder, filename)
+        encoding, mimetype, body, etag = asset.select(
+            request.headers.get("Accept-Encoding", ""),
+            request.headers.get("Accept", ""))
+        # A proxy that compressed the body itself may have weakened the ETag
+        if request.if_none_match.contains_weak(etag.strip('"')):
+            response = Response(status=304)
+            if self.on_not_modified is not None:
+                self.on_not_modified("static", len(body))
+        else:
+            response = Response(body, mimetype=mimetype)
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = \
+            "public, max-age=%d, immutable" % (self.max_age,)
+        if len(asset.variants) > 1:
+            response.headers["Vary"] = "Accept-Encoding, Accept"
+        if encoding is not None:
+            response.headers["Content-Encoding"] = encoding
+        return response
+
+
+def reencode_animations(folder):
+    """Write an animated WebP next to every GIF in folder that it shrinks"""
+    from PIL import Image
+
+    for filename in sorted(os.listdir(folder)):
+        root, ext = os.path.splitext(filename)
+        if ext != ".gif":
+            continue
+        path = os.path.join(folder, filename)
+        webp_path = os.path.join(folder, root + ".webp")
+        with Image.open(path) as image:
+            image.save(webp_path, "WEBP", save_all=True, lossless=True,
+                       method=6)
+        gif_size = os.path.getsize(path)
+        webp_size = os.path.getsize(webp_path)
+        if webp_size >= gif_size:
+            os.remove(webp_path)
+            print("%s: WebP is no smaller, skipped" % (filename,))
+        else:
+            print("%s: %d -> %d bytes" % (filename, gif_size, webp_size))
+
+
+if __name__ == "__main__":
+    reencode_animations(os.path.join(os.path.dirname(__file__), "static"))
@@ -0,0 +1,77 @@
+"""Cheap classification of requests for URLs the portal has no route for.
+
+While a device is behind the portal, everything it fetches ends up at the
+404 handler: the captive portal browser's page loads, but also app API
+calls, update checks, push and analytics, and image fetches. Only a
+document navigation can show the welcome page to anyone, so classify()
+picks those out from the request line and headers alone, without parsing
+the User-Agent. Everything else gets a tiny precomputed 511 (RFC 6585),
+which tells clients that understand it that the network wants a login, and
+costs no template work.
+
+The classification errs towards navigation. A request is only shed when
+something says it isn't one: a method other than GET or HEAD, a
+Sec-Fetch-Dest other than a document, a file extension or Accept header
+that isn't HTML, or a User-Agent from an app HTTP stack rather than a
+browser or captive portal agent.
+"""
+
+NAVIGATION = "navigation"
+
+# Fetch metadata destinations that are a page load
+_DOCUMENT_DESTS = frozenset(("document", "iframe", "frame"))
+
+# Extensions of files that are never shown as a page
+_NON_DOCUMENT_EXTENSIONS = frozenset((
+    "avif", "bin", "bmp", "css", "gif", "gz", "ico", "jpeg", "jpg", "js",
+    "json", "m3u8", "map", "mp3", "mp4", "otf", "pb", "png", "proto", "svg",
+    "tar", "ts", "ttf", "webm", "webp", "woff", "woff2", "xml", "zip",
+))
+
+# User-Agent markers of app HTTP stacks. Captive portal agents and browsers
+#  never contain these (the Dalvik agent is a captive portal agent)
+_APP_UA_PREFIXES = ("okhttp/", "Go-http-client/", "grpc-", "GoogleAnalytics")
+_APP_UA_MARKERS = (" CFNetwork/",)
+
+# The precomputed response for everything that isn't a page load
+NETWORK_AUTH_REQUIRED_STATUS = "511 NETWORK AUTHENTICATION REQUIRED"
+NETWORK_AUTH_REQUIRED_BODY = (
+    b'<html><head><meta http-equiv="refresh" content="0; url=/">'
+    b'</head></html>')
+NETWORK_AUTH_REQUIRED_HEADERS = (
+    ("Content-Type", "text/html; charset=utf-8"),
+    ("Content-Length", str(len(NETWORK_AUTH_REQUIRED_BODY))),
+    ("Cache-Control", "no-store"),
+)
+
+
+def _extension(path):
+    name = path.rpartition("/")[2]
+    if "." not in name:
+        return ""
+    return name.rpartition(".")[2].lower()
+
+
+def classify(method, path, accept, fetch_dest, user_agent):
+    """Return NAVIGATION for a page load, else why the request isn't one
+
+    accept, fetch_dest and user_agent are the Accept, Sec-Fetch-Dest and
+    User-Agent header values, "" if absent.
+    """
+    if method not in ("GET", "HEAD"):
+        return "method"
+    if fetch_dest:
+        if fetch_dest in _DOCUMENT_DESTS:
+            return NAVIGATION
+        return "fetch_dest"
+    if _extension(path) in _NON_DOCUMENT_EXTENSIONS:
+        return "extension"
+    if accept:
+        if "html" in accept:
+            return NAVIGATION
+        if "*/*" not in accept:
+            return "accept"
+    if user_agent.startswith(_APP_UA_PREFIXES) or \
+            any(marker in user_agent for marker in _APP_UA_MARKERS):
+        return "app"
+    return NAVIGATION
@@ -1,3 +1,108 @@
 DEBUG = False  # make sure DEBUG is off unless enabled explicitly otherwise
 CONNECTBOX_HOSTNAME = "ConnectBox"
 CONNECTBOX_URL = "http://gowifi.org"
+# Number of distinct User-Agent strings whose parse results are kept in memory
+UA_CACHE_SIZE = 256
+# A client coming back within this long is continuing the same captive
+#  portal session, rather than rejoining the network
+MAX_ASSUMED_CP_SESSION_TIME_SECS = 300
+# Clients not seen for this long are shown the portal again
+MAX_TIME_WITHOUT_SHOWING_CP_SECS = 86400  # 1 day
+# Where client session state is kept: "memory" (per process) or "mmap"
+#  (shared by every worker on the box, required when running more than one
+#  gunicorn worker)
+SESSION_STORE = "memory"
+SESSION_STORE_PATH = "/dev/shm/captiveportal-sessions"
+# At most this many clients are tracked, the least recently seen are evicted
+SESSION_STORE_CAPACITY = 4096
+# Clients not seen for this long are forgotten. This must be well past the
+#  time after which the portal is shown to a returning client (1 day plus
+#  SESSION_EXPIRY_JITTER_SECS), or expired sessions look like brand new
+#  clients and PORTAL_REDISPLAY_RATE doesn't apply to them
+SESSION_STORE_TTL_SECS = 2 * 86400
+# With the memory session store, journal session state to this file so that
+#  clients aren't shown the portal again after a restart. None disables it.
+#  The mmap store keeps its state in SESSION_STORE_PATH instead
+SESSION_JOURNAL_PATH = None
+# How often queued session changes are written to the journal
+SESSION_JOURNAL_FLUSH_SECS = 1.0
+# Send session changes to the other ConnectBoxes on the network and apply
+#  theirs, so that phones roaming between boxes aren't shown the portal
+#  again (see replication.py). Comma separated IPv4 "host:port" addresses,
+#  or a multicast "group:port" that every box also listens on. "" disables it
+SESSION_REPLICATION_PEERS = ""
+# Secret shared by every box, which signs the session changes they send so
+#  that clients can't forge them. Required with SESSION_REPLICATION_PEERS
+SESSION_REPLICATION_SECRET = ""
+# Where peers' session changes are received: "host:port", or the multicast
+#  "group:port" to join. Use the boxes' management network address rather
+#  than the guest network's where there is one
+SESSION_REPLICATION_LISTEN = "0.0.0.0:4377"
+# How often local session changes are sent to the peers
+SESSION_REPLICATION_FLUSH_SECS = 0.2
+# With more than one worker, each worker writes its metrics to a file in
+#  this directory so that /_metrics can report the total. None disables it
+METRICS_DIR = None
+# How often each worker writes its metrics file
+METRICS_SNAPSHOT_SECS = 5.0
+# Apply DHCP events streamed as lines to this Unix socket (see dhcp.py).
+#  None disables it
+DHCP_EVENT_SOCKET = None
+# Apply changes to this dnsmasq leases file as DHCP events. None disables it
+DHCP_LEASES_FILE = None
+# How often the leases file is checked for changes
+DHCP_LEASES_POLL_SECS = 2.0
+# Where python -m captiveportal.serve listens: unix:PATH or HOST:PORT
+SERVE_BIND = "unix:/run/captiveportal.sock"
+# gunicorn worker processes. More than one needs SESSION_STORE = "mmap"
+SERVE_WORKERS = 1
+# Threads per worker, each serving one keep-alive upstream connection
+SERVE_THREADS = 4
+# How long idle upstream connections from nginx are kept open
+SERVE_KEEPALIVE_SECS = 75
+# Serve static assets from memory under URLs containing a hash of their
+#  content, so that they can be cached by devices forever
+STATIC_FINGERPRINT = True
+# How long devices may cache fingerprinted static assets
+STATIC_MAX_AGE_SECS = 31536000  # 1 year
+# Embed the browser icon animation in the welcome page, so that captive
+#  portal browsers get the whole page in one response
+INLINE_ASSETS = False
+# Each client's session lasts up to this much longer than a day, by an
+#  amount fixed for that client, so that devices which joined together
+#  aren't all shown the portal again at the same moment
+SESSION_EXPIRY_JITTER_SECS = 3600
+# At most this many expired sessions per second (per worker) are shown the
+#  portal again; the rest get the usual probe answer and are tried again on
+#  their next probe. New clients are never held back. 0 disables the limit
+PORTAL_REDISPLAY_RATE = 5
+PORTAL_REDISPLAY_BURST = 20
+# How often the CAPTIVEPORTAL_SETTINGS file is checked for changes, which
+#  are applied without a restart. 0 disables it; SIGHUP to the portal's
+#  main process (the gunicorn master under captiveportal.serve) still
+#  reloads
+SETTINGS_POLL_SECS = 2.0
+# Requests for unknown URLs (mostly background app traffic) each client may
+#  make per second, in bursts of up to CATCH_ALL_BURST, before getting a
+#  503 with Retry-After instead of the welcome page. Probes are never
+#  limited. 0 disables the limit
+CATCH_ALL_RATE = 5
+CATCH_ALL_BURST = 50
+# Clients are hashed into this many rate limit slots of 8 bytes each
+#  (rounded up to a power of two)
+CATCH_ALL_LIMIT_SLOTS = 8192
+# Keep the rate limits in this file (e.g. on /dev/shm) so that every worker
+#  shares them. None keeps them in memory shared only with forked workers
+CATCH_ALL_LIMIT_PATH = None
+# Only show the welcome page for unknown URLs when they're page loads. App
+#  API calls, images and the like get a tiny 511 instead (see catchall.py)
+CATCH_ALL_PAGES_ONLY = True
+# Memory for the history of probe decisions served at /_history, at 44
+#  bytes per decision (per worker). Takes effect on restart. 0 disables it
+PROBE_HISTORY_BYTES = 1048576  # 1 MiB, about 23800 decisions
+# Use the templates compiled by make templates (see precompiled.py) when
+#  they match the template sources. Ignored in debug mode
+PRECOMPILED_TEMPLATES = True
+# Have the captiveportal.serve master render everything and freeze its heap
+#  before forking, so that the workers share that memory (see preload.py)
+SERVE_PRELOAD = True
@@ -0,0 +1,338 @@
+"""DHCP lease events, one at a time or in bulk.
+
+dnsmasq's --dhcp-script forks the script for every lease event, and having
+the script POST each event to /handle_dhcp_event costs a process and an HTTP
+round trip per event; when a crowd associates at once that's hundreds a
+second. Events can instead be sent in batches to /handle_dhcp_events, or fed
+to the portal without HTTP at all:
+
+* DHCP_EVENT_SOCKET: a Unix socket accepting a stream of event lines, so the
+  script can be as small as `echo "$@" | nc -U /run/captiveportal-dhcp.sock`
+* DHCP_LEASES_FILE: the dnsmasq leases file, polled for changes, so no
+  script is needed at all
+
+Event lines use the dnsmasq script's argument order: operation, MAC, IP and
+optionally the hostname, separated by whitespace.
+
+Given a ClientIdentities table, events also bind each leased IP address to
+the device's MAC address, and sessions follow the MAC (see
+captiveportal.identity). A batch of events updates the table in one go.
+
+Only one worker can listen on the socket, so with more than one worker it
+needs the shared mmap session store. Every worker polls the leases file, so
+that works with per-worker stores too, and it's the only feed that keeps
+every worker's identity table up to date (see can_key_by_mac()).
+"""
+import errno
+import ipaddress
+import os
+import socket
+import threading
+import time
+
+from captiveportal.identity import mac_key
+from captiveportal.sessions import client_key
+
+OPERATIONS = frozenset(("add", "old", "del"))
+
+
+class DHCPEventError(ValueError):
+    pass
+
+
+def parse_event_line(line):
+    """Return (operation, ip, mac) for one event line
+
+    Raises DHCPEventError if the line isn't a valid event.
+    """
+    fields = line.split()
+    if len(fields) < 3:
+        raise DHCPEventError("Expected operation, mac and ip: %r" % (line,))
+    operation, mac, dhcp_ip = fields[:3]
+    if operation not in OPERATIONS:
+        raise DHCPEventError("Unknown operation: %s" % (operation,))
+    try:
+        dhcp_ip = ipaddress.ip_address(dhcp_ip)
+    except ValueError:
+        raise DHCPEventError("dhcp_ip: %s is not a valid ip address" %
+                             (dhcp_ip,))
+    return operation, dhcp_ip, mac.lower()
+
+
+def _carry_forward(store, ip_key, key):
+    """Move the session kept under ip_key to key, unless key has one"""
+    last_seen = store.last_seen(ip_key)
+    if not last_seen:
+        return
+    if not store.last_seen(key):
+        store.touch(key, last_seen)
+        if store.is_acked(ip_key):
+            store.set_acked(key)
+    store.remove(ip_key)
+
+
+def can_key_by_mac(config, store):
+    """Return whether lease events may key sessions by MAC address
+
+    The identity table is per process. With a store that isn't shared,
+    every feed keeps this process's table up to date. With several workers
+    sharing the mmap store, a binding made by the one worker that got an
+    event would leave the others keying the client by IP address, splitting
+    its session in two, so only the leases file feed, which every worker
+    polls, may bind addresses (see events_bind()). Without it, sessions stay
+    keyed by IP address.
+    """
+    return not store.shared or bool(config.get("DHCP_LEASES_FILE"))
+
+
+def events_bind(store):
+    """Return whether events from the socket and HTTP hooks may bind
+    addresses in the identity table; see can_key_by_mac()
+    """
+    return not store.shared
+
+
+def apply_event(store, operation, dhcp_ip, mac=None, identities=None,
+                bind=True):
+    """Apply one lease event to the session store"""
+    apply_events(store, [(operation, dhcp_ip, mac)], identities, bind)
+
+
+def apply_events(store, events, identities=None, bind=True):
+    """Apply (operation, ip, mac) events in order, returning how many
+
+    With identities, leases bind their IP address to the MAC address's
+    session key, and the table is updated once for the whole batch. Unless
+    bind is True, the session changes are made under the MAC key but the
+    table is left to another feed.
+    """
+    bindings = {}
+    applied = 0
+    for operation, dhcp_ip, mac in events:
+        ip_key = client_key(dhcp_ip)
+        key = mac_key(mac) if identities is not None else None
+        if key is None:
+            key = ip_key
+        elif operation == "del":
+            bindings[ip_key] = None
+        elif operation == "add":
+            # A new lease: whatever was kept under the address belonged to
+            #  whoever had it before
+            store.remove(ip_key)
+            # The device itself is rejoining the network, so needs the
+            #  popup again as for an existing lease (see below), but stays
+            #  seen
+            store.clear_ack(key)
+            bindings[ip_key] = key
+        else:
+            # The lease holder was seen by address before its lease was
+            #  known, e.g. before a restart
+            _carry_forward(store, ip_key, key)
+            bindings[ip_key] = key
+        if operation == "old":
+            # Existing lease
+            # When rejoining the network, Android 7.1+ doesn't associate a
+            #  204 with having internet access, and thus presents a
+            #  "Connected. No internet access" even though all the required
+            #  204 has been given. To force the popup, when the device
+            #  rejoins the network, we have a short time between the DHCP
+            #  lease being assigned and the first captive portal hit being
+            #  made, and in that time we reset some of the captive portal
+            #  state so that the "X11" agent receives a 200 response, thus
+            #  raising the "Sign in to network" sheet
+            # Need to check... they may not have clicked ok
+            store.clear_ack(key)
+        applied += 1
+    if bindings and bind:
+        identities.update(bindings)
+    return applied
+
+
+def parse_event_lines(lines):
+    """Return ([(operation, ip, mac), ...], [error, ...]) for event lines"""
+    events = []
+    errors = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            events.append(parse_event_line(line))
+        except DHCPEventError as error:
+            errors.append(str(error))
+    return events, errors
+
+
+class EventSocketServer(object):
+    """Applies event lines streamed to a Unix socket, one batch per read"""
+
+    def __init__(self, path, store, identities=None, bind=True):
+        self.path = path
+        self.store = store
+        self.identities = identities
+        self.bind_identities = bind
+        self.sock = None
+
+    def bind(self):
+        """Listen on the socket, returning False if another worker does"""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(self.path)
+        except OSError as error:
+            if error.errno != errno.EADDRINUSE:
+                raise
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except OSError:
+                # Left behind by a process that has gone
+                os.remove(self.path)
+                sock.bind(self.path)
+            else:
+                sock.close()
+                return False
+            finally:
+                probe.close()
+        sock.listen(16)
+        self.sock = sock
+        return True
+
+    def start(self):
+        if not self.bind():
+            return False
+        server = threading.Thread(target=self.serve_forever,
+                                  name="dhcp-event-socket")
+        server.daemon = True
+        server.start()
+        return True
+
+    def serve_forever(self):
+        while True:
+            conn, _ = self.sock.accept()
+            reader = threading.Thread(target=self.handle_connection,
+                                      args=(conn,), name="dhcp-event-reader")
+            reader.daemon = True
+            reader.start()
+
+    def handle_connection(self, conn):
+        """Apply every complete line as soon as it arrives"""
+        buffered = b""
+        with conn:
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                lines = (buffered + data).split(b"\n")
+                buffered = lines.pop()
+                self._apply(lines)
+        self._apply([buffered])
+
+    def _apply(self, lines):
+        events, _ = parse_event_lines(
+            line.decode("utf-8", "replace") for line in lines)
+        apply_events(self.store, events, self.identities,
+                     self.bind_identities)
+
+
+def read_leases(path):
+    """Return {ip: (mac, expiry)} from a dnsmasq leases file
+
+    Only DHCPv4 leases are read: a DHCPv6 lease has the client's IAID where
+    the MAC address would be, and follows the file's duid line.
+    """
+    leases = {}
+    try:
+        with open(path) as leases_file:
+            data = leases_file.read()
+    except (IOError, OSError):
+        return leases
+    for line in data.splitlines():
+        # expiry, mac, ip, hostname, client id
+        fields = line.split()
+        if fields and fields[0] == "duid":
+            break
+        if len(fields) < 3:
+            continue
+        try:
+            dhcp_ip = ipaddress.ip_address(fields[2])
+        except ValueError:
+            continue
+        if dhcp_ip.version != 4:
+            continue
+        leases[dhcp_ip] = (fields[1].lower(), fields[0])
+    return leases
+
+
+def diff_leases(old, new):
+    """Return the events that turn the leases in old into those in new"""
+    events = []
+    for dhcp_ip, (mac, _) in old.items():
+        if new.get(dhcp_ip, (None,))[0] != mac:
+            events.append(("del", dhcp_ip, mac))
+    for dhcp_ip, (mac, expiry) in new.items():
+        try:
+            old_mac, old_expiry = old[dhcp_ip]
+        except KeyError:
+            events.append(("add", dhcp_ip, mac))
+            continue
+        if old_mac != mac:
+            events.append(("add", dhcp_ip, mac))
+        elif old_expiry != expiry:
+            # Renewed by a client that already held the lease
+            events.append(("old", dhcp_ip, mac))
+    return events
+
+
+class LeaseFileWatcher(object):
+    """Polls the dnsmasq leases file and applies the changes as events"""
+
+    def __init__(self, path, store, interval=2.0, identities=None):
+        self.path = path
+        self.store = store
+        self.interval = interval
+        self.identities = identities
+        self._mtime = None
+        # Leases from before startup aren't replayed as new events, but the
+        #  identity table starts out knowing them
+        self._leases = read_leases(path)
+        if identities is not None:
+            identities.update(dict(
+                (client_key(dhcp_ip), mac_key(mac))
+                for dhcp_ip, (mac, _) in self._leases.items()
+                if mac_key(mac) is not None))
+
+    def poll(self):
+        """Apply changes since the last poll, returning how many events"""
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return 0
+        if mtime == self._mtime:
+            return 0
+        self._mtime = mtime
+        leases = read_leases(self.path)
+        events = diff_leases(self._leases, leases)
+        self._leases = leases
+        return apply_events(self.store, events, self.identities)
+
+    def start(self):
+        watcher = threading.Thread(target=self._run, name="dhcp-leases")
+        watcher.daemon = True
+        watcher.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.poll()
+
+
+def start_feeds(config, store, identities=None):
+    """Start the DHCP event feeds enabled in config"""
+    if not can_key_by_mac(config, store):
+        identities = None
+    if config.get("DHCP_EVENT_SOCKET"):
+        EventSocketServer(config["DHCP_EVENT_SOCKET"], store,
+                          identities, events_bind(store)).start()
+    if config.get("DHCP_LEASES_FILE"):
+        LeaseFileWatcher(config["DHCP_LEASES_FILE"], store,
+                         config.get("DHCP_LEASES_POLL_SECS", 2.0),
+                         identities).start()
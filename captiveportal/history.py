@@ -0,0 +1,193 @@
+"""A bounded in-memory history of the probe decisions made for each client.
+
+When a phone falls back to cellular, the question is what the portal told
+its captive portal agents, probe by probe. ProbeHistory keeps that record:
+one compact event per decision (time, client key, endpoint, UA class,
+decision and whether the client had pressed OK) in a ring buffer sized from
+a memory budget, so the oldest events are overwritten once it's full.
+
+The buffer is a set of parallel arrays allocated up front, so recording an
+event stores a few numbers into them and keeps nothing else: the budget is
+all the memory the history ever uses. Clients are hashed into a fixed table
+of at most one bucket per event, each holding the sequence number of the
+latest event of a client in that bucket, and each event stores the previous
+one in its bucket. One client's events are found by following that chain and
+skipping the other clients' rather than scanning the buffer, and the chain
+ends at the first sequence number that has been overwritten, so nothing
+needs cleaning up. Events are stored in time order, so a time window is
+found by bisection.
+
+The history is per process; with several workers, each has its own.
+"""
+import ipaddress
+import threading
+from array import array
+
+from captiveportal.useragent import UA_CLASSES
+
+# time (8), previous sequence number in the bucket (8), client key (16),
+#  one byte each for the endpoint, UA class, decision and flags, and a
+#  share of the bucket table (8)
+EVENT_BYTES = 44
+
+_ACKED = 0x01
+# The event has no client key (an address client_key() couldn't parse)
+_NO_KEY = 0x02
+
+_MASK_64 = 0xffffffffffffffff
+_FIBONACCI = 0x9e3779b97f4a7c15
+
+
+class _Codes(object):
+    """Numbers the distinct names of one event field, up to 256 of them"""
+
+    def __init__(self, names=()):
+        self.names = list(names)
+        self._codes = dict((name, code) for code, name in enumerate(names))
+
+    def code(self, name):
+        try:
+            return self._codes[name]
+        except KeyError:
+            if len(self.names) == 256:
+                raise ValueError("Too many distinct values: %r" % (name,))
+            self._codes[name] = len(self.names)
+            self.names.append(name)
+            return self._codes[name]
+
+
+class ProbeHistory(object):
+    """Ring buffer of the last budget // EVENT_BYTES probe decisions"""
+
+    def __init__(self, budget):
+        self.capacity = budget // EVENT_BYTES
+        capacity = self.capacity
+        self._time = array("d", bytes(8 * capacity))
+        self._prev = array("q", bytes(8 * capacity))
+        # Client keys are up to 128 bits (see captiveportal.identity)
+        self._key_high = array("Q", bytes(8 * capacity))
+        self._key_low = array("Q", bytes(8 * capacity))
+        self._endpoint = bytearray(capacity)
+        self._ua_class = bytearray(capacity)
+        self._decision = bytearray(capacity)
+        self._flags = bytearray(capacity)
+        self._endpoints = _Codes()
+        self._ua_classes = _Codes(UA_CLASSES)
+        self._decisions = _Codes()
+        # Bucket -> sequence number of the latest event in it, -1 if none.
+        #  A power of two no bigger than the capacity, to stay in budget
+        self._bucket_bits = max(capacity.bit_length() - 1, 0)
+        self._buckets = array("q", [-1]) * (1 << self._bucket_bits
+                                            if capacity else 0)
+        # Sequence number of the next event
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _bucket(self, key):
+        if key is None:
+            key = 0
+        folded = (key >> 64) ^ (key & _MASK_64)
+        # Fibonacci hashing: the high bits of the product mix every key bit
+        return ((folded * _FIBONACCI) & _MASK_64) >> (64 - self._bucket_bits)
+
+    def _has_key(self, slot, key):
+        if key is None:
+            return bool(self._flags[slot] & _NO_KEY)
+        return not self._flags[slot] & _NO_KEY and \
+            self._key_low[slot] == key & _MASK_64 and \
+            self._key_high[slot] == key >> 64
+
+    def record(self, when, key, endpoint, ua_class, decision, acked):
+        """Add an event, overwriting the oldest if the buffer is full"""
+        if not self.capacity:
+            return
+        bucket = self._bucket(key)
+        with self._lock:
+            seq = self._next
+            slot = seq % self.capacity
+            self._time[slot] = when
+            self._prev[slot] = self._buckets[bucket]
+            if key is None:
+                self._key_high[slot] = self._key_low[slot] = 0
+                self._flags[slot] = _NO_KEY | (_ACKED if acked else 0)
+            else:
+                self._key_high[slot] = key >> 64
+                self._key_low[slot] = key & _MASK_64
+                self._flags[slot] = _ACKED if acked else 0
+            self._endpoint[slot] = self._endpoints.code(endpoint)
+            self._ua_class[slot] = self._ua_classes.code(ua_class)
+            self._decision[slot] = self._decisions.code(decision)
+            self._buckets[bucket] = seq
+            self._next = seq + 1
+
+    def __len__(self):
+        return min(self._next, self.capacity)
+
+    def _oldest(self):
+        return max(0, self._next - self.capacity)
+
+    def _event(self, seq):
+        slot = seq % self.capacity
+        flags = self._flags[slot]
+        if flags & _NO_KEY:
+            ip = None
+        else:
+            ip = str(ipaddress.ip_address(
+                self._key_high[slot] << 64 | self._key_low[slot]))
+        return {
+            "time": self._time[slot],
+            "ip": ip,
+            "endpoint": self._endpoints.names[self._endpoint[slot]],
+            "ua_class": self._ua_classes.names[self._ua_class[slot]],
+            "decision": self._decisions.names[self._decision[slot]],
+            "acked": bool(flags & _ACKED),
+        }
+
+    def _after(self, when):
+        """Return the sequence number of the first event after when"""
+        low, high = self._oldest(), self._next
+        while low < high:
+            middle = (low + high) // 2
+            if self._time[middle % self.capacity] <= when:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _client_seqs(self, key):
+        """Yield the sequence numbers of key's events, newest first"""
+        oldest = self._oldest()
+        seq = self._buckets[self._bucket(key)]
+        # Sequence numbers only go down the chain, and once one is older than
+        #  the buffer its slot has been reused
+        while seq >= oldest:
+            slot = seq % self.capacity
+            if self._has_key(slot, key):
+                yield seq
+            seq = self._prev[slot]
+
+    def events(self, key=None, since=None, until=None, limit=100):
+        """Return up to limit events as dicts, newest first
+
+        Only events for the client key (if given) and with since <= time <=
+        until (where given) are returned.
+        """
+        with self._lock:
+            if not self.capacity:
+                return []
+            if key is not None:
+                seqs = self._client_seqs(key)
+            else:
+                end = self._next if until is None else self._after(until)
+                seqs = iter(range(end - 1, self._oldest() - 1, -1))
+            found = []
+            for seq in seqs:
+                if len(found) == limit:
+                    break
+                when = self._time[seq % self.capacity]
+                if until is not None and when > until:
+                    continue
+                if since is not None and when < since:
+                    break
+                found.append(self._event(seq))
+            return found
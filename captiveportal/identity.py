@@ -0,0 +1,78 @@
+"""Which device is behind each IP address, according to the DHCP server.
+
+Keying sessions by IP address alone breaks on networks with short leases:
+a device that comes back with a new address gets the whole portal flow
+again, and a device handed an address someone else just gave up inherits
+their session, OK press and all. When the portal gets DHCP lease events
+(see captiveportal.dhcp), sessions are instead keyed by the device's MAC
+address, and ClientIdentities maps each leased IP address to it, so a probe
+costs one dict lookup more than before. Addresses with no lease known to
+the portal keep using their IP key.
+
+MAC keys share the session stores' integer key space with client_key(): a
+MAC address is placed in the IPv6 discard-only prefix 100::/64 (RFC 6666),
+which no client can probe from, so the two can never collide and the stores
+and journal need no changes.
+
+The table is per process. The leases file feed updates every worker's
+table, but the event socket and HTTP hooks only reach one worker, so with
+several workers sharing the mmap store only the leases file binds addresses,
+and without DHCP_LEASES_FILE sessions stay keyed by IP address (see
+captiveportal.dhcp.can_key_by_mac).
+"""
+import ipaddress
+import re
+import threading
+
+_MAC_KEY_PREFIX = 0x0100 << 112
+_MAC_KEY_MASK = (1 << 64) - 1
+
+# Six hex octets separated by colons or dashes, and nothing else: dnsmasq
+#  passes other identifiers, such as a DHCPv6 client's IAID, in the same place
+_MAC_RE = re.compile(r"\A[0-9a-fA-F]{2}([:-])[0-9a-fA-F]{2}"
+                     r"(?:\1[0-9a-fA-F]{2}){4}\Z")
+
+
+def mac_key(mac):
+    """Return the session key for a MAC address, or None if it isn't one"""
+    if not isinstance(mac, str) or not _MAC_RE.match(mac):
+        return None
+    return _MAC_KEY_PREFIX | int(re.sub("[:-]", "", mac), 16)
+
+
+def is_mac_key(key):
+    return key is not None and key & ~_MAC_KEY_MASK == _MAC_KEY_PREFIX
+
+
+def describe_key(key):
+    """Return the MAC or IP address a session key stands for, as a string"""
+    if key is None:
+        return None
+    if is_mac_key(key):
+        digits = "%012x" % (key & _MAC_KEY_MASK,)
+        return ":".join(digits[i:i + 2] for i in range(0, len(digits), 2))
+    return str(ipaddress.ip_address(key))
+
+
+class ClientIdentities(object):
+    """Maps the client_key() of each leased IP address to its MAC key"""
+
+    def __init__(self):
+        self._macs = {}
+        self._lock = threading.Lock()
+
+    def session_key(self, ip_key):
+        """Return the key that the session for ip_key is stored under"""
+        return self._macs.get(ip_key, ip_key)
+
+    def update(self, bindings):
+        """Apply {ip key: MAC key, or None to unbind} all at once"""
+        with self._lock:
+            for ip_key, key in bindings.items():
+                if key is None:
+                    self._macs.pop(ip_key, None)
+                else:
+                    self._macs[ip_key] = key
+
+    def __len__(self):
+        return len(self._macs)
@@ -0,0 +1,233 @@
+"""On-disk journal that lets session state survive a portal restart.
+
+Without it, a restart (deploy, crash, OOM on the box) forgets every client,
+so the next probe from every connected phone looks like a new captive portal
+session and the sign-in sheet pops up on hundreds of devices at once.
+
+JournaledSessionStore wraps another SessionStore. Every change is queued in
+memory and a background thread appends the queue to the journal file once
+per flush interval, so no disk IO happens on the request path. When the
+journal has grown well past the size of the live state, the same thread
+rewrites it as a compact snapshot. At startup the whole file is loaded with
+a single read.
+
+A gunicorn worker forks from a master that loaded the journal when it
+started, and one respawned after a crash would otherwise start from that
+stale state and, at its next compaction, erase everything journaled since.
+So each worker reloads the journal once it has forked (see
+captiveportal.serve).
+
+If the journal can't be written (a missing directory, or a full or
+read-only SD card), the error is logged and the changes stay queued for the
+next flush. The queue is bounded, so while the problem lasts the oldest
+changes are dropped rather than memory growing with every probe.
+
+The mmap session store doesn't need this to survive a process restart, as
+its table already lives in a file; put SESSION_STORE_PATH on persistent
+storage rather than /dev/shm if it must also survive a reboot.
+"""
+import atexit
+import collections
+import logging
+import os
+import struct
+import threading
+import time
+
+from captiveportal.sessions import SessionStore, pack_key, unpack_key
+
+# operation, packed client key, time
+_RECORD = struct.Struct("<B16sd")
+
+OP_TOUCH = 1
+OP_ACK = 2
+OP_CLEAR_ACK = 3
+OP_REMOVE = 4
+
+# Don't bother compacting journals smaller than this
+MIN_COMPACTION_BYTES = 64 * 1024
+
+# At most this many changes wait to be written; beyond it the oldest go
+MAX_PENDING_RECORDS = 16384
+
+logger = logging.getLogger(__name__)
+
+
+class JournaledSessionStore(SessionStore):
+    """A SessionStore whose changes are journaled to disk off the request path
+    """
+
+    def __init__(self, store, path, flush_interval=1.0):
+        self.store = store
+        self.path = path
+        self.flush_interval = flush_interval
+        self._pending = collections.deque()
+        self._flush_lock = threading.Lock()
+        self._writer_pid = None
+        self._snapshot_bytes = 0
+        self.dropped = 0
+        self._load()
+        self._journal_bytes = self._file_size()
+        atexit.register(self._flush_or_log)
+
+    def _file_size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def _load(self):
+        """Replay the journal into the wrapped store with one bulk read"""
+        try:
+            with open(self.path, "rb") as journal:
+                data = journal.read()
+        except (IOError, OSError):
+            return
+        # Ignore a partial record left by a crash part way through a write
+        data = data[:len(data) - len(data) % _RECORD.size]
+        clients = {}
+        for op, packed, when in _RECORD.iter_unpack(data):
+            if op == OP_REMOVE:
+                clients.pop(packed, None)
+                continue
+            client = clients.setdefault(packed, [0, False])
+            if op == OP_TOUCH:
+                client[0] = when
+            elif op == OP_ACK:
+                client[1] = True
+            elif op == OP_CLEAR_ACK:
+                client[1] = False
+
+        cutoff = time.time() - getattr(self.store, "ttl", float("inf"))
+        # Oldest first, so the wrapped store's eviction order is preserved
+        for packed, (last_seen, acked) in sorted(clients.items(),
+                                                 key=lambda c: c[1][0]):
+            if last_seen < cutoff:
+                continue
+            key = unpack_key(packed)
+            self.store.touch(key, last_seen)
+            if acked:
+                self.store.set_acked(key)
+        self._snapshot_bytes = len(clients) * _RECORD.size
+
+    def reload(self):
+        """Replace the wrapped store's state with the journal's"""
+        with self._flush_lock:
+            for key, _, _ in self.store.items():
+                self.store.remove(key)
+            self._pending.clear()
+            self._load()
+            self._journal_bytes = self._file_size()
+
+    def _record(self, op, key, when=0.0):
+        if key is None:
+            return
+        self._pending.append((op, key, when))
+        if len(self._pending) > MAX_PENDING_RECORDS:
+            self._drop_oldest()
+        # Threads don't survive a fork, so each worker starts its own writer
+        if self._writer_pid != os.getpid():
+            self._writer_pid = os.getpid()
+            writer = threading.Thread(target=self._run_writer,
+                                      name="session-journal")
+            writer.daemon = True
+            writer.start()
+
+    def _drop_oldest(self):
+        pending = self._pending
+        while len(pending) > MAX_PENDING_RECORDS:
+            try:
+                pending.popleft()
+            except IndexError:
+                break
+            self.dropped += 1
+
+    def _run_writer(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self._flush_or_log()
+
+    def _flush_or_log(self):
+        try:
+            self.flush()
+        except OSError:
+            logger.exception("Couldn't write the session journal %s",
+                             self.path)
+
+    def flush(self):
+        """Append every queued change to the journal, compacting if needed
+
+        If the journal can't be written, the changes are queued again and
+        the OSError is raised.
+        """
+        with self._flush_lock:
+            changes = []
+            pending = self._pending
+            while pending:
+                changes.append(pending.popleft())
+            if changes:
+                data = b"".join(_RECORD.pack(op, pack_key(key), when)
+                                for op, key, when in changes)
+                try:
+                    with open(self.path, "ab") as journal:
+                        journal.write(data)
+                except OSError:
+                    # Back in front of anything queued since, in order
+                    pending.extendleft(reversed(changes))
+                    self._drop_oldest()
+                    raise
+                self._journal_bytes += len(data)
+            if self._journal_bytes > max(MIN_COMPACTION_BYTES,
+                                         4 * self._snapshot_bytes):
+                self._compact()
+
+    def _compact(self):
+        """Rewrite the journal as a snapshot of the live state"""
+        records = []
+        for key, last_seen, acked in self.store.items():
+            packed = pack_key(key)
+            records.append(_RECORD.pack(OP_TOUCH, packed, last_seen))
+            if acked:
+                records.append(_RECORD.pack(OP_ACK, packed, 0.0))
+        data = b"".join(records)
+        tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp_path, "wb") as snapshot:
+            snapshot.write(data)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.rename(tmp_path, self.path)
+        self._snapshot_bytes = self._journal_bytes = len(data)
+
+    def last_seen(self, key):
+        return self.store.last_seen(key)
+
+    def touch(self, key, when):
+        self.store.touch(key, when)
+        self._record(OP_TOUCH, key, when)
+
+    def is_acked(self, key):
+        return self.store.is_acked(key)
+
+    def set_acked(self, key, when=None):
+        self.store.set_acked(key, when)
+        self._record(OP_ACK, key)
+
+    def clear_ack(self, key, when=None):
+        self.store.clear_ack(key, when)
+        self._record(OP_CLEAR_ACK, key)
+
+    def remove(self, key, when=None):
+        self.store.remove(key, when)
+        self._record(OP_REMOVE, key)
+
+    def items(self):
+        return self.store.items()
+
+    def stats(self):
+        stats = dict(self.store.stats())
+        stats["journal_bytes"] = self._journal_bytes
+        stats["journal_dropped"] = self.dropped
+        return stats
+
+    def __len__(self):
+        return len(self.store)
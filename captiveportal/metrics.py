@@ -0,0 +1,259 @@
+"""Request, latency and decision metrics in Prometheus text format.
+
+Every route is counted by endpoint and status with a latency histogram, and
+the probe handlers count which decision they made (see captiveportal.portal).
+Conditional requests answered with a 304 count the body bytes they saved.
+Recording is a couple of dict and list increments in the worker's own memory,
+with no locks or IO on the request path; under the GIL a rare increment lost
+to a thread race is an acceptable price for that.
+
+With several gunicorn workers each one only sees its own requests. When
+METRICS_DIR is set, every worker writes a snapshot of its counters there
+from a background thread, and whichever worker serves the metrics endpoint
+adds up the snapshots of the others with its own live counters.
+"""
+import bisect
+import collections
+import json
+import os
+import threading
+import time
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+class Metrics(object):
+    """Per worker counters, optionally shared through snapshot files"""
+
+    def __init__(self, ua_cache, session_store, snapshot_dir=None,
+                 snapshot_interval=5.0, redisplay_admission=None):
+        self.ua_cache = ua_cache
+        self.session_store = session_store
+        self.redisplay_admission = redisplay_admission
+        self.snapshot_dir = snapshot_dir
+        self.snapshot_interval = snapshot_interval
+        # (endpoint, status) -> count
+        self.requests = collections.Counter()
+        # endpoint -> [count per bucket..., count above the last bucket, sum]
+        self.latencies = {}
+        # (handler, decision) -> count
+        self.decisions = collections.Counter()
+        # endpoint -> body bytes not sent thanks to a 304
+        self.bytes_saved = collections.Counter()
+        self._writer_pid = None
+
+    def observe_request(self, endpoint, status, seconds):
+        self.requests[(endpoint, status)] += 1
+        try:
+            histogram = self.latencies[endpoint]
+        except KeyError:
+            histogram = self.latencies[endpoint] = \
+                [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+        histogram[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        histogram[-1] += seconds
+        # Threads don't survive a fork, so each worker starts its own writer
+        if self.snapshot_dir is not None and self._writer_pid != os.getpid():
+            self._writer_pid = os.getpid()
+            writer = threading.Thread(target=self._run_writer,
+                                      name="metrics-snapshot")
+            writer.daemon = True
+            writer.start()
+
+    def count_decision(self, handler, decision):
+        self.decisions[(handler, decision)] += 1
+
+    def count_not_modified(self, endpoint, body_bytes):
+        self.bytes_saved[endpoint] += body_bytes
+
+    def snapshot(self):
+        """Return this worker's counters as a JSON serialisable dict"""
+        return {
+            "requests": [list(key) + [count]
+                         for key, count in list(self.requests.items())],
+            "latencies": [[endpoint] + list(histogram)
+                          for endpoint, histogram
+                          in list(self.latencies.items())],
+            "decisions": [list(key) + [count]
+                          for key, count in list(self.decisions.items())],
+            "bytes_saved": [[endpoint, count] for endpoint, count
+                            in list(self.bytes_saved.items())],
+            "ua_cache": [self.ua_cache.hits, self.ua_cache.misses],
+            "sessions": self.session_store.stats(),
+            "redisplays_deferred": self._redisplays_deferred(),
+        }
+
+    def _redisplays_deferred(self):
+        if self.redisplay_admission is None:
+            return 0
+        return self.redisplay_admission.deferred
+
+    def _snapshot_path(self, pid):
+        return os.path.join(self.snapshot_dir, "%d.json" % (pid,))
+
+    def _run_writer(self):
+        while True:
+            time.sleep(self.snapshot_interval)
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        """Atomically replace this worker's snapshot file"""
+        path = self._snapshot_path(os.getpid())
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as snapshot:
+            json.dump(self.snapshot(), snapshot)
+        os.rename(tmp_path, path)
+
+    def _worker_snapshots(self):
+        """Yield the snapshots of every other live worker"""
+        try:
+            names = os.listdir(self.snapshot_dir)
+        except OSError:
+            return
+        for name in names:
+            pid, ext = os.path.splitext(name)
+            if ext != ".json" or not pid.isdigit() or \
+                    int(pid) == os.getpid():
+                continue
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                # The worker has gone, and so have its counters
+                try:
+                    os.remove(os.path.join(self.snapshot_dir, name))
+                except OSError:
+                    pass
+                continue
+            except OSError:
+                pass
+            try:
+                with open(os.path.join(self.snapshot_dir, name)) as snapshot:
+                    yield json.load(snapshot)
+            except (OSError, ValueError):
+                continue
+
+    def aggregate(self):
+        """Return this worker's snapshot added up with every other worker's
+        """
+        requests = collections.Counter(self.requests)
+        latencies = dict((endpoint, list(histogram))
+                         for endpoint, histogram
+                         in list(self.latencies.items()))
+        decisions = collections.Counter(self.decisions)
+        bytes_saved = collections.Counter(self.bytes_saved)
+        ua_hits, ua_misses = self.ua_cache.hits, self.ua_cache.misses
+        sessions = collections.Counter(self.session_store.stats())
+        redisplays_deferred = self._redisplays_deferred()
+        workers = 1
+        if self.snapshot_dir is not None:
+            for snapshot in self._worker_snapshots():
+                workers += 1
+                for endpoint, status, count in snapshot["requests"]:
+                    requests[(endpoint, status)] += count
+                for row in snapshot["latencies"]:
+                    histogram = latencies.setdefault(
+                        row[0], [0] * (len(LATENCY_BUCKETS) + 1) + [0.0])
+                    for index, value in enumerate(row[1:]):
+                        histogram[index] += value
+                for handler, decision, count in snapshot["decisions"]:
+                    decisions[(handler, decision)] += count
+                for endpoint, count in snapshot.get("bytes_saved", []):
+                    bytes_saved[endpoint] += count
+                ua_hits += snapshot["ua_cache"][0]
+                ua_misses += snapshot["ua_cache"][1]
+                redisplays_deferred += snapshot.get("redisplays_deferred", 0)
+                # A shared store already counts every worker's clients
+                if not self.session_store.shared:
+                    sessions.update(snapshot["sessions"])
+        return {
+            "requests": requests,
+            "latencies": latencies,
+            "decisions": decisions,
+            "bytes_saved": bytes_saved,
+            "ua_cache": (ua_hits, ua_misses),
+            "sessions": sessions,
+            "redisplays_deferred": redisplays_deferred,
+            "workers": workers,
+        }
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format"""
+        totals = self.aggregate()
+        lines = [
+            "# HELP captiveportal_requests_total Requests handled",
+            "# TYPE captiveportal_requests_total counter",
+        ]
+        for (endpoint, status), count in sorted(totals["requests"].items()):
+            lines.append('captiveportal_requests_total{endpoint="%s",'
+                         'status="%s"} %d' % (endpoint, status, count))
+
+        lines.extend([
+            "# HELP captiveportal_request_duration_seconds Time spent "
+            "handling requests",
+            "# TYPE captiveportal_request_duration_seconds histogram",
+        ])
+        for endpoint, histogram in sorted(totals["latencies"].items()):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, histogram):
+                cumulative += count
+                lines.append('captiveportal_request_duration_seconds_bucket'
+                             '{endpoint="%s",le="%g"} %d' %
+                             (endpoint, bound, cumulative))
+            cumulative += histogram[len(LATENCY_BUCKETS)]
+            lines.append('captiveportal_request_duration_seconds_bucket'
+                         '{endpoint="%s",le="+Inf"} %d' %
+                         (endpoint, cumulative))
+            lines.append('captiveportal_request_duration_seconds_sum'
+                         '{endpoint="%s"} %.6f' % (endpoint, histogram[-1]))
+            lines.append('captiveportal_request_duration_seconds_count'
+                         '{endpoint="%s"} %d' % (endpoint, cumulative))
+
+        lines.extend([
+            "# HELP captiveportal_decisions_total Decisions made by the "
+            "probe handlers",
+            "# TYPE captiveportal_decisions_total counter",
+        ])
+        for (handler, decision), count in sorted(
+                totals["decisions"].items()):
+            lines.append('captiveportal_decisions_total{handler="%s",'
+                         'decision="%s"} %d' % (handler, decision, count))
+
+        lines.extend([
+            "# HELP captiveportal_not_modified_bytes_saved_total Body bytes "
+            "not sent because the client's copy was current (304)",
+            "# TYPE captiveportal_not_modified_bytes_saved_total counter",
+        ])
+        for endpoint, count in sorted(totals["bytes_saved"].items()):
+            lines.append('captiveportal_not_modified_bytes_saved_total'
+                         '{endpoint="%s"} %d' % (endpoint, count))
+
+        hits, misses = totals["ua_cache"]
+        lines.extend([
+            "# HELP captiveportal_ua_cache_lookups_total User-Agent cache "
+            "lookups",
+            "# TYPE captiveportal_ua_cache_lookups_total counter",
+            'captiveportal_ua_cache_lookups_total{result="hit"} %d' % (hits,),
+            'captiveportal_ua_cache_lookups_total{result="miss"} %d' %
+            (misses,),
+            "# TYPE captiveportal_ua_cache_hit_ratio gauge",
+            "captiveportal_ua_cache_hit_ratio %.4f" % (
+                hits / (hits + misses) if hits + misses else 0.0,),
+            "# HELP captiveportal_session_store Session store size and "
+            "expiry counters",
+            "# TYPE captiveportal_session_store gauge",
+        ])
+        for name, value in sorted(totals["sessions"].items()):
+            lines.append('captiveportal_session_store{stat="%s"} %d' %
+                         (name, value))
+        lines.extend([
+            "# HELP captiveportal_redisplays_deferred_total Expired sessions "
+            "not shown the portal again yet, to limit the load",
+            "# TYPE captiveportal_redisplays_deferred_total counter",
+            "captiveportal_redisplays_deferred_total %d" % (
+                totals["redisplays_deferred"],),
+            "# HELP captiveportal_workers Workers whose counters are included",
+            "# TYPE captiveportal_workers gauge",
+            "captiveportal_workers %d" % (totals["workers"],),
+        ])
+        return "\n".join(lines) + "\n"
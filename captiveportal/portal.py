@@ -0,0 +1,223 @@
+"""Captive portal decision logic, independent of any web framework.
+
+Each probe handler works out what a client should be told from its session
+state and DeviceProfile alone, and returns one of the DECISION_* values.
+The Flask views in views.py and the asyncio probe server in asgi.py turn
+decisions into responses, so both serve clients exactly the same way.
+
+Devices that joined together, say at the start of yesterday's morning
+session, would all be shown the portal again in the same minute a day later.
+Two things spread that load out. Every client's session lasts up to
+SESSION_EXPIRY_JITTER_SECS longer than MAX_TIME_WITHOUT_SHOWING_CP_SECS, by
+an amount that is fixed for that client, so its portal doesn't come back on
+a different schedule each time. And the decide_* functions take an optional
+TokenBucket that limits how often expired sessions are shown the portal
+again. A client over the limit gets the cheap steady state answer, and its
+session isn't renewed, so it's tried again on its next probe. Clients that
+have never been seen are always shown the portal.
+
+The timings are read from captiveportal.settings on every call, so they
+can be changed without a restart.
+"""
+import threading
+
+from captiveportal import settings
+
+# Android: internet access is available
+DECISION_204 = "204"
+# Android: show the welcome page, which raises the "sign-in" sheet
+DECISION_WELCOME = "welcome"
+# iOS/macOS: client is rejoining the network, don't raise the CP browser
+DECISION_REJOIN = "rejoin"
+# iOS/macOS: wispr agent has already been through the portal
+DECISION_SUCCESS = "success"
+# iOS/macOS: new session, or the CP browser itself, gets the welcome page
+DECISION_CONNECTED = "connected"
+
+
+class TokenBucket(object):
+    """Admits at most rate events per second, with bursts of up to burst
+
+    A rate of 0 admits everything.
+    """
+
+    def __init__(self, rate, burst):
+        self.deferred = 0
+        self.updated = None
+        self._lock = threading.Lock()
+        self.configure(rate, burst)
+
+    def configure(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+
+    def admit(self, now):
+        if not self.rate:
+            return True
+        with self._lock:
+            if self.updated is not None:
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            self.deferred += 1
+            return False
+
+
+def expiry_jitter(key):
+    """Return how much longer than a day this client's sessions last
+
+    The value is spread evenly over [0, SESSION_EXPIRY_JITTER_SECS) by a
+    multiplicative hash of the client key, so it's the same on every call,
+    in every worker and across restarts.
+    """
+    jitter_secs = settings.current.SESSION_EXPIRY_JITTER_SECS
+    if key is None or not jitter_secs:
+        return 0
+    return (key * 2654435761 & 0xffffffff) * jitter_secs / 2 ** 32
+
+
+def max_time_without_showing_cp(key):
+    return settings.current.MAX_TIME_WITHOUT_SHOWING_CP_SECS + \
+        expiry_jitter(key)
+
+
+def secs_since_last_seen(store, key, now):
+    """Return seconds elapsed since this client was last registered with the portal.
+
+    Returns a very large number (time since epoch) for clients that have never
+    been seen, so all comparison checks naturally treat them as "new".
+    """
+    return now - store.last_seen(key)
+
+
+def client_is_rejoining_network(store, key, now):
+    """
+    Checks whether this IP has gone through this CP recently
+
+    We want to avoid bringing up the captive portal browser when a
+    user rejoins the network after a short break because spamminess
+    is bad, and they shouldn't need a pointer to the content (which
+    is what the captive portal browser provides).
+
+    We differentiate rejoining the network as opposed to continuing the
+    same captive portal session, and we do this by saying that a rejoin
+    is only happening if it's more than MAX_ASSUMED_CP_SESSION_TIME_SECS
+    after the last session started
+    """
+    secs = secs_since_last_seen(store, key, now)
+    return settings.current.MAX_ASSUMED_CP_SESSION_TIME_SECS < secs < \
+        max_time_without_showing_cp(key)
+
+
+def is_new_captive_portal_session(store, key, now):
+    """Return True if this client has not been seen within the last 24 hours.
+
+    A client older than MAX_TIME_WITHOUT_SHOWING_CP_SECS is treated as brand-new
+    so the portal page is shown again — this handles devices that return after
+    more than a day without going through the captive portal flow again.
+    """
+    return secs_since_last_seen(store, key, now) > \
+        max_time_without_showing_cp(key)
+
+
+def defer_redisplay(store, key, now, admission):
+    """Should showing the portal again to this expired session wait?"""
+    return admission is not None and store.last_seen(key) != 0 and \
+        not admission.admit(now)
+
+
+def android_cpa_needs_204_now(store, key, profile):
+    """Does this captive portal agent need a 204 right now?
+
+    We expect the user agents to go through various states before receiving
+    a 204. This is particularly important for Android >= 7.1, which falls back
+    to cellular if it doesn't get a 204 at the right time.
+    """
+    if not profile.is_android:
+        # We're the "X11" agent in Android 7.1+
+        # Only show a 204 if the user has pressed "OK" on the CP screen
+        return store.is_acked(key)
+
+    # 5.0.1 shows a confusing webpage unavailable page when Dalvik receives
+    #  a 204 response after a POST, but as we never present an OK button to
+    #  5.0.1 (because the DeviceProfile never sets show_ok), we don't have
+    #  to worry about a specific 5.0.1 check here.
+    if profile.is_dalvik:
+        return store.is_acked(key)
+
+    # We're the Android Webkit agent, never send a 204
+    return False
+
+
+def decide_ios_macos(store, key, profile, now, admission=None):
+    """Handle iOS and MacOS interactions
+    iOS <v9 and MacOS pre-yosemite
+    See: https://forum.piratebox.cc/read.php?9,8927
+
+    iOS >= v9 and MacOS Yosemite and later:
+    # pylint: disable=line-too-long
+    See: https://apple.stackexchange.com/questions/45418/how-to-automatically-login-to-captive-portals-on-os-x
+    """
+    if client_is_rejoining_network(store, key, now):
+        # Don't raise captive portal browser
+        store.touch(key, now)
+        return DECISION_REJOIN
+
+    if is_new_captive_portal_session(store, key, now):
+        if defer_redisplay(store, key, now, admission):
+            # Too many sessions are expiring at once. Carry on as if this
+            #  one hadn't, without renewing it
+            if profile.is_captive_network_support:
+                return DECISION_SUCCESS
+            return DECISION_CONNECTED
+        store.touch(key, now)
+        # raise captive portal browser by not showing success.html
+        return DECISION_CONNECTED
+
+    if profile.is_captive_network_support:
+        # CaptiveNetworkSupport/wispr is the captive portal agent.
+        # Always show "success" after initial interaction
+        return DECISION_SUCCESS
+
+    # We're the captive portal browser.
+    # Show connected message after initial interaction
+    return DECISION_CONNECTED
+
+
+def decide_android(store, key, profile, method, now, admission=None):
+    """Handle Android interactions"""
+    if is_new_captive_portal_session(store, key, now):
+        if defer_redisplay(store, key, now, admission):
+            # Too many sessions are expiring at once. Carry on as if this
+            #  one hadn't, without renewing it
+            if android_cpa_needs_204_now(store, key, profile):
+                return DECISION_204
+            return DECISION_WELCOME
+        # reset state in order to raise the captive portal browser
+        # As >= v7.1 "X11 agent" regularly hits the generate_204
+        #  endpoint, in >=7.1 the check isn't really about whether this is a
+        #  new captive portal session and more about whether we haven't seen
+        #  the device "recently"
+        # this code path is also used by < v7.1, but it's ok to reset state
+        #  for those devices too because it will still raise the cp browser
+        store.remove(key, now)
+
+    # The X11 captive portal agent periodically checks for internet access.
+    # It's the only agent that hits this endpoint after the captive portal
+    #  browser has been seen, and as the X11 agent doesn't detect internet
+    #  access after a reconnect to the network, despite a 204. Updating the
+    #  session start time means that eventually this won't been seen as an
+    #  existing captive portal session and we won't send a 204, which
+    #  will cause the "sign-in to wifi" sheet to come up.
+    store.touch(key, now)
+
+    if method == "POST":
+        store.set_acked(key, now)
+
+    if android_cpa_needs_204_now(store, key, profile):
+        return DECISION_204
+    return DECISION_WELCOME
@@ -0,0 +1,72 @@
+"""Templates compiled to Python ahead of time.
+
+Jinja compiles each template to Python source and then to bytecode the
+first time it's rendered, which on a slow board is a noticeable part of the
+time from a worker starting to it serving its first welcome page.
+
+    make templates
+
+compiles the templates into the precompiled_templates directory next to
+them, which is shipped in the sdist. At startup, install() puts them in
+front of the normal template loader, as long as they were compiled from the
+current template sources by the installed Jinja version; otherwise the
+templates are compiled at runtime as usual. Debug mode always uses the
+sources, so that template edits show up.
+"""
+import hashlib
+import json
+import os
+
+import jinja2
+from jinja2 import ChoiceLoader, ModuleLoader
+
+TEMPLATES = ("connected.html", "success.html")
+
+_MANIFEST = "manifest.json"
+
+
+def target_folder(app):
+    return os.path.join(app.root_path, "precompiled_templates")
+
+
+def _manifest(app):
+    """Return what the precompiled templates must have been built from"""
+    template_folder = os.path.join(app.root_path, app.template_folder)
+    sources = {}
+    for name in TEMPLATES:
+        with open(os.path.join(template_folder, name), "rb") as template:
+            sources[name] = hashlib.sha1(template.read()).hexdigest()
+    return {"jinja2": jinja2.__version__, "templates": sources}
+
+
+def compile_templates(app, target=None):
+    """Compile the templates into target, as Python modules"""
+    target = target or target_folder(app)
+    app.jinja_env.compile_templates(
+        target, filter_func=lambda name: name in TEMPLATES, zip=None,
+        ignore_errors=False)
+    with open(os.path.join(target, _MANIFEST), "w") as manifest:
+        json.dump(_manifest(app), manifest, indent=2, sort_keys=True)
+
+
+def install(app, target=None):
+    """Load templates from target if they're up to date, returning True if so
+    """
+    target = target or target_folder(app)
+    if app.debug:
+        return False
+    try:
+        with open(os.path.join(target, _MANIFEST)) as manifest:
+            if json.load(manifest) != _manifest(app):
+                return False
+    except (IOError, OSError, ValueError):
+        return False
+    app.jinja_env.loader = ChoiceLoader([ModuleLoader(target),
+                                         app.jinja_env.loader])
+    return True
+
+
+def main():
+    # pylint: disable=import-outside-toplevel
+    from captiveportal import app
+    compile_templates(app)
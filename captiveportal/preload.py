@@ -0,0 +1,39 @@
+"""Build everything once in the gunicorn master, before the workers fork.
+
+Without this, every worker imports ua_parser's regex list, compiles the
+templates and renders the welcome page variants on its first requests, so
+each grows its own copy of all of that and memory goes up with every worker.
+warm() does that work in the master instead: the app and static assets are
+already loaded by importing captiveportal, and warm() adds ua_parser, the
+compiled templates and every pre-rendered page. The workers forked from it
+then share those pages of memory with the master.
+
+Sharing only lasts until a page is written to, and in CPython even reading
+an object writes its reference count, while each garbage collection touches
+every object it tracks. freeze() moves everything built so far out of the
+collector's reach (gc.freeze(), Python 3.7+) so that collections in the
+workers leave those pages alone.
+"""
+import gc
+
+from captiveportal.useragent import parse
+from captiveportal.views import response_cache
+
+
+def warm():
+    """Load and render everything the workers would do on first use"""
+    # pylint: disable=import-outside-toplevel,unused-import
+    # Lazily imported otherwise (see captiveportal.useragent)
+    from ua_parser import user_agent_parser
+    # Builds every page variant, compiling the templates on the way
+    response_cache.success()
+    response_cache.connected(parse(""))
+
+
+def freeze():
+    """Keep everything allocated so far out of the garbage collector's way"""
+    gc.collect()
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+        return True
+    return False
@@ -0,0 +1,212 @@
+"""Captive portal probes answered without going through Flask.
+
+Once a device has been through the portal, its probes settle into a steady
+state whose answer depends only on the path, the DeviceProfile and one
+session lookup: a bare 204 for the Android agents that have pressed OK,
+success.html for the wispr agent, the welcome page for everyone else, and
+the fixed RFC 8908 JSON document. answer_probe() makes the same decisions
+as the views (see captiveportal.portal) and returns one of the pre-rendered
+responses, so a server can skip Flask routing and request context set up.
+
+ProbeFastPath serves those answers as WSGI middleware in front of Flask
+(inside ProxyFix, so the client address is already the real one); the
+asyncio server in asgi.py serves them on the event loop.
+
+ProbeFastPath also sheds catch-all traffic: requests for URLs the app has no
+route for, which Flask would answer with a full welcome page, are limited
+per client by views.catch_all_limiter before any of that work is done, and
+only those that are page loads (see captiveportal.catchall) reach Flask.
+
+Conditional GETs for a page the client already has are answered with a
+bodiless 304. Probes still go through their decision first, since that
+updates the session, but a catch-all page load or a Windows probe whose
+If-None-Match names a welcome page variant is answered without parsing the
+User-Agent at all.
+"""
+import time
+
+from captiveportal import app, catchall, portal, settings
+from captiveportal.sessions import client_key
+from captiveportal.useragent import parse
+from captiveportal.views import catch_all_limiter, client_identities, \
+    metrics, record_decision, redisplay_admission, response_cache, \
+    session_store, start_background_tasks
+
+ANDROID_PATHS = frozenset(("/generate_204", "/gen_204"))
+IOS_MACOS_PATHS = frozenset(("/hotspot-detect.html", "/success.html",
+                             "/library/test/success.html"))
+WINDOWS_PATHS = frozenset(("/ncsi.txt", "/connecttest.txt"))
+CAPTIVE_PORTAL_API_PATH = "/.well-known/captive-portal"
+
+# Probes answered here are counted under the Flask view they stand in for
+ENDPOINTS = dict((rule.rule, rule.endpoint)
+                 for rule in app.url_map.iter_rules())
+
+# Every path with a route; anything else goes to the 404 handler
+_ROUTED_PREFIXES = tuple(rule.rule.split("<", 1)[0]
+                         for rule in app.url_map.iter_rules()
+                         if rule.arguments)
+
+
+def is_catch_all(path):
+    """Return True if path would be served by the 404 handler"""
+    return path not in ENDPOINTS and not path.startswith(_ROUTED_PREFIXES)
+
+
+def _page(path, method, cached, if_none_match):
+    """Return (status, cached), 304 if the client already has the page"""
+    if method in ("GET", "HEAD") and cached.matches(if_none_match):
+        metrics.count_not_modified(ENDPOINTS[path], len(cached.body))
+        return 304, cached
+    return 200, cached
+
+
+def answer_probe(path, method, user_agent, client_addr, if_none_match=""):
+    """Return (status, CachedResponse) for a probe, or None if it isn't one
+
+    The CachedResponse is None for a 204. The status is 304 if
+    if_none_match names the page that would have been sent.
+    """
+    if path == CAPTIVE_PORTAL_API_PATH:
+        if method not in ("GET", "HEAD"):
+            return None
+        return _page(path, method, response_cache.captive_portal_api(),
+                     if_none_match)
+
+    if method not in ("GET", "HEAD", "POST"):
+        return None
+    if path in ANDROID_PATHS:
+        profile = parse(user_agent)
+        ip_key = client_key(client_addr)
+        key = client_identities.session_key(ip_key)
+        now = time.time()
+        decision = portal.decide_android(
+            session_store, key, profile, method, now, redisplay_admission)
+        record_decision("android", ENDPOINTS[path], ip_key, key, profile,
+                        decision, now)
+        if decision == portal.DECISION_204:
+            return 204, None
+        return _page(path, method, response_cache.connected(profile),
+                     if_none_match)
+    if path in IOS_MACOS_PATHS:
+        profile = parse(user_agent)
+        ip_key = client_key(client_addr)
+        key = client_identities.session_key(ip_key)
+        now = time.time()
+        decision = portal.decide_ios_macos(
+            session_store, key, profile, now, redisplay_admission)
+        record_decision("ios_macos", ENDPOINTS[path], ip_key, key, profile,
+                        decision, now)
+        if decision in (portal.DECISION_REJOIN, portal.DECISION_SUCCESS):
+            return _page(path, method, response_cache.success(),
+                         if_none_match)
+        return _page(path, method, response_cache.connected(profile),
+                     if_none_match)
+    if path in WINDOWS_PATHS:
+        session_store.touch(
+            client_identities.session_key(client_key(client_addr)),
+            time.time())
+        cached = None
+        if method in ("GET", "HEAD"):
+            cached = response_cache.connected_matching(if_none_match)
+        if cached is None:
+            cached = response_cache.connected(parse(user_agent))
+        return _page(path, method, cached, if_none_match)
+    return None
+
+
+_STATUS_LINES = {200: "200 OK", 204: "204 NO CONTENT",
+                 304: "304 NOT MODIFIED"}
+_NO_CONTENT_HEADERS = [("Content-Length", "0")]
+_SHED_STATUS_LINE = "503 SERVICE UNAVAILABLE"
+
+
+class ProbeFastPath(object):
+    """WSGI middleware answering GET and HEAD probes from the response cache
+
+    POSTs, which carry the Android OK press, and every other request fall
+    through to the Flask app, except catch-all requests from clients over
+    their rate limit, which get an empty 503 with Retry-After, and those
+    that aren't page loads, which get a precomputed 511. Catch-all page
+    loads revalidating a welcome page variant get a 304 here too.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        start_background_tasks()
+        method = environ["REQUEST_METHOD"]
+        started = time.perf_counter()
+        path = environ.get("PATH_INFO", "")
+        answer = None
+        if method in ("GET", "HEAD"):
+            answer = answer_probe(path, method,
+                                  environ.get("HTTP_USER_AGENT", ""),
+                                  environ.get("REMOTE_ADDR"),
+                                  environ.get("HTTP_IF_NONE_MATCH", ""))
+        if answer is None:
+            if is_catch_all(path):
+                wait = catch_all_limiter.check(
+                    client_key(environ.get("REMOTE_ADDR")), time.time())
+                if wait:
+                    return self._shed(wait, start_response, started)
+                if settings.current.CATCH_ALL_PAGES_ONLY:
+                    kind = catchall.classify(
+                        method, path, environ.get("HTTP_ACCEPT", ""),
+                        environ.get("HTTP_SEC_FETCH_DEST", ""),
+                        environ.get("HTTP_USER_AGENT", ""))
+                    metrics.count_decision("catch_all", kind)
+                    if kind != catchall.NAVIGATION:
+                        return self._network_auth_required(
+                            method, start_response, started)
+                if method in ("GET", "HEAD"):
+                    cached = response_cache.connected_matching(
+                        environ.get("HTTP_IF_NONE_MATCH", ""))
+                    if cached is not None:
+                        metrics.count_not_modified("default_view",
+                                                   len(cached.body))
+                        return self._respond("default_view", 304, cached,
+                                             method, start_response, started)
+            return self.wsgi_app(environ, start_response)
+
+        status, cached = answer
+        return self._respond(ENDPOINTS[path], status, cached, method,
+                             start_response, started)
+
+    @staticmethod
+    def _respond(endpoint, status, cached, method, start_response, started):
+        if cached is None:
+            start_response(_STATUS_LINES[status], _NO_CONTENT_HEADERS)
+            body = b""
+        elif status == 304:
+            start_response(_STATUS_LINES[status],
+                           list(cached.not_modified_wsgi_headers))
+            body = b""
+        else:
+            start_response(_STATUS_LINES[status], list(cached.wsgi_headers))
+            body = b"" if method == "HEAD" else cached.body
+        metrics.observe_request(endpoint, status,
+                                time.perf_counter() - started)
+        return [body]
+
+    @staticmethod
+    def _shed(wait, start_response, started):
+        start_response(_SHED_STATUS_LINE, [
+            ("Retry-After", catch_all_limiter.retry_after(wait)),
+            ("Cache-Control", "no-store"),
+            ("Content-Length", "0"),
+        ])
+        metrics.observe_request("default_view", 503,
+                                time.perf_counter() - started)
+        return [b""]
+
+    @staticmethod
+    def _network_auth_required(method, start_response, started):
+        start_response(catchall.NETWORK_AUTH_REQUIRED_STATUS,
+                       list(catchall.NETWORK_AUTH_REQUIRED_HEADERS))
+        metrics.observe_request("default_view", 511,
+                                time.perf_counter() - started)
+        if method == "HEAD":
+            return [b""]
+        return [catchall.NETWORK_AUTH_REQUIRED_BODY]
@@ -0,0 +1,84 @@
+"""Per-client rate limiting of catch-all traffic.
+
+Every phone's background app traffic (update checks, push, analytics) hits
+the portal while it's in the way, and all of it ends up at the 404 handler.
+RateLimiter bounds how fast each client can do that. The probe endpoints are
+never limited.
+
+The limiter is the generic cell rate algorithm: each client has a single
+"theoretical arrival time", and a request is allowed if it's no more than
+the burst allowance ahead of now. That's one double per client, so the whole
+state is a flat array of them: clients are hashed into a fixed number of
+slots (clients that collide share a limit, so make slots a few times the
+number of clients; it's rounded up to a power of two). The array lives in
+an mmap: a file in /dev/shm to share it between every worker, or anonymous
+shared memory otherwise, which workers forked from a preloaded master also
+share. Updates from different workers can race and lose an update, which
+only makes the limit slightly more generous.
+"""
+import math
+import mmap
+import os
+
+_MASK_64 = 0xffffffffffffffff
+_FIBONACCI = 11400714819323198485
+
+
+class RateLimiter(object):
+    """Allows each client rate requests per second, in bursts of up to burst
+
+    A rate of 0 allows everything.
+    """
+
+    def __init__(self, rate, burst, slots=8192, path=None):
+        self._slot_bits = max(slots - 1, 1).bit_length()
+        self.slots = slots = 1 << self._slot_bits
+        size = slots * 8
+        if path is None:
+            self._mmap = mmap.mmap(-1, size)
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                if os.fstat(fd).st_size != size:
+                    os.ftruncate(fd, size)
+                self._mmap = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+        # Theoretical arrival time of each slot's next request
+        self._tat = memoryview(self._mmap).cast("d")
+        self.configure(rate, burst)
+
+    def configure(self, rate, burst):
+        self.rate = float(rate)
+        self._interval = 1.0 / rate if rate else 0.0
+        self._tolerance = self._interval * (max(burst, 1) - 1)
+
+    def _slot(self, key):
+        if key is None:
+            return 0
+        # IPv6 keys are 128 bits
+        folded = (key >> 64) ^ (key & _MASK_64)
+        # Fibonacci hashing spreads neighbouring addresses over the table,
+        #  but only in the product's high bits: its low bits depend only on
+        #  the key's low bits
+        return ((folded * _FIBONACCI) & _MASK_64) >> (64 - self._slot_bits)
+
+    def check(self, key, now):
+        """Return 0 if this request is allowed, else seconds to wait"""
+        if not self.rate:
+            return 0
+        slot = self._slot(key)
+        tat = max(self._tat[slot], now)
+        wait = tat - now - self._tolerance
+        if wait > 0:
+            return wait
+        self._tat[slot] = tat + self._interval
+        return 0
+
+    def retry_after(self, wait):
+        """Return the Retry-After header value for a wait in seconds"""
+        return str(max(1, int(math.ceil(wait))))
+
+    def close(self):
+        self._tat.release()
+        self._mmap.close()
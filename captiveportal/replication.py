@@ -0,0 +1,393 @@
+"""Session state replicated between ConnectBoxes on one network.
+
+Large venues run several ConnectBoxes on one network segment. A phone that
+roams from one to another reaches a portal that has never seen it, so the
+portal pops up again, and an Android device that had pressed OK loses its
+204 and falls back to cellular.
+
+ReplicatedSessionStore wraps another SessionStore, like the journal does.
+Every local change is merged into a pending batch in memory, and a
+background thread sends the batch to the peers over UDP once per flush
+interval, so the request path never waits on the network. Peers are
+"host:port" addresses, or a multicast group that every box listens on.
+Changes received from peers are applied to the wrapped store and aren't
+sent on again.
+
+Batches are delta encoded. Only the latest change of each kind per client
+since the last flush is sent, times are millisecond offsets from the
+batch's base time, and IPv4 keys take 4 bytes rather than 16. A batch that
+doesn't fit in one datagram is split over several.
+
+Conflicts are settled by last writer wins on wall clock time. A change is
+applied only if it's newer than what the store already has for the client:
+its last seen time, or the time of its last ack, ack clear or removal. The
+boxes' clocks need to agree to within a few seconds, which is far less than
+the session times involved. Delivery is best effort; a lost datagram is made
+up for by the client's next change, and every last seen time sent also
+says whether the client had pressed OK, so a lost ack heals itself on the
+client's next probe.
+
+Every datagram carries an HMAC-SHA256 tag keyed with a secret shared by
+the boxes (SESSION_REPLICATION_SECRET), and datagrams without a valid tag
+are dropped. Without it, any phone on the guest network could send an ack
+or a removal for any other client. Replaying a captured datagram only
+repeats changes that have since been overtaken, as last writer wins. Even
+so, listen on the boxes' management network where there is one.
+"""
+import collections
+import errno
+import hashlib
+import hmac
+import os
+import socket
+import struct
+import threading
+import time
+
+from captiveportal.sessions import SessionStore, pack_key, unpack_key
+
+_MAGIC = b"CPRS"
+_VERSION = 1
+# magic, version, sending node, base time, records
+_HEADER = struct.Struct("<4sB3x8sdH")
+# op and flags, milliseconds after the base time; then a 4 or 16 byte key
+_RECORD = struct.Struct("<BI")
+_IPV4_KEY = struct.Struct(">I")
+
+OP_TOUCH = 1
+OP_ACK = 2
+OP_CLEAR_ACK = 3
+OP_REMOVE = 4
+_OP_MASK = 0x0f
+# On OP_TOUCH: the client had pressed OK when it was last seen
+_FLAG_ACKED = 0x40
+_FLAG_IPV4_KEY = 0x80
+
+# Datagrams are kept under a typical MTU so they're never fragmented
+MAX_DATAGRAM_BYTES = 1400
+# Truncated HMAC-SHA256 at the end of every datagram
+_TAG_BYTES = 16
+_MAX_OFFSET_MS = 0xffffffff
+
+
+def parse_address(address):
+    """Return (host, port) for a "host:port" string"""
+    host, _, port = address.rpartition(":")
+    return host.strip("[]"), int(port)
+
+
+def _is_multicast(host):
+    try:
+        return 224 <= int(host.split(".")[0]) <= 239
+    except ValueError:
+        return False
+
+
+def _tag(secret, data):
+    return hmac.new(secret, data, hashlib.sha256).digest()[:_TAG_BYTES]
+
+
+def encode_batch(node_id, changes, secret):
+    """Return signed datagrams for a list of (op, flags, key, when) changes
+    """
+    datagrams = []
+    start = 0
+    while start < len(changes):
+        base = min(change[3] for change in changes[start:])
+        records = []
+        size = _HEADER.size + _TAG_BYTES
+        index = start
+        while index < len(changes):
+            op, flags, key, when = changes[index]
+            if key <= 0xffffffff:
+                packed = _IPV4_KEY.pack(key)
+                flags |= _FLAG_IPV4_KEY
+            else:
+                packed = pack_key(key)
+            offset = min(int((when - base) * 1000), _MAX_OFFSET_MS)
+            record = _RECORD.pack(op | flags, offset) + packed
+            if size + len(record) > MAX_DATAGRAM_BYTES:
+                break
+            records.append(record)
+            size += len(record)
+            index += 1
+        datagram = _HEADER.pack(_MAGIC, _VERSION, node_id, base,
+                                len(records)) + b"".join(records)
+        datagrams.append(datagram + _tag(secret, datagram))
+        start = index
+    return datagrams
+
+
+def decode_batch(data, secret):
+    """Return (node id, [(op, flags, key, when)]) for a datagram
+
+    Raises ValueError if it isn't one of ours, or isn't signed with secret.
+    """
+    if len(data) < _HEADER.size + _TAG_BYTES:
+        raise ValueError("Short datagram")
+    data, tag = data[:-_TAG_BYTES], data[-_TAG_BYTES:]
+    if not hmac.compare_digest(tag, _tag(secret, data)):
+        raise ValueError("Bad datagram signature")
+    magic, version, node_id, base, count = _HEADER.unpack_from(data)
+    if magic != _MAGIC or version != _VERSION:
+        raise ValueError("Not a session replication datagram")
+    changes = []
+    position = _HEADER.size
+    for _ in range(count):
+        op, offset = _RECORD.unpack_from(data, position)
+        position += _RECORD.size
+        if op & _FLAG_IPV4_KEY:
+            key = _IPV4_KEY.unpack_from(data, position)[0]
+            position += _IPV4_KEY.size
+        else:
+            key = unpack_key(data[position:position + 16])
+            position += 16
+        changes.append((op & _OP_MASK, op & _FLAG_ACKED, key,
+                        base + offset / 1000.0))
+    if position != len(data):
+        raise ValueError("Malformed datagram")
+    return node_id, changes
+
+
+class ReplicatedSessionStore(SessionStore):
+    """A SessionStore whose changes are sent to and received from peers"""
+
+    def __init__(self, store, peers, secret, listen=None, flush_interval=0.2):
+        if not secret:
+            raise ValueError("Session replication needs a shared secret")
+        self.store = store
+        if not isinstance(secret, bytes):
+            secret = secret.encode("utf-8")
+        self.secret = secret
+        self.peers = [parse_address(peer) for peer in peers]
+        self.listen = listen
+        self.flush_interval = flush_interval
+        self.node_id = os.urandom(8)
+        self._lock = threading.Lock()
+        # key -> [last seen time, ack op, ack op time] changed since the
+        #  last flush
+        self._pending = {}
+        # key -> (time, op) of the last ack, ack clear or removal, oldest
+        #  first and bounded like the store itself
+        self._stamps = collections.OrderedDict()
+        self._max_stamps = getattr(store, "capacity", 4096)
+        self._sender_pid = None
+        self._send_sock = None
+        self.sock = None
+        self.sent = 0
+        self.applied = 0
+        self.stale = 0
+
+    @property
+    def shared(self):
+        return self.store.shared
+
+    def _stamp(self, key, when, op):
+        self._stamps.pop(key, None)
+        self._stamps[key] = (when, op)
+        if len(self._stamps) > self._max_stamps:
+            self._stamps.popitem(last=False)
+
+    def _record(self, key, when, op=None):
+        """Queue a local change; op is None for a touch"""
+        with self._lock:
+            change = self._pending.get(key)
+            if change is None:
+                change = self._pending[key] = [0.0, None, 0.0]
+            if op is None:
+                change[0] = max(change[0], when)
+            else:
+                if op == OP_REMOVE:
+                    change[0] = 0.0
+                change[1] = op
+                change[2] = when
+                self._stamp(key, when, op)
+        # Threads don't survive a fork, so each worker starts its own sender
+        if self._sender_pid != os.getpid():
+            self._sender_pid = os.getpid()
+            sender = threading.Thread(target=self._run_sender,
+                                      name="session-replication-sender")
+            sender.daemon = True
+            sender.start()
+
+    def _run_sender(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """Send every change queued since the last flush to the peers"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        changes = []
+        for key, (last_seen, op, when) in pending.items():
+            # A touch still pending after a removal came after it (see
+            #  _record), as when decide_android starts a new session
+            if op is not None:
+                changes.append((op, 0, key, when))
+            if last_seen:
+                changes.append((OP_TOUCH, _FLAG_ACKED
+                                if self.store.is_acked(key) else 0,
+                                key, last_seen))
+        if not changes:
+            return
+        if self._send_sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            # Multicast stays on the local network segment
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+            self._send_sock = sock
+        for datagram in encode_batch(self.node_id, changes, self.secret):
+            for peer in self.peers:
+                try:
+                    self._send_sock.sendto(datagram, peer)
+                except OSError:
+                    # A peer that's down catches up from later changes
+                    continue
+        self.sent += len(changes)
+
+    def bind(self):
+        """Listen for peers' changes, returning False if another worker does
+        """
+        host, port = parse_address(self.listen)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            # Multicast groups are joined on the wildcard address
+            sock.bind(("" if _is_multicast(host) else host, port))
+        except OSError as error:
+            sock.close()
+            if error.errno != errno.EADDRINUSE:
+                raise
+            return False
+        if _is_multicast(host):
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                            socket.inet_aton(host) +
+                            socket.inet_aton("0.0.0.0"))
+        self.sock = sock
+        return True
+
+    def start(self):
+        """Start receiving peers' changes, unless another worker already is
+        """
+        if self.listen is None or not self.bind():
+            return False
+        receiver = threading.Thread(target=self.serve_forever,
+                                    name="session-replication-receiver")
+        receiver.daemon = True
+        receiver.start()
+        return True
+
+    def serve_forever(self):
+        sock = self.sock
+        while self.sock is sock:
+            try:
+                data, _ = sock.recvfrom(65536)
+            except OSError:
+                # Closed by close()
+                if self.sock is not sock:
+                    return
+                raise
+            self.receive(data)
+
+    def close(self):
+        """Stop receiving peers' changes"""
+        sock, self.sock = self.sock, None
+        if sock is not None:
+            try:
+                # Wakes the receiver thread up
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+    def receive(self, data):
+        """Merge one datagram of peer changes, returning how many applied"""
+        try:
+            node_id, changes = decode_batch(data, self.secret)
+        except (ValueError, struct.error):
+            return 0
+        # Our own multicast datagrams come back to us
+        if node_id == self.node_id:
+            return 0
+        applied = 0
+        with self._lock:
+            for op, flags, key, when in changes:
+                if self._merge(op, flags, key, when):
+                    applied += 1
+        self.applied += applied
+        self.stale += len(changes) - applied
+        return applied
+
+    def _merge(self, op, flags, key, when):
+        """Apply a peer's change if it's newer than ours, last writer wins"""
+        stamp_when, stamp_op = self._stamps.get(key, (0.0, None))
+        if op == OP_TOUCH:
+            # A touch made at the moment of a removal came after it
+            if stamp_op == OP_REMOVE and when < stamp_when:
+                return False
+            applied = False
+            if when > self.store.last_seen(key):
+                self.store.touch(key, when)
+                applied = True
+            # Only makes up for a lost ack, it never overrides a clear
+            if flags & _FLAG_ACKED and stamp_op in (None, OP_REMOVE) and \
+                    not self.store.is_acked(key):
+                self.store.set_acked(key, when)
+                self._stamp(key, when, OP_ACK)
+                applied = True
+            return applied
+        if when < stamp_when:
+            return False
+        if op == OP_ACK:
+            self.store.set_acked(key, when)
+        elif op == OP_CLEAR_ACK:
+            self.store.clear_ack(key, when)
+        elif op == OP_REMOVE:
+            if when < self.store.last_seen(key):
+                return False
+            self.store.remove(key, when)
+        else:
+            return False
+        self._stamp(key, when, op)
+        return True
+
+    def last_seen(self, key):
+        return self.store.last_seen(key)
+
+    def touch(self, key, when):
+        self.store.touch(key, when)
+        if key is not None:
+            self._record(key, when)
+
+    def is_acked(self, key):
+        return self.store.is_acked(key)
+
+    def set_acked(self, key, when=None):
+        when = time.time() if when is None else when
+        self.store.set_acked(key, when)
+        if key is not None:
+            self._record(key, when, OP_ACK)
+
+    def clear_ack(self, key, when=None):
+        when = time.time() if when is None else when
+        self.store.clear_ack(key, when)
+        if key is not None:
+            self._record(key, when, OP_CLEAR_ACK)
+
+    def remove(self, key, when=None):
+        when = time.time() if when is None else when
+        self.store.remove(key, when)
+        if key is not None:
+            self._record(key, when, OP_REMOVE)
+
+    def items(self):
+        return self.store.items()
+
+    def stats(self):
+        stats = dict(self.store.stats())
+        stats["replication_sent"] = self.sent
+        stats["replication_applied"] = self.applied
+        stats["replication_stale"] = self.stale
+        return stats
+
+    def __len__(self):
+        return len(self.store)
@@ -0,0 +1,250 @@
+"""Pre-rendered captive portal pages.
+
+Everything that goes into connected.html is either static config or one of
+a few enum values taken from the DeviceProfile (icon type x link type x
+OK button = 8 variants), and success.html and the RFC 8908 captive portal
+API document are fully static. Every variant is rendered once, on first
+use, and stored as bytes alongside a precomputed ETag and Content-Length so
+that probes are served without touching Jinja.
+
+The ETag is a strong validator over the body. A client that sends it back
+in If-None-Match is answered with a bodiless 304. For the welcome page that
+can be decided before the User-Agent is even looked at: the ETag names the
+variant the client already has, and connected_matching() finds it by ETag.
+The pages a probe URL gets depend on the User-Agent, so they're sent with
+Vary: User-Agent to keep caches from handing one device's variant to
+another.
+
+With INLINE_ASSETS, the browser icon animation is embedded in the welcome
+page as a data URI, so the captive portal browser gets everything it shows
+in a single response. Those browsers are slow and sometimes give up on
+sub-resources over a crowded radio link. The page is about a third bigger
+than the animation it embeds, but it's one round trip instead of two, and
+the encoding is done once when the cache is built.
+"""
+import base64
+import hashlib
+import itertools
+import json
+import os
+import threading
+
+from flask import Response, has_request_context, render_template, url_for
+
+from captiveportal import settings
+from captiveportal.useragent import LINK_OPS
+
+ICON_TYPES = ("safari", "chrome")
+
+
+def if_none_match_tags(value):
+    """Return the entity tags in an If-None-Match header value, quoted
+
+    If-None-Match uses the weak comparison, so W/ prefixes are dropped. The
+    tags are only ever compared to ours, which are quoted hex digests, so
+    splitting on commas is enough.
+    """
+    tags = []
+    for tag in value.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag:
+            tags.append(tag)
+    return tags
+
+
+def _raw_headers(headers):
+    """Return WSGI (name, value) headers as ASGI (name, value) bytes"""
+    return [(name.lower().encode("latin-1"), value.encode("latin-1"))
+            for name, value in headers]
+
+
+class CachedResponse(object):
+    """A fully rendered response body and its precomputed headers"""
+
+    __slots__ = ("body", "etag", "content_length", "mimetype", "vary",
+                 "wsgi_headers", "raw_headers", "not_modified_wsgi_headers",
+                 "not_modified_raw_headers")
+
+    def __init__(self, body, mimetype="text/html", vary=None):
+        self.body = body
+        self.etag = '"%s"' % (hashlib.sha1(body).hexdigest(),)
+        self.content_length = str(len(body))
+        self.mimetype = mimetype
+        # The request headers that chose this body, if any
+        self.vary = vary
+        if mimetype.startswith("text/"):
+            content_type = mimetype + "; charset=utf-8"
+        else:
+            content_type = mimetype
+        # Headers for responses that bypass Flask, as WSGI (name, value)
+        #  strings and as ASGI (name, value) bytes
+        # A 304 carries only the validator, and Vary as a 200 would
+        self.not_modified_wsgi_headers = (("ETag", self.etag),)
+        if vary is not None:
+            self.not_modified_wsgi_headers += (("Vary", vary),)
+        self.wsgi_headers = (
+            ("Content-Type", content_type),
+            ("Content-Length", self.content_length),
+        ) + self.not_modified_wsgi_headers
+        self.raw_headers = _raw_headers(self.wsgi_headers)
+        self.not_modified_raw_headers = \
+            _raw_headers(self.not_modified_wsgi_headers)
+
+    def matches(self, if_none_match):
+        """Return True if an If-None-Match header value names this body"""
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        return self.etag in if_none_match_tags(if_none_match)
+
+    def to_response(self):
+        """Return a new flask Response carrying the cached body"""
+        headers = {
+            "ETag": self.etag,
+            "Content-Length": self.content_length,
+        }
+        if self.vary is not None:
+            headers["Vary"] = self.vary
+        return Response(self.body, mimetype=self.mimetype, headers=headers)
+
+    def to_not_modified_response(self):
+        """Return a new flask 304 Response for this body"""
+        return Response(status=304,
+                        headers=list(self.not_modified_wsgi_headers))
+
+
+class ResponseCache(object):
+    """Renders every variant of the portal pages once and serves them as bytes
+
+    The cache is filled on first use. It's built in the current request
+    context if there is one, so that url_for builds static URLs with the
+    right script root, and in a synthetic one otherwise. It's rebuilt when
+    the settings are reloaded, and in debug mode whenever the templates it
+    depends on change.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._lock = threading.Lock()
+        # (generation, connected variants, success page, captive portal API,
+        #  connected variants by ETag), swapped atomically
+        self._pages = None
+
+    def _current_generation(self):
+        """Return a value that changes whenever the cached pages would"""
+        generation = (
+            settings.current.CONNECTBOX_URL,
+            settings.current.CONNECTBOX_HOSTNAME,
+            settings.current.INLINE_ASSETS,
+        )
+        if self.app.debug:
+            template_dir = os.path.join(self.app.root_path,
+                                        self.app.template_folder)
+            generation += tuple(
+                os.path.getmtime(os.path.join(template_dir, template))
+                for template in ("connected.html", "success.html")
+            )
+        return generation
+
+    def invalidate(self):
+        """Drop every rendered page so the next request re-renders them"""
+        self._pages = None
+
+    def _build(self, generation):
+        if not has_request_context():
+            with self.app.test_request_context():
+                return self._build(generation)
+
+        connectbox_url, connectbox_hostname, inline_assets = generation[:3]
+        browser_icons = {}
+        for icon_type in ICON_TYPES:
+            filename = 'go-animation-%s.gif' % (icon_type,)
+            if inline_assets:
+                browser_icons[icon_type] = \
+                    self._data_uri(filename, "image/gif")
+            else:
+                browser_icons[icon_type] = \
+                    url_for('static', filename=filename)
+        connected = {}
+        for icon_type, link_type, show_ok in itertools.product(
+                ICON_TYPES, LINK_OPS.values(), (True, False)):
+            browser_icon = browser_icons[icon_type]
+            body = render_template(
+                "connected.html",
+                connectbox_url=connectbox_url,
+                connectbox_hostname=connectbox_hostname,
+                LINK_OPS=LINK_OPS,
+                browser_icon=browser_icon,
+                link_type=link_type,
+                show_ok=show_ok,
+            )
+            connected[(icon_type, link_type, show_ok)] = \
+                CachedResponse(body.encode("utf-8"), vary="User-Agent")
+        # Probe URLs give success.html to some agents and not others
+        success = CachedResponse(
+            render_template("success.html").encode("utf-8"),
+            vary="User-Agent")
+        captive_portal_api = CachedResponse(
+            json.dumps({
+                "captive": True,
+                "user-portal-url": connectbox_url,
+            }).encode("utf-8"),
+            mimetype="application/json",
+        )
+        connected_by_etag = dict((page.etag, page)
+                                 for page in connected.values())
+        return (generation, connected, success, captive_portal_api,
+                connected_by_etag)
+
+    def _data_uri(self, filename, mimetype):
+        """Return a static file's content as a data: URI"""
+        with open(os.path.join(self.app.static_folder, filename),
+                  "rb") as static_file:
+            data = static_file.read()
+        return "data:%s;base64,%s" % (
+            mimetype, base64.b64encode(data).decode("ascii"))
+
+    def _get_pages(self):
+        pages = self._pages
+        # Outside debug mode the config and templates are fixed once the
+        #  cache has been built, so skip the generation check entirely
+        if pages is not None and not self.app.debug:
+            return pages
+        generation = self._current_generation()
+        if pages is not None and pages[0] == generation:
+            return pages
+        with self._lock:
+            pages = self._pages
+            if pages is None or pages[0] != generation:
+                pages = self._build(generation)
+                self._pages = pages
+        return pages
+
+    def connected(self, profile):
+        """Return the welcome page variant for this DeviceProfile"""
+        return self._get_pages()[1][
+            (profile.icon_type, profile.link_type, profile.show_ok)]
+
+    def connected_matching(self, if_none_match):
+        """Return the welcome page variant an If-None-Match header value
+        names, or None
+        """
+        if not if_none_match:
+            return None
+        by_etag = self._get_pages()[4]
+        for tag in if_none_match_tags(if_none_match):
+            page = by_etag.get(tag)
+            if page is not None:
+                return page
+        return None
+
+    def success(self):
+        """Return the static success.html page"""
+        return self._get_pages()[2]
+
+    def captive_portal_api(self):
+        """Return the RFC 8908 captive portal API JSON document"""
+        return self._get_pages()[3]
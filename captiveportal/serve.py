@@ -0,0 +1,142 @@
+"""Serve the portal to nginx over a Unix domain socket.
+
+On the low power boards the portal ships on, a loopback TCP connection per
+probe is a measurable cost. Binding gunicorn to a Unix socket and letting
+nginx keep its upstream connections open avoids both the TCP stack and the
+connection setup:
+
+    python -m captiveportal.serve --bind unix:/run/captiveportal.sock
+
+with an nginx upstream that keeps connections alive and forwards the client
+address, which ProxyFix (see captiveportal/__init__.py) turns back into
+request.remote_addr. Without X-Forwarded-For every client would appear to be
+the socket, and share a single portal session:
+
+    upstream captiveportal {
+        server unix:/run/captiveportal.sock;
+        keepalive 16;
+    }
+    location / {
+        proxy_pass http://captiveportal;
+        proxy_http_version 1.1;
+        proxy_set_header Connection "";
+        proxy_set_header Host $host;
+        proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
+    }
+
+gunicorn's sync workers close the connection after every response, so the
+threaded worker is used to get keep-alive.
+
+With SERVE_PRELOAD (the default), the master also pre-renders the pages and
+freezes its heap before forking (see captiveportal.preload), so the workers
+share that memory. Either way, each worker reloads the session journal (see
+captiveportal.journal) and starts its own DHCP feeds and settings watcher
+once it has forked.
+
+SIGHUP to the master reloads the settings there and passes the signal on to
+the workers, which reload theirs too. Unlike gunicorn's usual SIGHUP, the
+workers aren't replaced, so the sessions they hold in memory are kept.
+gunicorn's own settings (bind, workers and so on) only change on restart.
+"""
+import argparse
+import signal
+import sys
+
+from gunicorn.app.base import BaseApplication
+from gunicorn.arbiter import Arbiter
+
+from captiveportal import app, preload, settings
+from captiveportal.views import reload_session_journal, \
+    start_background_tasks
+
+
+class PortalApplication(BaseApplication):
+    """gunicorn application serving the portal with the given settings"""
+
+    def __init__(self, application, options):
+        self.application = application
+        self.options = options
+        super(PortalApplication, self).__init__()
+
+    def load_config(self):
+        for name, value in self.options.items():
+            self.cfg.set(name, value)
+
+    def load(self):
+        return self.application
+
+    def run(self):
+        # As BaseApplication.run(), with the portal's arbiter
+        try:
+            PortalArbiter(self).run()
+        except RuntimeError as error:
+            sys.exit("\nError: %s\n" % (error,))
+
+
+class PortalArbiter(Arbiter):
+    """gunicorn's master, reloading the portal's settings on SIGHUP"""
+
+    def handle_hup(self):
+        self.log.info("Hang up: reloading the settings")
+        settings.reload()
+        if self.cfg.preload_app:
+            preload.warm()
+            preload.freeze()
+        for pid in list(self.WORKERS):
+            self.kill_worker(pid, signal.SIGHUP)
+
+
+def _post_fork(server, worker):
+    # pylint: disable=unused-argument
+    # The master's sessions are as old as the master
+    reload_session_journal()
+    start_background_tasks()
+
+
+def _post_worker_init(worker):
+    # pylint: disable=unused-argument
+    # The worker has just reset its signal handlers, in its main thread
+    settings.install_sighup_handler()
+
+
+def gunicorn_options(config, bind=None, workers=None, preload_app=None):
+    """Return the gunicorn settings for the SERVE_* values in config"""
+    if preload_app is None:
+        preload_app = config["SERVE_PRELOAD"]
+    return {
+        "bind": bind or config["SERVE_BIND"],
+        "workers": workers or config["SERVE_WORKERS"],
+        "worker_class": "gthread",
+        "threads": config["SERVE_THREADS"],
+        "keepalive": config["SERVE_KEEPALIVE_SECS"],
+        "preload_app": preload_app,
+        "post_fork": _post_fork,
+        "post_worker_init": _post_worker_init,
+        # Let nginx and the dnsmasq script connect to the socket
+        "umask": 0o007,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the captive portal")
+    parser.add_argument("--bind", action="append",
+                        help="unix:PATH or HOST:PORT, may be repeated "
+                             "(default: SERVE_BIND)")
+    parser.add_argument("--workers", type=int,
+                        help="worker processes (default: SERVE_WORKERS)")
+    parser.add_argument("--preload", dest="preload", action="store_true",
+                        default=None, help="build everything before forking "
+                                           "the workers (default: "
+                                           "SERVE_PRELOAD)")
+    parser.add_argument("--no-preload", dest="preload", action="store_false")
+    args = parser.parse_args()
+    options = gunicorn_options(app.config, args.bind, args.workers,
+                               args.preload)
+    if options["preload_app"]:
+        preload.warm()
+        preload.freeze()
+    PortalApplication(app, options).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,705 @@
+"""Client session state: when each client was last seen and whether it has
+pressed OK on the captive portal page.
+
+The views only talk to the SessionStore interface. Two backends ship with
+the portal:
+
+- MemorySessionStore keeps everything in process-local memory. It's the
+  default and is fine for the development server or a single worker.
+- MmapSessionStore keeps a fixed-size hash table in a memory-mapped file
+  (on /dev/shm by default) so that every gunicorn worker on the box sees
+  the same state. Without it, an Android device whose OK-press POST lands
+  on one worker and whose next /generate_204 lands on another never gets
+  its 204 and falls back to cellular.
+
+Both backends hold at most `capacity` clients and forget clients that
+haven't been seen for `ttl` seconds. Expired entries are evicted a few at a
+time whenever a client is added or removed, so there is never a sweep over
+the whole table on the request path.
+"""
+import fcntl
+import ipaddress
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from array import array
+
+# Number of entries examined for expiry each time a client is added
+EVICTION_BATCH_SIZE = 8
+
+_IPV4_MAPPED_PREFIX = 0xffff << 32
+
+
+def client_key(client_ip):
+    """Return the packed integer session key for an IP address
+
+    IPv4 addresses become 32-bit integers and IPv6 addresses 128-bit ones.
+    IPv4-mapped IPv6 addresses (as reported by dual-stack sockets) are
+    normalised to their IPv4 key, so every code path agrees on the key for
+    a client however its address was written. Returns None if client_ip
+    isn't an IP address.
+    """
+    try:
+        address = ipaddress.ip_address(client_ip)
+    except ValueError:
+        return None
+    key = int(address)
+    if address.version == 6 and key >> 32 == 0xffff:
+        return key & 0xffffffff
+    return key
+
+
+class SessionStore(object):
+    """Interface implemented by all session store backends
+
+    Clients are identified by the integer keys returned by client_key().
+    Stores treat a key of None as a client they know nothing about. The
+    optional when passed with a change is the time the caller made it, which
+    orders it against the same client's other changes when they're sent to
+    other ConnectBoxes (see captiveportal.replication); it defaults to now.
+    """
+
+    # True if every worker process sees the same state
+    shared = False
+
+    def last_seen(self, key):
+        """Return when the client was last seen, or 0 if it's unknown"""
+        raise NotImplementedError
+
+    def touch(self, key, when):
+        """Record that the client was seen at time when"""
+        raise NotImplementedError
+
+    def is_acked(self, key):
+        """Has the client pressed OK on the captive portal page?"""
+        raise NotImplementedError
+
+    def set_acked(self, key, when=None):
+        """Record that the client has pressed OK on the captive portal page"""
+        raise NotImplementedError
+
+    def clear_ack(self, key, when=None):
+        """Forget that the client has pressed OK, keeping its last seen time"""
+        raise NotImplementedError
+
+    def remove(self, key, when=None):
+        """Forget everything about the client"""
+        raise NotImplementedError
+
+    def items(self):
+        """Return a list of (key, last seen time, acked) for every client"""
+        raise NotImplementedError
+
+    def stats(self):
+        """Return a dict of the store's size and eviction counters"""
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+
+class MemorySessionStore(SessionStore):
+    """Session state held in process-local memory
+
+    Clients live in slots of parallel compact arrays (a struct of arrays)
+    rather than in dicts of boxed floats and bools; a single dict maps each
+    key to its slot. The slots form a doubly linked list in last seen order,
+    so the oldest entries are always at the head and expiring them is O(1)
+    per entry. Only touch() moves a slot; acks are updated in place.
+
+    Every public method holds a lock: the list and the dict are updated
+    together by several threads at once (threaded workers, the DHCP feeds,
+    the replication receiver), and a method interleaved with another part
+    way through would leave them out of step.
+    """
+
+    def __init__(self, capacity=4096, ttl=86400):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.expired = 0
+        self.evicted = 0
+        self._slots = {}
+        self._keys = []
+        self._last_seen = array("d")
+        self._acked = bytearray()
+        self._prev = array("l")
+        self._next = array("l")
+        self._head = -1
+        self._tail = -1
+        self._free = []
+
+    def _unlink(self, slot):
+        prev_slot, next_slot = self._prev[slot], self._next[slot]
+        if prev_slot == -1:
+            self._head = next_slot
+        else:
+            self._next[prev_slot] = next_slot
+        if next_slot == -1:
+            self._tail = prev_slot
+        else:
+            self._prev[next_slot] = prev_slot
+
+    def _link_after(self, slot, prev_slot):
+        """Link slot in after prev_slot, or at the head if that's -1"""
+        next_slot = self._head if prev_slot == -1 else self._next[prev_slot]
+        self._prev[slot] = prev_slot
+        self._next[slot] = next_slot
+        if prev_slot == -1:
+            self._head = slot
+        else:
+            self._next[prev_slot] = slot
+        if next_slot == -1:
+            self._tail = slot
+        else:
+            self._prev[next_slot] = slot
+
+    def _link_in_order(self, slot):
+        # Usually at the tail, but a peer's touch can carry an older time
+        when = self._last_seen[slot]
+        prev_slot = self._tail
+        while prev_slot != -1 and self._last_seen[prev_slot] > when:
+            prev_slot = self._prev[prev_slot]
+        self._link_after(slot, prev_slot)
+
+    def _release(self, slot):
+        self._unlink(slot)
+        del self._slots[self._keys[slot]]
+        self._keys[slot] = None
+        self._free.append(slot)
+
+    def _evict(self, now):
+        """Expire a few of the oldest entries and make room for a new one"""
+        cutoff = now - self.ttl
+        for _ in range(EVICTION_BATCH_SIZE):
+            if self._head == -1 or self._last_seen[self._head] >= cutoff:
+                break
+            self._release(self._head)
+            self.expired += 1
+        while self._slots and len(self._slots) >= self.capacity:
+            self._release(self._head)
+            self.evicted += 1
+
+    def _slot(self, key, now):
+        """Return the slot for key, allocating one if necessary
+
+        A new slot has never been seen, so it's linked at the head.
+        """
+        slot = self._slots.get(key)
+        if slot is not None:
+            return slot
+        self._evict(now)
+        if self._free:
+            slot = self._free.pop()
+            self._keys[slot] = key
+            self._last_seen[slot] = 0
+            self._acked[slot] = 0
+        else:
+            slot = len(self._keys)
+            self._keys.append(key)
+            self._last_seen.append(0)
+            self._acked.append(0)
+            self._prev.append(-1)
+            self._next.append(-1)
+        self._slots[key] = slot
+        self._link_after(slot, -1)
+        return slot
+
+    def last_seen(self, key):
+        with self._lock:
+            slot = self._slots.get(key)
+            return self._last_seen[slot] if slot is not None else 0
+
+    def touch(self, key, when):
+        if key is not None:
+            with self._lock:
+                slot = self._slot(key, when)
+                self._unlink(slot)
+                self._last_seen[slot] = when
+                self._link_in_order(slot)
+
+    def is_acked(self, key):
+        with self._lock:
+            slot = self._slots.get(key)
+            return slot is not None and self._acked[slot] == 1
+
+    def set_acked(self, key, when=None):
+        if key is not None:
+            with self._lock:
+                self._acked[self._slot(
+                    key, time.time() if when is None else when)] = 1
+
+    def clear_ack(self, key, when=None):
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is not None:
+                self._acked[slot] = 0
+
+    def remove(self, key, when=None):
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is not None:
+                self._release(slot)
+
+    def items(self):
+        with self._lock:
+            return [(key, self._last_seen[slot], self._acked[slot] == 1)
+                    for key, slot in self._slots.items()]
+
+    def stats(self):
+        return {
+            "size": len(self._slots),
+            "capacity": self.capacity,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
+
+    def __len__(self):
+        return len(self._slots)
+
+
+# magic, slots, capacity, used, tombstones, sweep cursor, moves, expired,
+#  evicted. Tables written by older versions have 0 for moves
+_HEADER = struct.Struct("<8sIIIIIIQQ")
+# Odd while entries are being moved to close a gap (see _fill_hole)
+_MOVES = struct.Struct("<I")
+_MOVES_OFFSET = 28
+_HEADER_SIZE = 64
+_MAGIC = b"CPSESS02"
+# seq, flags, key (IPv6 or IPv4-mapped address), last seen time
+_RECORD = struct.Struct("<IB3x16sd")
+_SEQ = struct.Struct("<I")
+_MAX_READ_RETRIES = 1000
+
+_FLAG_USED = 0x01
+_FLAG_TOMBSTONE = 0x02
+_FLAG_ACKED = 0x04
+
+_EMPTY_KEY = b"\0" * 16
+
+
+def pack_key(key):
+    """Return the 16 byte form of a client_key(), or None
+
+    IPv4 keys are packed as IPv4-mapped IPv6 addresses so every packed key is
+    the same size.
+    """
+    if key is None:
+        return None
+    if key <= 0xffffffff:
+        key |= _IPV4_MAPPED_PREFIX
+    return key.to_bytes(16, "big")
+
+
+def unpack_key(packed):
+    """Return the client_key() for a key packed by pack_key()"""
+    key = int.from_bytes(packed, "big")
+    if key >> 32 == 0xffff:
+        return key & 0xffffffff
+    return key
+
+
+class MmapSessionStore(SessionStore):
+    """Session state in an open-addressed hash table in a shared mmap
+
+    Every record is a fixed 32 bytes and the table has a third more slots
+    than its capacity so that probe chains stay short. Reads are lock-free:
+    each record carries a sequence number that writers make odd while they
+    update it (a seqlock), and readers retry until they see the same even
+    number before and after reading. Writers to an existing record lock only
+    that record's byte range with fcntl; inserting or removing a packed takes a
+    lock on the table header so that two workers can't claim the same slot.
+    Record locks are per process, so a thread lock serialises writers
+    within a worker as well.
+
+    Removing an entry leaves no tombstone: the entries after it in its probe
+    chain that belong before the gap are moved back into it (backward shift
+    deletion), so lookups of unknown clients stay short however much the
+    clients churn. Moves are bracketed by a table-wide moves counter, odd
+    while they're in progress, and a lookup that misses retries if the
+    counter changed meanwhile, as an entry may have been moved past it.
+    Tables left with tombstones by older versions are cleaned up by the
+    expiry sweep.
+
+    The header also holds the entry counts, the position of the incremental
+    expiry sweep and the eviction counters, so they're shared by all workers.
+    """
+
+    shared = True
+
+    def __init__(self, path, capacity=4096, ttl=86400):
+        self.path = path
+        self.ttl = ttl
+        self._thread_lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, _HEADER_SIZE, 0)
+        try:
+            size = os.fstat(self._fd).st_size
+            if size < _HEADER_SIZE:
+                slots = capacity + capacity // 3 + 1
+                os.ftruncate(self._fd, _HEADER_SIZE + slots * _RECORD.size)
+                os.pwrite(self._fd, _HEADER.pack(
+                    _MAGIC, slots, capacity, 0, 0, 0, 0, 0, 0), 0)
+            else:
+                header = _HEADER.unpack(os.pread(self._fd, _HEADER.size, 0))
+                if header[0] != _MAGIC:
+                    raise ValueError("%s is not a session store" % (path,))
+                slots, capacity = header[1:3]
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, _HEADER_SIZE, 0)
+        self.slots = slots
+        self.capacity = capacity
+        self._mm = mmap.mmap(self._fd, _HEADER_SIZE + slots * _RECORD.size)
+
+    def close(self):
+        self._mm.close()
+        os.close(self._fd)
+
+    def _offset(self, slot):
+        return _HEADER_SIZE + slot * _RECORD.size
+
+    def _read(self, slot):
+        """Return a consistent (seq, flags, packed key, last_seen) for slot"""
+        offset = self._offset(slot)
+        for _ in range(_MAX_READ_RETRIES):
+            seq = _SEQ.unpack_from(self._mm, offset)[0]
+            if seq & 1:
+                continue
+            record = _RECORD.unpack_from(self._mm, offset)
+            # A writer that started after the first read has changed the
+            #  sequence number by now, even if the copy began before it did
+            if _SEQ.unpack_from(self._mm, offset)[0] == seq:
+                return record
+        # A worker that was killed part way through a write leaves the
+        #  sequence number odd forever, so don't spin on it indefinitely
+        return _RECORD.unpack_from(self._mm, offset)
+
+    def _write(self, slot, flags, packed, last_seen):
+        """Update slot. The caller must hold the lock covering it"""
+        offset = self._offset(slot)
+        seq = _SEQ.unpack_from(self._mm, offset)[0]
+        _SEQ.pack_into(self._mm, offset, seq + 1)
+        _RECORD.pack_into(self._mm, offset, seq + 1, flags, packed,
+                          last_seen)
+        _SEQ.pack_into(self._mm, offset, (seq + 2) & 0xffffffff)
+
+    def _home(self, packed):
+        return zlib.crc32(packed) % self.slots
+
+    def _probe(self, packed):
+        """Yield the slots to examine for a packed key, in order"""
+        start = self._home(packed)
+        for i in range(self.slots):
+            yield (start + i) % self.slots
+
+    def _moves(self):
+        return _MOVES.unpack_from(self._mm, _MOVES_OFFSET)[0]
+
+    def _search(self, packed):
+        for slot in self._probe(packed):
+            record = self._read(slot)
+            flags = record[1]
+            if not flags & (_FLAG_USED | _FLAG_TOMBSTONE):
+                break
+            if flags & _FLAG_USED and record[2] == packed:
+                return slot, record
+        return None, None
+
+    def _find(self, packed):
+        """Return (slot, record) for a packed key, or (None, None)"""
+        for _ in range(_MAX_READ_RETRIES):
+            moves = self._moves()
+            slot, record = self._search(packed)
+            # A hit is always real, but a miss may be an entry that was moved
+            #  from ahead of the search to behind it
+            if slot is not None or \
+                    (not moves & 1 and self._moves() == moves):
+                return slot, record
+        return None, None
+
+    def _lock_record(self, slot):
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, _RECORD.size, self._offset(slot))
+
+    def _unlock_record(self, slot):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, _RECORD.size, self._offset(slot))
+
+    def _write_locked(self, slot, flags, packed, last_seen):
+        """Update slot while holding the table lock"""
+        self._lock_record(slot)
+        try:
+            self._write(slot, flags, packed, last_seen)
+        finally:
+            self._unlock_record(slot)
+
+    def _lock_table(self):
+        self._thread_lock.acquire()
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, _HEADER_SIZE, 0)
+
+    def _unlock_table(self):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, _HEADER_SIZE, 0)
+        self._thread_lock.release()
+
+    def _header(self):
+        """Return [used, tombstones, cursor, expired, evicted]"""
+        header = _HEADER.unpack_from(self._mm, 0)
+        return list(header[3:6] + header[7:])
+
+    def _set_header(self, counters):
+        """Store counters from _header(). The table lock must be held"""
+        _HEADER.pack_into(self._mm, 0, _MAGIC, self.slots, self.capacity,
+                          counters[0], counters[1], counters[2],
+                          self._moves(), counters[3], counters[4])
+
+    def _set_moves(self, moves):
+        _MOVES.pack_into(self._mm, _MOVES_OFFSET, moves & 0xffffffff)
+
+    def _fill_hole(self, hole):
+        """Empty slot hole, moving later entries of its chain back into it
+
+        An entry is moved back unless its home slot lies after the hole, so
+        that every entry stays reachable from its home without passing an
+        empty slot. The table lock must be held.
+        """
+        moves = self._moves()
+        self._set_moves(moves | 1)
+        try:
+            self._write_locked(hole, 0, _EMPTY_KEY, 0.0)
+            slot = hole
+            for _ in range(self.slots - 1):
+                slot = (slot + 1) % self.slots
+                flags, packed = self._read(slot)[1:3]
+                if not flags & (_FLAG_USED | _FLAG_TOMBSTONE):
+                    break
+                if not flags & _FLAG_USED:
+                    continue
+                home = self._home(packed)
+                # Stays put if home is in (hole, slot], going round the table
+                if hole < slot:
+                    stays = hole < home <= slot
+                else:
+                    stays = home > hole or home <= slot
+                if stays:
+                    continue
+                # Locked so that an update in progress isn't lost: once it's
+                #  let in, it finds the key gone and looks it up again
+                self._lock_record(slot)
+                try:
+                    _, flags, packed, last_seen = self._read(slot)
+                    self._write_locked(hole, flags, packed, last_seen)
+                    self._write(slot, 0, _EMPTY_KEY, 0.0)
+                finally:
+                    self._unlock_record(slot)
+                hole = slot
+        finally:
+            self._set_moves((moves | 1) + 1)
+
+    def _free_slot(self, slot, counters):
+        """Remove a used slot's entry. The table lock must be held"""
+        self._fill_hole(slot)
+        counters[0] -= 1
+
+    def _sweep(self, now, counters):
+        """Expire a few entries starting from the shared sweep cursor
+
+        Also clears any tombstones left by older versions. The table lock
+        must be held.
+        """
+        cutoff = now - self.ttl
+        cursor = counters[2]
+        for _ in range(EVICTION_BATCH_SIZE):
+            flags, last_seen = self._read(cursor)[1:4:2]
+            if flags & _FLAG_USED and last_seen < cutoff:
+                self._free_slot(cursor, counters)
+                counters[3] += 1
+            elif flags & _FLAG_TOMBSTONE:
+                self._fill_hole(cursor)
+                counters[1] -= 1
+            else:
+                cursor = (cursor + 1) % self.slots
+                continue
+            # An entry may have been moved into the slot; look at it again
+            #  unless it stayed empty
+            if not self._read(cursor)[1] & _FLAG_USED:
+                cursor = (cursor + 1) % self.slots
+        counters[2] = cursor
+
+    def _evict_oldest(self, counters):
+        """Evict the oldest of the next few entries after the sweep cursor
+
+        This is a sampled approximation of LRU eviction, used when the table
+        is at capacity. The table lock must be held.
+        """
+        oldest_slot = None
+        oldest_seen = None
+        sampled = 0
+        cursor = counters[2]
+        for _ in range(self.slots):
+            flags, last_seen = self._read(cursor)[1:4:2]
+            if flags & _FLAG_USED:
+                if oldest_seen is None or last_seen < oldest_seen:
+                    oldest_slot, oldest_seen = cursor, last_seen
+                sampled += 1
+                if sampled == EVICTION_BATCH_SIZE:
+                    break
+            cursor = (cursor + 1) % self.slots
+        if oldest_slot is not None:
+            self._free_slot(oldest_slot, counters)
+            counters[4] += 1
+
+    def _update(self, key, update, create):
+        """Apply update(flags, last_seen) -> (flags, last_seen) to key
+
+        If key isn't in the table, it's inserted when create is True
+        """
+        packed = pack_key(key)
+        if packed is None:
+            return
+        slot = self._find(packed)[0]
+        if slot is not None:
+            with self._thread_lock:
+                self._lock_record(slot)
+                try:
+                    # Re-read under the lock in case it was removed meanwhile
+                    _, flags, current_key, last_seen = self._read(slot)
+                    if flags & _FLAG_USED and current_key == packed:
+                        flags, last_seen = update(flags, last_seen)
+                        self._write(slot, flags, packed, last_seen)
+                        return
+                finally:
+                    self._unlock_record(slot)
+        if not create:
+            return
+
+        self._lock_table()
+        try:
+            counters = self._header()
+            self._sweep(time.time(), counters)
+            if counters[0] >= self.capacity:
+                self._evict_oldest(counters)
+            free_slot = None
+            existing_slot = None
+            for slot in self._probe(packed):
+                flags, current_key = self._read(slot)[1:3]
+                if flags & _FLAG_USED:
+                    if current_key == packed:
+                        existing_slot = slot
+                        break
+                    continue
+                if free_slot is None:
+                    free_slot = slot
+                if not flags & _FLAG_TOMBSTONE:
+                    break
+            if existing_slot is not None:
+                _, flags, _, last_seen = self._read(existing_slot)
+                flags, last_seen = update(flags, last_seen)
+                self._write_locked(existing_slot, flags, packed, last_seen)
+            elif free_slot is not None:
+                if self._read(free_slot)[1] & _FLAG_TOMBSTONE:
+                    counters[1] -= 1
+                flags, last_seen = update(_FLAG_USED, 0.0)
+                self._write_locked(free_slot, flags, packed, last_seen)
+                counters[0] += 1
+            self._set_header(counters)
+        finally:
+            self._unlock_table()
+
+    def last_seen(self, key):
+        packed = pack_key(key)
+        if packed is None:
+            return 0
+        record = self._find(packed)[1]
+        return record[3] if record is not None else 0
+
+    def touch(self, key, when):
+        self._update(key, lambda flags, _: (flags, when), create=True)
+
+    def is_acked(self, key):
+        packed = pack_key(key)
+        if packed is None:
+            return False
+        record = self._find(packed)[1]
+        return record is not None and bool(record[1] & _FLAG_ACKED)
+
+    def set_acked(self, key, when=None):
+        self._update(key,
+                     lambda flags, last_seen: (flags | _FLAG_ACKED, last_seen),
+                     create=True)
+
+    def clear_ack(self, key, when=None):
+        self._update(key,
+                     lambda flags, last_seen: (flags & ~_FLAG_ACKED, last_seen),
+                     create=False)
+
+    def remove(self, key, when=None):
+        packed = pack_key(key)
+        if packed is None:
+            return
+        self._lock_table()
+        try:
+            counters = self._header()
+            slot = self._find(packed)[0]
+            if slot is not None:
+                self._free_slot(slot, counters)
+            self._sweep(time.time(), counters)
+            self._set_header(counters)
+        finally:
+            self._unlock_table()
+
+    def items(self):
+        for _ in range(_MAX_READ_RETRIES):
+            moves = self._moves()
+            items = []
+            for slot in range(self.slots):
+                _, flags, packed, last_seen = self._read(slot)
+                if flags & _FLAG_USED:
+                    items.append((unpack_key(packed), last_seen,
+                                  bool(flags & _FLAG_ACKED)))
+            # A moved entry may have been missed or listed twice
+            if not moves & 1 and self._moves() == moves:
+                break
+        return items
+
+    def stats(self):
+        used, _, _, expired, evicted = self._header()
+        return {
+            "size": used,
+            "capacity": self.capacity,
+            "expired": expired,
+            "evicted": evicted,
+        }
+
+    def __len__(self):
+        return self._header()[0]
+
+
+def create_session_store(config):
+    """Build the session store selected by the SESSION_STORE config value"""
+    backend = config.get("SESSION_STORE", "memory")
+    capacity = config.get("SESSION_STORE_CAPACITY", 4096)
+    ttl = config.get("SESSION_STORE_TTL_SECS", 86400)
+    if backend == "memory":
+        store = MemorySessionStore(capacity, ttl)
+        journal_path = config.get("SESSION_JOURNAL_PATH")
+        if journal_path:
+            # Imported here as the journal module builds on this one
+            from captiveportal.journal import JournaledSessionStore
+            store = JournaledSessionStore(
+                store, journal_path,
+                config.get("SESSION_JOURNAL_FLUSH_SECS", 1.0))
+    elif backend == "mmap":
+        store = MmapSessionStore(config["SESSION_STORE_PATH"], capacity, ttl)
+    else:
+        raise ValueError("Unknown SESSION_STORE: %s" % (backend,))
+    peers = config.get("SESSION_REPLICATION_PEERS")
+    if peers:
+        # Imported here as the replication module builds on this one
+        from captiveportal.replication import ReplicatedSessionStore
+        store = ReplicatedSessionStore(
+            store, [peer.strip() for peer in peers.split(",")],
+            config.get("SESSION_REPLICATION_SECRET"),
+            config.get("SESSION_REPLICATION_LISTEN"),
+            config.get("SESSION_REPLICATION_FLUSH_SECS", 0.2))
+    return store
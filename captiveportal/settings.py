@@ -0,0 +1,208 @@
+"""Typed, frozen settings that can be reloaded without a restart.
+
+Settings are built once from default_settings.py, then the file named by the
+CAPTIVEPORTAL_SETTINGS environment variable (Python, like Flask config
+files; relative paths are relative to this package; a missing file is
+logged and skipped), then CAPTIVEPORTAL_<NAME> environment variables. Every
+value is converted to the type of its default, so "300" from the
+environment becomes an int and a typo fails loudly at startup rather than
+on the first request.
+
+The result is a namedtuple, so code reads settings.current.NAME instead of
+looking up app.config on every request. On SIGHUP, or when the settings file
+changes, a new one is built and swapped in with a single assignment.
+Callbacks registered with on_change() then update what was built from the
+old settings, such as the pre-rendered pages. Session state isn't touched,
+but the session store's backend, path, capacity and replication peers only
+change on restart.
+
+Signal handlers can only be installed from the main thread, so the SIGHUP
+handler is installed when the app is imported rather than with the other
+background tasks, which start on a request thread. Under gunicorn, SIGHUP
+goes to the master, which passes it on to its workers rather than
+replacing them (see captiveportal.serve).
+"""
+import collections
+import errno
+import logging
+import os
+import signal
+import threading
+import time
+import types
+
+from captiveportal import default_settings
+
+logger = logging.getLogger(__name__)
+
+ENV_PREFIX = "CAPTIVEPORTAL_"
+
+_DEFAULTS = collections.OrderedDict(
+    (name, getattr(default_settings, name))
+    for name in sorted(dir(default_settings)) if name.isupper())
+
+Settings = collections.namedtuple("Settings", list(_DEFAULTS))
+
+# pylint: disable=invalid-name
+current = Settings(**_DEFAULTS)
+
+_callbacks = []
+
+
+def _coerce(name, value):
+    """Return value converted to the type of name's default"""
+    default = _DEFAULTS[name]
+    if default is None or value is None:
+        return value
+    if isinstance(default, bool):
+        if isinstance(value, str):
+            if value.lower() in ("1", "true", "yes", "on"):
+                return True
+            if value.lower() in ("0", "false", "no", "off", ""):
+                return False
+            raise ValueError("%s: %r is not a boolean" % (name, value))
+        return bool(value)
+    if isinstance(default, (int, float)):
+        if isinstance(value, str):
+            try:
+                return int(value)
+            except ValueError:
+                pass
+            try:
+                return float(value)
+            except ValueError:
+                raise ValueError("%s: %r is not a number" % (name, value))
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return value
+        raise ValueError("%s: %r is not a number" % (name, value))
+    if isinstance(default, str):
+        if not isinstance(value, str):
+            raise ValueError("%s: %r is not a string" % (name, value))
+        return value
+    return value
+
+
+def settings_path(environ=None):
+    """Return the path of the settings file, or None if there isn't one"""
+    environ = os.environ if environ is None else environ
+    path = environ.get(ENV_PREFIX + "SETTINGS")
+    if not path:
+        return None
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+
+
+def _read_file(path):
+    config = types.ModuleType("config")
+    config.__file__ = path
+    with open(path, "rb") as settings_file:
+        exec(compile(settings_file.read(), path, "exec"), config.__dict__)
+    return dict((name, value) for name, value in vars(config).items()
+                if name.isupper())
+
+
+def load(environ=None):
+    """Build Settings from the defaults, settings file and environment"""
+    environ = os.environ if environ is None else environ
+    values = dict(_DEFAULTS)
+    path = settings_path(environ)
+    file_values = {}
+    if path is not None:
+        try:
+            file_values = _read_file(path)
+        except (IOError, OSError) as error:
+            if error.errno != errno.ENOENT:
+                raise
+            logger.warning("Settings file %s doesn't exist, using the "
+                           "defaults", path)
+        for name, value in file_values.items():
+            if name not in _DEFAULTS:
+                logger.warning("Ignoring unknown setting %s in %s", name, path)
+                continue
+            values[name] = _coerce(name, value)
+    for name in _DEFAULTS:
+        if ENV_PREFIX + name in environ:
+            values[name] = _coerce(name, environ[ENV_PREFIX + name])
+    return Settings(**values)
+
+
+def on_change(callback):
+    """Call callback(settings) whenever new settings are installed"""
+    _callbacks.append(callback)
+
+
+def install(new):
+    """Swap in new settings and tell everything built from the old ones"""
+    global current
+    current = new
+    for callback in _callbacks:
+        callback(new)
+
+
+def reload():
+    """Load and install the settings again, keeping the old ones on error"""
+    try:
+        new = load()
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("Not reloading settings")
+        return False
+    if new != current:
+        install(new)
+    return True
+
+
+def install_sighup_handler():
+    """Reload the settings on SIGHUP, returning False if that can't be done
+
+    Must be called from the main thread.
+    """
+    try:
+        signal.signal(signal.SIGHUP, lambda signum, frame: reload())
+    except (ValueError, AttributeError) as error:
+        # Not the main thread, or no SIGHUP on this platform
+        logger.warning("SIGHUP won't reload the settings: %s", error)
+        return False
+    return True
+
+
+class SettingsWatcher(object):
+    """Reloads the settings whenever the settings file changes"""
+
+    def __init__(self, path, interval=2.0):
+        self.path = path
+        self.interval = interval
+        self._mtime = self._current_mtime()
+
+    def _current_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def poll(self):
+        """Reload if the file has changed, returning True if it had"""
+        mtime = self._current_mtime()
+        if mtime == self._mtime:
+            return False
+        self._mtime = mtime
+        reload()
+        return True
+
+    def start(self):
+        watcher = threading.Thread(target=self._run, name="settings-watcher")
+        watcher.daemon = True
+        watcher.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.poll()
+
+
+def start_reloading():
+    """Reload when the settings file changes, if SETTINGS_POLL_SECS is set
+
+    SIGHUP is handled by install_sighup_handler().
+    """
+    path = settings_path()
+    if path is not None and current.SETTINGS_POLL_SECS:
+        SettingsWatcher(path, current.SETTINGS_POLL_SECS).start()
@@ -0,0 +1,288 @@
+"""User-Agent classification shared by all of the captive portal views.
+
+The portal only needs a handful of facts from a UA: the OS family and
+version, and whether it's one of the captive portal agents. Those are
+worked out by a short list of precompiled patterns that match the agents we
+see on the probe endpoints, falling back to ua_parser's full regex list for
+anything the fast path can't classify.
+
+Classification happens at most once per distinct UA string per process: the
+resulting DeviceProfile is kept in a bounded LRU cache keyed on the raw
+string, and the profile for the current request is stashed on flask.g so
+every helper in views.py shares it.
+
+Loading ua_parser's regex list takes longer than importing the rest of the
+portal, so it's only imported when the fast path first fails to classify a
+UA; a worker that only ever sees the usual agents never loads it.
+"""
+import re
+import threading
+from collections import OrderedDict
+
+from flask import g, has_request_context, request
+
+
+LINK_OPS = {
+    "TEXT": "text",
+    "HREF": "href",
+}
+
+# Coarse kinds of client, as recorded in the probe history. The first four
+#  are the captive portal agents and browsers that probe us
+UA_CLASSES = ("x11", "dalvik", "wispr", "android", "ios", "macos", "windows",
+              "other")
+
+# Fast-path patterns, ordered by how often we see each agent on the probe
+#  endpoints. Each entry is (compiled pattern, os family); the pattern's
+#  first two groups (if any) are the OS major and minor versions. The
+#  patterns are anchored and strict so that anything unusual (e.g. Windows
+#  Phone claiming to be Android) falls through to ua_parser.
+_FAST_PATTERNS = (
+    # Android 7.1+ "X11" captive portal agent, re-probing every 30-300s
+    (re.compile(r"^Mozilla/5\.0 \(X11; Linux [^;)]*\) AppleWebKit/"),
+     "Linux"),
+    # Android Dalvik captive portal agent
+    (re.compile(r"^Dalvik/[\d.]+ \(Linux; U; Android (\d+)(?:\.(\d+))?"
+                r"(?:\.\d+)*;"),
+     "Android"),
+    # Android webkit agent i.e. the captive portal browser
+    (re.compile(r"^Mozilla/5\.0 \(Linux; (?:U; )?Android (\d+)(?:\.(\d+))?"
+                r"(?:\.\d+)*[;)]"),
+     "Android"),
+    # iOS and macOS wispr agent
+    (re.compile(r"^CaptiveNetworkSupport-[\d.]+ wispr$"),
+     "Other"),
+    # iOS captive portal browser
+    (re.compile(r"^Mozilla/5\.0 \((?:iPhone|iPad|iPod)(?:; U)?; "
+                r"CPU (?:iPhone )?OS (\d+)_(\d+)"),
+     "iOS"),
+    # macOS captive portal browser
+    (re.compile(r"^Mozilla/5\.0 \(Macintosh; Intel Mac OS X (\d+)[_.](\d+)"),
+     "Mac OS X"),
+)
+
+
+def _requires_ok_press(os_family, os_major):
+    """
+    Only some devices need an OK press to complete CP workflow
+
+    For some devices it's a distraction, for others it does bad things
+    This user agent detection is against the ua that shows the text, rather
+    than one of the other UAs that performs connectivity testing
+
+    Android >= 6 needs an OK press. Android 7.1+ uses an X11-style UA string
+    in its captive portal browser (not the Dalvik agent), so "Android" does
+    not appear in the UA — we must handle that case separately.
+    """
+    # iOS and MacOS never need the OK button
+    if os_family in ("iOS", "Mac OS X"):
+        return False
+
+    if os_family == "Android":
+        # Don't assume that everything has an os.major that can be cast to an int
+        #  but as old android devices are tolerant of an OK button press (even
+        #  though the UX isn't ideal) and newer Android devices with cellular plans
+        #  simply won't work without one, we show the OK button if we can't work
+        #  out what to do
+        try:
+            return int(os_major) >= 6
+        except (ValueError, TypeError):
+            return True
+
+    # Android 7.1+ captive portal browser identifies as an X11 agent
+    # (ua_parser reports os_family as "Linux", not "Android").
+    # The OK button POST to /generate_204 is what sets the ack flag that
+    # causes android_cpa_needs_204_now() to return True and complete the
+    # captive portal handshake — without it the device stays in portal state.
+    return True
+
+
+def _link_type(os_family, os_major, os_minor):
+    """Return whether the device can show useable hrefs
+
+
+    Lollipop (Android v5) and Marshmallow (Android v6) can render links,
+     and can execute javascript but all operations keep the device
+     trapped in the reduced-capability captive portal browsers and we
+     don't want that, so we just show text
+    """
+    if os_family == "iOS":
+        # iOS 9 and iOS 11+ can open links from the captive portal browser
+        # in the system browser. iOS 10 cannot - the link opens in the
+        # captive portal browser itself. iOS 12+ restored the ability to
+        # escape to the system browser.
+        try:
+            major = int(os_major or 0)
+            if major == 9 or major >= 11:
+                return LINK_OPS["HREF"]
+        except (ValueError, TypeError):
+            pass
+
+    if os_family == "Mac OS X":
+        # macOS 10.12 (Sierra) and later can open links from the captive
+        # portal browser in the system browser. macOS 11+ (Big Sur, Monterey,
+        # Ventura, Sonoma, Sequoia) uses a new major version numbering scheme.
+        try:
+            major = int(os_major or 0)
+            minor = int(os_minor or 0)
+            if major >= 11 or (major == 10 and minor >= 12):
+                return LINK_OPS["HREF"]
+        except (ValueError, TypeError):
+            pass
+
+    return LINK_OPS["TEXT"]
+
+
+def _ua_class(profile, os_family):
+    """Return which of UA_CLASSES a profile belongs to"""
+    if profile.is_captive_network_support:
+        return "wispr"
+    if profile.is_dalvik:
+        return "dalvik"
+    if profile.is_x11 and os_family == "Linux":
+        return "x11"
+    if os_family == "Android":
+        return "android"
+    if os_family == "iOS":
+        return "ios"
+    if os_family == "Mac OS X":
+        return "macos"
+    if os_family.startswith("Windows"):
+        return "windows"
+    return "other"
+
+
+class DeviceProfile(object):
+    """Everything the portal decides from a User-Agent string
+
+    The welcome page decisions (icon_type, link_type and show_ok) are
+    computed once, when the profile is built.
+    """
+
+    __slots__ = ("ua_str", "os_family", "os_major", "os_minor",
+                 "is_android", "is_dalvik", "is_x11",
+                 "is_captive_network_support", "ua_class",
+                 "icon_type", "link_type", "show_ok")
+
+    def __init__(self, ua_str, os_family, os_major=None, os_minor=None):
+        self.ua_str = ua_str
+        self.os_family = os_family
+        self.os_major = os_major
+        self.os_minor = os_minor
+        # Substring markers used by the captive portal agent checks. These
+        #  are deliberately not derived from os_family because the Android
+        #  7.1+ "X11" agent doesn't mention Android at all
+        self.is_android = "Android" in ua_str
+        self.is_dalvik = "Dalvik" in ua_str
+        self.is_x11 = "X11" in ua_str
+        self.is_captive_network_support = "CaptiveNetworkSupport" in ua_str
+        self.ua_class = _ua_class(self, os_family)
+
+        if os_family in ("iOS", "Mac OS X"):
+            self.icon_type = "safari"
+        else:
+            self.icon_type = "chrome"
+        self.link_type = _link_type(os_family, os_major, os_minor)
+        self.show_ok = _requires_ok_press(os_family, os_major)
+
+    @classmethod
+    def from_ua_parser(cls, ua_str):
+        """Build a profile using ua_parser's full regex list"""
+        # pylint: disable=import-outside-toplevel
+        from ua_parser import user_agent_parser
+        parsed_os = user_agent_parser.ParseOS(ua_str)
+        return cls(ua_str, parsed_os["family"],
+                   parsed_os["major"], parsed_os["minor"])
+
+    @classmethod
+    def from_fast_path(cls, ua_str):
+        """Build a profile from the precompiled patterns
+
+        Returns None if none of the patterns match ua_str
+        """
+        if not ua_str:
+            return cls(ua_str, "Other")
+        for pattern, os_family in _FAST_PATTERNS:
+            match = pattern.match(ua_str)
+            if match:
+                versions = match.groups() + (None, None)
+                return cls(ua_str, os_family, versions[0], versions[1])
+        return None
+
+
+def classify(ua_str):
+    """Return the DeviceProfile for ua_str, without caching"""
+    return DeviceProfile.from_fast_path(ua_str) or \
+        DeviceProfile.from_ua_parser(ua_str)
+
+
+class UserAgentCache(object):
+    """Bounded LRU cache of DeviceProfile objects keyed on the raw UA string
+
+    A venue full of phones only produces a few dozen distinct UA strings so
+    a small cache means nearly every probe skips classification entirely.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, ua_str):
+        """Return the DeviceProfile for ua_str, classifying it on a miss"""
+        with self._lock:
+            try:
+                profile = self._entries[ua_str]
+            except KeyError:
+                pass
+            else:
+                self._entries.move_to_end(ua_str)
+                self.hits += 1
+                return profile
+
+        # Classify outside the lock; two threads racing on the same new
+        #  string just both classify it, which is harmless
+        profile = classify(ua_str)
+        with self._lock:
+            self.misses += 1
+            self._entries[ua_str] = profile
+            self._entries.move_to_end(ua_str)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return profile
+
+    def clear(self):
+        """Drop all cached entries and reset the hit/miss counters"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# pylint: disable=invalid-name
+ua_cache = UserAgentCache()
+
+
+def parse(ua_str):
+    """Return the (possibly cached) DeviceProfile for ua_str"""
+    return ua_cache.get(ua_str)
+
+
+def current_user_agent():
+    """Return the DeviceProfile for the request being handled
+
+    The result is stored on flask.g so the UA is looked up once per request
+    no matter how many helpers ask for it.
+    """
+    if not has_request_context():
+        return parse("")
+    try:
+        return g.parsed_user_agent
+    except AttributeError:
+        g.parsed_user_agent = parse(request.headers.get("User-agent", ""))
+        return g.parsed_user_agent
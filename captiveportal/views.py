@@ -1,160 +1,141 @@
 import ipaddress
+import os
+import threading
 import time
-from flask import jsonify, redirect, render_template, request, Response, url_for
-from ua_parser import user_agent_parser
+from flask import g, jsonify, redirect, request, Response
 
-from captiveportal import app
+from captiveportal import app, dhcp, portal, settings
+from captiveportal.assets import StaticAssets
+from captiveportal.history import ProbeHistory
+from captiveportal.identity import ClientIdentities
+from captiveportal.journal import JournaledSessionStore
+from captiveportal.metrics import Metrics
+from captiveportal.ratelimit import RateLimiter
+from captiveportal.replication import ReplicatedSessionStore
+from captiveportal.responses import ResponseCache
+from captiveportal.sessions import client_key, create_session_store
+from captiveportal.useragent import current_user_agent, ua_cache
 
 
-LINK_OPS = {
-    "TEXT": "text",
-    "HREF": "href",
-}
 # pylint: disable=invalid-name
-_client_last_seen_time = {}
-MAX_ASSUMED_CP_SESSION_TIME_SECS = 300
-MAX_TIME_WITHOUT_SHOWING_CP_SECS = 86400  # 1 day
+session_store = create_session_store(app.config)
 
-_android_has_acked_cp_instructions = {}
+# Limits how fast expired sessions are shown the portal again
+redisplay_admission = portal.TokenBucket(app.config["PORTAL_REDISPLAY_RATE"],
+                                         app.config["PORTAL_REDISPLAY_BURST"])
 
+# Limits how fast each client can fetch unknown URLs (see probes.py)
+catch_all_limiter = RateLimiter(app.config["CATCH_ALL_RATE"],
+                                app.config["CATCH_ALL_BURST"],
+                                app.config["CATCH_ALL_LIMIT_SLOTS"],
+                                app.config["CATCH_ALL_LIMIT_PATH"])
 
-def secs_since_last_seen():
-    """Return seconds elapsed since this client IP was last registered with the portal.
-
-    Returns a very large number (time since epoch) for clients that have never
-    been seen, so all comparison checks naturally treat them as "new".
-    """
-    last_session_start_time = \
-        _client_last_seen_time.get(request.remote_addr, 0)
-    return time.time() - last_session_start_time
-
-
-def client_is_rejoining_network():
-    """
-    Checks whether this IP has gone through this CP recently
-
-    We want to avoid bringing up the captive portal browser when a
-    user rejoins the network after a short break because spamminess
-    is bad, and they shouldn't need a pointer to the content (which
-    is what the captive portal browser provides).
-
-    We differentiate rejoining the network as opposed to continuing the
-    same captive portal session, and we do this by saying that a rejoin
-    is only happening if it's more than MAX_ASSUMED_CP_SESSION_TIME_SECS
-    after the last session started
-    """
-    return secs_since_last_seen() < MAX_TIME_WITHOUT_SHOWING_CP_SECS and \
-        secs_since_last_seen() > MAX_ASSUMED_CP_SESSION_TIME_SECS
+response_cache = ResponseCache(app)
 
+# Which device holds each leased address, so sessions follow the device
+client_identities = ClientIdentities()
+# What the HTTP hooks' lease events bind addresses in, if anything
+dhcp_identities = client_identities \
+    if dhcp.can_key_by_mac(app.config, session_store) else None
 
-def is_new_captive_portal_session():
-    """Return True if this client has not been seen within the last 24 hours.
+metrics = Metrics(ua_cache, session_store, app.config["METRICS_DIR"],
+                  app.config["METRICS_SNAPSHOT_SECS"], redisplay_admission)
 
-    A client older than MAX_TIME_WITHOUT_SHOWING_CP_SECS is treated as brand-new
-    so the portal page is shown again — this handles devices that return after
-    more than a day without going through the captive portal flow again.
-    """
-    return secs_since_last_seen() > MAX_TIME_WITHOUT_SHOWING_CP_SECS
+static_assets = StaticAssets(app, metrics.count_not_modified)
 
-def device_requires_ok_press(ua_str):
-    """
-    Only some devices need an OK press to complete CP workflow
+probe_history = ProbeHistory(app.config["PROBE_HISTORY_BYTES"])
 
-    For some devices it's a distraction, for others it does bad things
-    This user agent detection is against the ua that shows the text, rather
-    than one of the other UAs that performs connectivity testing
 
-    Android >= 6 needs an OK press. Android 7.1+ uses an X11-style UA string
-    in its captive portal browser (not the Dalvik agent), so "Android" does
-    not appear in the UA — we must handle that case separately.
-    """
-    user_agent = user_agent_parser.Parse(ua_str)
-    os_family = user_agent["os"]["family"]
+def apply_settings(new):
+    """Bring everything built from the previous settings up to date"""
+    app.config.update(new._asdict())
+    ua_cache.maxsize = new.UA_CACHE_SIZE
+    static_assets.max_age = new.STATIC_MAX_AGE_SECS
+    redisplay_admission.configure(new.PORTAL_REDISPLAY_RATE,
+                                  new.PORTAL_REDISPLAY_BURST)
+    catch_all_limiter.configure(new.CATCH_ALL_RATE, new.CATCH_ALL_BURST)
+    response_cache.invalidate()
 
-    # iOS and MacOS never need the OK button
-    if os_family in ("iOS", "Mac OS X"):
-        return False
 
-    if os_family == "Android":
-        # Don't assume that everything has an os.major that can be cast to an int
-        #  but as old android devices are tolerant of an OK button press (even
-        #  though the UX isn't ideal) and newer Android devices with cellular plans
-        #  simply won't work without one, we show the OK button if we can't work
-        #  out what to do
-        try:
-            return int(user_agent["os"]["major"]) >= 6
-        except (ValueError, TypeError):
-            return True
+settings.on_change(apply_settings)
 
-    # Android 7.1+ captive portal browser identifies as an X11 agent
-    # (ua_parser reports os_family as "Other", not "Android").
-    # The OK button POST to /generate_204 is what sets the ack flag that
-    # causes android_cpa_needs_204_now() to return True and complete the
-    # captive portal handshake — without it the device stays in portal state.
-    return True
+# The DHCP feeds, the settings watcher and the session replication receiver
+#  run in background threads, which don't survive a fork. They're started in
+#  each process that serves requests rather than at import, so that a
+#  gunicorn master that loaded the app before forking (see
+#  captiveportal.serve) doesn't hold the DHCP and replication sockets
+_background_pid = None
+_background_lock = threading.Lock()
 
 
-def get_link_type(ua_str):
-    """Return whether the device can show useable hrefs
+def reload_session_journal():
+    """Reload this process's sessions from the journal, if there is one"""
+    store = session_store
+    # Under the replication wrapper, if sessions are replicated
+    while store is not None and not isinstance(store, JournaledSessionStore):
+        store = getattr(store, "store", None)
+    if store is not None:
+        store.reload()
 
 
-    Lollipop (Android v5) and Marshmallow (Android v6) can render links,
-     and can execute javascript but all operations keep the device
-     trapped in the reduced-capability captive portal browsers and we
-     don't want that, so we just show text
+def start_background_tasks():
+    """Start this process's DHCP feeds, settings file watcher and
+    replication receiver, once
     """
-    user_agent = user_agent_parser.Parse(ua_str)
-
-    if user_agent["os"]["family"] == "iOS":
-        # iOS 9 and iOS 11+ can open links from the captive portal browser
-        # in the system browser. iOS 10 cannot - the link opens in the
-        # captive portal browser itself. iOS 12+ restored the ability to
-        # escape to the system browser.
-        try:
-            major = int(user_agent["os"]["major"] or 0)
-            if major == 9 or major >= 11:
-                return LINK_OPS["HREF"]
-        except (ValueError, TypeError):
-            pass
-
-    if user_agent["os"]["family"] == "Mac OS X":
-        # macOS 10.12 (Sierra) and later can open links from the captive
-        # portal browser in the system browser. macOS 11+ (Big Sur, Monterey,
-        # Ventura, Sonoma, Sequoia) uses a new major version numbering scheme.
-        try:
-            major = int(user_agent["os"]["major"] or 0)
-            minor = int(user_agent["os"]["minor"] or 0)
-            if major >= 11 or (major == 10 and minor >= 12):
-                return LINK_OPS["HREF"]
-        except (ValueError, TypeError):
-            pass
-
-    return LINK_OPS["TEXT"]
-
-
-def android_cpa_needs_204_now():
-    """Does this captive portal agent need a 204 right now?
-
-    We expect the user agents to go through various states before receiving
-    a 204. This is particularly important for Android >= 7.1, which falls back
-    to cellular if it doesn't get a 204 at the right time.
+    global _background_pid
+    if _background_pid == os.getpid():
+        return
+    with _background_lock:
+        if _background_pid == os.getpid():
+            return
+        _background_pid = os.getpid()
+        dhcp.start_feeds(app.config, session_store, client_identities)
+        if isinstance(session_store, ReplicatedSessionStore):
+            session_store.start()
+        settings.start_reloading()
+
+
+# Unlike the tasks above this needs the main thread, which is the one that
+#  imports the app (gunicorn workers install it again, see
+#  captiveportal.serve)
+settings.install_sighup_handler()
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    # Unknown URLs have no endpoint, they're served by the 404 handler
+    metrics.observe_request(request.endpoint or "default_view",
+                            response.status_code,
+                            time.perf_counter() - g.request_started)
+    return response
+
+
+def current_client_ip_key():
+    """Return the client_key() of the address making this request"""
+    try:
+        return g.client_ip_key
+    except AttributeError:
+        g.client_ip_key = client_key(request.remote_addr)
+        return g.client_ip_key
+
+
+def current_client_key():
+    """Return the session store key for the client making this request.
+
+    That's the device's MAC key if its address has a DHCP lease we know of,
+    and its IP key otherwise (see captiveportal.identity). The key is
+    computed once per request and shared by every helper.
     """
-    ua_str = request.headers.get("User-agent", "")
-
-    if "Android" not in ua_str:
-        # We're the "X11" agent in Android 7.1+
-        # Only show a 204 if the user has pressed "OK" on the CP screen
-        return _android_has_acked_cp_instructions.get(request.remote_addr, False)
-
-    # 5.0.1 shows a confusing webpage unavailable page when Dalvik receives
-    #  a 204 response after a POST, but as we never present an OK button to
-    #  5.0.1 (because device_requires_ok_press never passes), we don't have
-    #  to worry about a specific 5.0.1 check here.
-    if "Dalvik" in ua_str:
-        return _android_has_acked_cp_instructions.get(request.remote_addr, False)
-
-    # We're the Android Webkit agent, never send a 204
-    return False
+    try:
+        return g.client_key
+    except AttributeError:
+        g.client_key = client_identities.session_key(current_client_ip_key())
+        return g.client_key
 
 
 def register_client_last_seen_time():
@@ -164,99 +145,91 @@ def register_client_last_seen_time():
     The timestamp is used by secs_since_last_seen() to decide whether to show
     the portal page again or silently pass the client through.
     """
-    _client_last_seen_time[request.remote_addr] = time.time()
+    session_store.touch(current_client_key(), time.time())
 
 
-def handle_ios_macos():
-    """Handle iOS and MacOS interactions
-    iOS <v9 and MacOS pre-yosemite
-    See: https://forum.piratebox.cc/read.php?9,8927
+def record_decision(handler, endpoint, ip_key, key, profile, decision, now):
+    """Count a probe decision and add it to the client's probe history
 
-    iOS >= v9 and MacOS Yosemite and later:
-    # pylint: disable=line-too-long
-    See: https://apple.stackexchange.com/questions/45418/how-to-automatically-login-to-captive-portals-on-os-x
+    The history is kept by address; key is the client's session key.
     """
-    if client_is_rejoining_network():
-        # Don't raise captive portal browser
-        register_client_last_seen_time()
-        return render_template("success.html")
-
-    if is_new_captive_portal_session():
-        register_client_last_seen_time()
-        # raise captive portal browser by not showing success.html
-        return show_connected()
+    metrics.count_decision(handler, decision)
+    probe_history.record(now, ip_key, endpoint, profile.ua_class, decision,
+                         session_store.is_acked(key))
+
+
+def _is_local_request():
+    try:
+        return ipaddress.ip_address(request.remote_addr).is_loopback
+    except ValueError:
+        return False
+
 
-    ua_str = request.headers.get("User-agent", "")
-    if "CaptiveNetworkSupport" in ua_str:
-        # CaptiveNetworkSupport/wispr is the captive portal agent.
-        # Always show "success" after initial interaction
-        return render_template("success.html")
+def handle_ios_macos():
+    """Handle iOS and MacOS interactions
 
-    # We're the captive portal browser.
-    # Show connected message after initial interaction
+    See portal.decide_ios_macos for the workflow.
+    """
+    now = time.time()
+    decision = portal.decide_ios_macos(session_store, current_client_key(),
+                                       current_user_agent(), now,
+                                       redisplay_admission)
+    record_decision("ios_macos", request.endpoint, current_client_ip_key(),
+                    current_client_key(), current_user_agent(), decision, now)
+    if decision in (portal.DECISION_REJOIN, portal.DECISION_SUCCESS):
+        return cached_response(response_cache.success())
     return show_connected()
 
-def handle_android():
-    """Handle Android interactions"""
-    if is_new_captive_portal_session():
-        # reset state in order to raise the captive portal browser
-        # As >= v7.1 "X11 agent" regularly hits the generate_204
-        #  endpoint, in >=7.1 the check isn't really about whether this is a
-        #  new captive portal session and more about whether we haven't seen
-        #  the device "recently"
-        # this code path is also used by < v7.1, but it's ok to reset state
-        #  for those devices too because it will still raise the cp browser
-        _do_remove_client(request.remote_addr)
-
-    # The X11 captive portal agent periodically checks for internet access.
-    # It's the only agent that hits this endpoint after the captive portal
-    #  browser has been seen, and as the X11 agent doesn't detect internet
-    #  access after a reconnect to the network, despite a 204. Updating the
-    #  session start time means that eventually this won't been seen as an
-    #  existing captive portal session and we won't send a 204, which
-    #  will cause the "sign-in to wifi" sheet to come up.
-    register_client_last_seen_time()
 
-    if request.method == "POST":
-        _android_has_acked_cp_instructions[request.remote_addr] = True
+def handle_android():
+    """Handle Android interactions
 
-    if android_cpa_needs_204_now():
+    See portal.decide_android for the workflow.
+    """
+    now = time.time()
+    decision = portal.decide_android(session_store, current_client_key(),
+                                     current_user_agent(), request.method,
+                                     now, redisplay_admission)
+    record_decision("android", request.endpoint, current_client_ip_key(),
+                    current_client_key(), current_user_agent(), decision, now)
+    if decision == portal.DECISION_204:
         return Response(status=204)
-    else:
-        return show_connected()
+    return show_connected()
+
+
+def cached_response(cached):
+    """Return a flask Response for a CachedResponse, or a 304 if the client
+    already has it
+    """
+    if request.method in ("GET", "HEAD") and \
+            cached.matches(request.headers.get("If-None-Match", "")):
+        metrics.count_not_modified(request.endpoint or "default_view",
+                                   len(cached.body))
+        return cached.to_not_modified_response()
+    return cached.to_response()
 
 
 def show_connected():
-    """Render the captive portal welcome page tailored to the client's OS.
+    """Serve the captive portal welcome page tailored to the client's OS.
 
     Selects the correct browser icon (Safari vs Chrome) and link type (clickable
     href vs plain text) based on User-Agent so the page renders correctly in each
-    OS's captive portal browser.  Also passes the ConnectBox URL and hostname from
-    app config so the template can display the correct destination link.
+    OS's captive portal browser.  Every variant is pre-rendered with the
+    ConnectBox URL and hostname from app config, so no template work happens here.
+    A client revalidating the variant it has gets a 304 without its User-Agent
+    being parsed.
     """
-    ua_str = request.headers.get("User-agent", "")
-    user_agent = user_agent_parser.Parse(ua_str)
-    if user_agent["os"]["family"] == "iOS" or \
-           user_agent["os"]["family"] == "Mac OS X":
-        icon_type = "safari"
-    else:
-        icon_type = "chrome"
+    cached = None
+    if request.method in ("GET", "HEAD"):
+        cached = response_cache.connected_matching(
+            request.headers.get("If-None-Match", ""))
+    if cached is None:
+        cached = response_cache.connected(current_user_agent())
+    return cached_response(cached)
 
-    browser_icon = \
-        url_for('static', filename='go-animation-%s.gif' % (icon_type,))
-    return render_template(
-        "connected.html",
-        connectbox_url=app.config.get("CONNECTBOX_URL", "http://gowifi.org"),
-        connectbox_hostname=app.config.get("CONNECTBOX_HOSTNAME", "ConnectBox"),
-        LINK_OPS=LINK_OPS,
-        browser_icon=browser_icon,
-        link_type=get_link_type(ua_str),
-        show_ok=device_requires_ok_press(ua_str),
-    )
 
-
-def _do_remove_client(source_ip):
-    """Remove all session state for source_ip from both tracking dicts.
+def _do_remove_client(source_key):
+    """Remove all session state for a client from the session store.
 
     Called when a client is explicitly de-authorised (DELETE /_authorised_clients)
     or when Android rejoins the network and needs a fresh portal session.
@@ -265,22 +238,53 @@ def _do_remove_client(source_ip):
 
     Parameters
     ----------
-    source_ip : str — dotted-decimal IPv4 address string
+    source_key : int — session key, as returned by current_client_key()
     """
-    if source_ip in _client_last_seen_time:
-        del _client_last_seen_time[source_ip]
-
-    if source_ip in _android_has_acked_cp_instructions:
-        del _android_has_acked_cp_instructions[source_ip]
+    session_store.remove(source_key)
 
 
 @app.route('/_authorised_clients', methods=['DELETE'])
 def remove_authorised_client():
     """Forgets that a client has been seen recently to allow running tests"""
-    _do_remove_client(request.remote_addr)
+    _do_remove_client(current_client_key())
     return Response(status=204)
 
 
+@app.route('/_metrics', methods=['GET'])
+def show_metrics():
+    """Request, latency and decision metrics in Prometheus text format
+
+    Only served to localhost; anyone else gets the welcome page, as they
+    would for any other unknown URL.
+    """
+    if not _is_local_request():
+        return show_connected()
+    return Response(metrics.render(),
+                    mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.route('/_history', methods=['GET'])
+def show_history():
+    """The probe decisions made for a client or in a time window, as JSON
+
+    Query parameters: ip, since and until (Unix times) and limit (default
+    100). Events are newest first. Like /_metrics, only served to localhost.
+    """
+    if not _is_local_request():
+        return show_connected()
+    key = None
+    if "ip" in request.args:
+        key = client_key(request.args["ip"])
+        if key is None:
+            return "ip: %s is not a valid ip address" % \
+                (request.args["ip"],), 400
+    # Unparseable numbers are ignored, as though they weren't given
+    since = request.args.get("since", type=float)
+    until = request.args.get("until", type=float)
+    limit = request.args.get("limit", 100, type=int)
+    return jsonify({"events": probe_history.events(key, since, until, limit)})
+
+
 @app.route('/handle_dhcp_event', methods=["POST"])
 def handle_dhcp_event():
     """
@@ -295,33 +299,41 @@ def handle_dhcp_event():
     operation = request.values.get("operation", "")
     if not operation:
         return "Missing operation", 400
-    elif operation == "old":
-        # Existing lease
+    elif operation in dhcp.OPERATIONS:
         try:
             dhcp_ip = ipaddress.ip_address(request.values.get("dhcp_ip", ""))
         except ValueError:
             return "dhcp_id: %s is not a valid ip address" % \
                 request.values.get("dhcp_ip", ""), 400
-
-        # When rejoining the network, Android 7.1+ doesn't associate a
-        #  204 with having internet access, and thus presents a
-        #  "Connected. No internet access" even though all the required 204
-        #  has been given. To force the popup, when the device rejoins the
-        #  network, we have a short time between the DHCP lease being assigned
-        #  and the first captive portal hit being made, and in that time we
-        #  reset some of the captive portal state so that the "X11" agent
-        #  receives a 200 response, thus raising the "Sign in to network"
-        #  sheet
-        # Need to check... they may not have clicked ok
-        if dhcp_ip.exploded in _android_has_acked_cp_instructions:
-            del _android_has_acked_cp_instructions[dhcp_ip.exploded]
+        dhcp.apply_event(session_store, operation, dhcp_ip,
+                         request.values.get("mac", "").lower() or None,
+                         dhcp_identities, dhcp.events_bind(session_store))
         return "", 204
     else:
-        # Currently, we don't do anything with other operations and we don't
-        #  attempt to validate that it's even a known operation
+        # We don't attempt to validate that it's even a known operation
         return "", 204
 
 
+@app.route('/handle_dhcp_events', methods=["POST"])
+def handle_dhcp_events():
+    """
+    Hook for handling a batch of dhcp events in one request
+
+    The body has one event per line: operation, mac and ip separated by
+    whitespace, in the order dnsmasq passes them to --dhcp-script. Valid
+    events are applied even if others in the batch are rejected.
+
+    Like /handle_dhcp_event, this should be protected in the webserver so
+    that it cannot be accessed except from localhost
+    """
+    events, errors = dhcp.parse_event_lines(
+        request.get_data(as_text=True).splitlines())
+    applied = dhcp.apply_events(session_store, events, dhcp_identities,
+                                dhcp.events_bind(session_store))
+    return jsonify({"applied": applied, "errors": errors}), \
+        400 if errors else 200
+
+
 @app.route('/kindle-wifi/wifistub.html', methods=["GET", "POST"])
 def handle_wifistub_html():
     """Captive portal probe handler for Amazon Kindle Fire devices."""
@@ -392,7 +404,4 @@ def handle_fallback_android():
 # New devices use this to discover the portal URL directly instead of probing.
 @app.route('/.well-known/captive-portal', methods=["GET"])
 def captive_portal_api():
-    return jsonify({
-        "captive": True,
-        "user-portal-url": app.config.get("CONNECTBOX_URL", "http://gowifi.org")
-    })
+    return cached_response(response_cache.captive_portal_api())
@@ -17,4 +17,15 @@ setup(
         'MarkupSafe==1.1.1',  # 3.5 support dropped 30Jan2020
         'Jinja2==2.11.2',  # 3.5 support dropped 27Jan2020
     ],
+    entry_points={
+        'console_scripts': [
+            'captiveportal-serve = captiveportal.serve:main',
+        ],
+    },
+    extras_require={
+        # Asyncio serving mode for the probe endpoints (captiveportal.asgi)
+        'asgi': ['uvicorn'],
+        # Brotli compressed CSS, and WebP animations (captiveportal.assets)
+        'assets': ['brotli', 'Pillow'],
+    },
 )
@@ -0,0 +1,81 @@
+import asyncio
+import unittest
+
+from captiveportal.asgi import application
+from captiveportal.sessions import client_key
+from captiveportal.useragent import parse
+from captiveportal.views import response_cache, session_store
+
+
+def asgi_request(path, method="GET", headers=(), client="10.1.0.1"):
+    """Send one request through the ASGI app and return (status, body)"""
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                    for name, value in headers],
+        "client": (client, 12345),
+        "server": ("127.0.0.1", 5000),
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(application(scope, receive, send))
+    finally:
+        loop.close()
+    return messages[0]["status"], messages[1]["body"]
+
+
+class ASGITestCase(unittest.TestCase):
+
+    X11_UA = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 " \
+             "(KHTML, like Gecko) Chrome/52.0.2743.82 Safari/537.36"
+
+    def tearDown(self):
+        session_store.remove(client_key("10.1.0.1"))
+
+    def testAndroidGets204AfterOKPress(self):
+        headers = [("User-Agent", self.X11_UA)]
+        status, body = asgi_request("/generate_204", headers=headers)
+        self.assertEqual(status, 200)
+        self.assertIn(b"OK</button></form>", body)
+        status, _ = asgi_request("/generate_204", method="POST",
+                                 headers=headers)
+        self.assertEqual(status, 204)
+        status, _ = asgi_request("/gen_204", headers=headers)
+        self.assertEqual(status, 204)
+
+    def testRevalidatedPageGets304(self):
+        etag = response_cache.connected(parse(self.X11_UA)).etag
+        status, body = asgi_request("/generate_204", headers=[
+            ("User-Agent", self.X11_UA), ("If-None-Match", etag)])
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b"")
+
+    def testProxiedClientAddress(self):
+        headers = [("User-Agent", self.X11_UA),
+                   ("X-Forwarded-For", "10.1.0.1")]
+        asgi_request("/generate_204", method="POST", headers=headers,
+                     client="127.0.0.1")
+        self.assertTrue(session_store.is_acked(client_key("10.1.0.1")))
+
+    def testOtherPathsAreServedByFlask(self):
+        status, body = asgi_request("/kindle-wifi/wifistub.html")
+        self.assertEqual(status, 200)
+        self.assertIn(b"Connected to ConnectBox", body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import gzip
+import re
+import unittest
+
+from captiveportal import app
+from captiveportal.assets import Asset
+from captiveportal.views import static_assets
+
+WISPR_UA = "CaptiveNetworkSupport-346.50.1 wispr"
+
+
+class StaticAssetsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def testWelcomePageUsesFingerprintedURL(self):
+        body = self.client.get("/hotspot-detect.html",
+                               headers={"User-Agent": WISPR_UA},
+                               environ_base={"REMOTE_ADDR": "10.7.0.1"}).data
+        url = re.search(rb'<img src="([^"]+)"', body).group(1).decode()
+        self.assertRegex(url,
+                         r"^/static/go-animation-\w+\.[0-9a-f]{12}\.gif$")
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Content-Type"], "image/gif")
+        self.assertIn("immutable", response.headers["Cache-Control"])
+
+        response = self.client.get(
+            url, headers={"If-None-Match": response.headers["ETag"]})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b"")
+        # As forwarded by a proxy that compressed the response itself
+        response = self.client.get(
+            url, headers={"If-None-Match": "W/" + response.headers["ETag"]})
+        self.assertEqual(response.status_code, 304)
+
+    def testCSSIsPrecompressed(self):
+        css = b"body { font-family: sans-serif; }\n" * 50
+        asset = Asset(css, "text/css")
+        encoding, _, body, _ = asset.select("gzip, deflate", "*/*")
+        self.assertEqual(encoding, "gzip")
+        self.assertEqual(gzip.decompress(body), css)
+        self.assertEqual(asset.select("", "*/*")[2], css)
+        self.assertEqual(asset.select("gzip;q=0, deflate", "*/*")[2], css)
+        self.assertEqual(asset.select("*;q=0", "*/*")[2], css)
+        self.assertEqual(asset.select("*", "*/*")[0], asset.select(
+            "br, gzip", "*/*")[0])
+
+    def testTinyAssetsAreNotCompressed(self):
+        # styles.css is smaller than its gzip header
+        url = "/static/" + static_assets.urls["styles.css"]
+        response = self.client.get(url, headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertIn("immutable", response.headers["Cache-Control"])
+
+    def testPlainNamesAreStillServed(self):
+        response = self.client.get("/static/styles.css")
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+    def testWebPServedOnlyToDevicesAcceptingIt(self):
+        asset = Asset(b"GIF89a" + b"\x00" * 100, "image/gif")
+        asset.add_alternative(b"RIFF" + b"\x00" * 10, "image/webp")
+        self.assertEqual(asset.select("", "*/*")[1], "image/gif")
+        self.assertEqual(asset.select("", "image/webp,image/*")[1],
+                         "image/webp")
+        self.assertEqual(asset.select("", "image/webp;q=0, image/*")[1],
+                         "image/gif")
+
+
+if __name__ == '__main__':
+    unittest.main()
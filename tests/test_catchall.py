@@ -0,0 +1,76 @@
+import unittest
+
+from captiveportal import app, catchall, settings
+from captiveportal.views import metrics
+
+CHROME_UA = "Mozilla/5.0 (Linux; Android 9; Pixel) AppleWebKit/537.36 " \
+            "(KHTML, like Gecko) Chrome/70.0.3538.64 Mobile Safari/537.36"
+PAGE_ACCEPT = "text/html,application/xhtml+xml,*/*;q=0.8"
+
+
+class ClassifyTestCase(unittest.TestCase):
+
+    def assertKind(self, kind, method="GET", path="/", accept="",
+                   fetch_dest="", user_agent=CHROME_UA):
+        self.assertEqual(
+            catchall.classify(method, path, accept, fetch_dest, user_agent),
+            kind)
+
+    def testPageLoads(self):
+        self.assertKind(catchall.NAVIGATION, accept=PAGE_ACCEPT)
+        self.assertKind(catchall.NAVIGATION, path="/index.html",
+                        fetch_dest="document")
+        # Plain HTTP clients and captive portal agents without an Accept
+        #  header still get the welcome page
+        self.assertKind(catchall.NAVIGATION, path="/unknown_local_page",
+                        accept="*/*", user_agent="python-requests/2.31.0")
+        self.assertKind(catchall.NAVIGATION, user_agent="Dalvik/2.1.0 "
+                        "(Linux; U; Android 9; Pixel Build/PPR1)")
+
+    def testEverythingElse(self):
+        self.assertKind("method", method="POST")
+        self.assertKind("fetch_dest", fetch_dest="image")
+        self.assertKind("extension", path="/logo.PNG")
+        self.assertKind("accept", path="/v1/sync", accept="application/json")
+        self.assertKind("app", path="/v1/sync",
+                        user_agent="okhttp/4.9.0")
+        self.assertKind("app", path="/v1/sync",
+                        user_agent="Weather/3 CFNetwork/1220.1 Darwin/20.3.0")
+
+
+class CatchAllResponseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+        self.environ = {"REMOTE_ADDR": "10.7.2.1"}
+
+    def testNonPagesGet511(self):
+        before = metrics.decisions[("catch_all", "extension")]
+        response = self.client.get("/ads/banner.jpg",
+                                   environ_base=self.environ)
+        self.assertEqual(response.status_code, 511)
+        self.assertEqual(response.data, catchall.NETWORK_AUTH_REQUIRED_BODY)
+        self.assertEqual(response.headers["Cache-Control"], "no-store")
+        self.assertEqual(metrics.decisions[("catch_all", "extension")],
+                         before + 1)
+
+    def testPagesGetWelcomePage(self):
+        response = self.client.get("/news", headers={"Accept": PAGE_ACCEPT},
+                                   environ_base=self.environ)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"Connected to", response.data)
+
+    def testCanBeTurnedOff(self):
+        old_settings = settings.current
+        settings.install(
+            settings.current._replace(CATCH_ALL_PAGES_ONLY=False))
+        try:
+            response = self.client.get("/ads/banner.jpg",
+                                       environ_base=self.environ)
+        finally:
+            settings.install(old_settings)
+        self.assertEqual(response.status_code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,251 @@
+import ipaddress
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+
+from captiveportal import app, dhcp
+from captiveportal.identity import ClientIdentities, describe_key, \
+    is_mac_key, mac_key
+from captiveportal.sessions import MemorySessionStore, client_key
+from captiveportal.views import client_identities, session_store
+
+X11_UA = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 " \
+         "(KHTML, like Gecko) Chrome/52.0.2743.82 Safari/537.36"
+
+
+class SharedStore(MemorySessionStore):
+    """Stands in for a store shared by several workers"""
+
+    shared = True
+
+
+class BatchEndpointTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def testOldLeasesClearAcks(self):
+        for client_ip in ("10.3.0.1", "10.3.0.2"):
+            session_store.touch(client_key(client_ip), time.time())
+            session_store.set_acked(client_key(client_ip))
+        response = self.client.post(
+            "/handle_dhcp_events",
+            data="old aa:bb:cc:dd:ee:01 10.3.0.1\n"
+                 "add aa:bb:cc:dd:ee:03 10.3.0.3 phone\n"
+                 "old aa:bb:cc:dd:ee:02 10.3.0.2\n")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), {"applied": 3, "errors": []})
+        self.assertFalse(session_store.is_acked(client_key("10.3.0.1")))
+        self.assertFalse(session_store.is_acked(client_key("10.3.0.2")))
+
+    def testInvalidEventsAreReported(self):
+        response = self.client.post(
+            "/handle_dhcp_events",
+            data="old aa:bb:cc:dd:ee:01 10.3.0.1\n"
+                 "old aa:bb:cc:dd:ee:01 not-an-ip\n"
+                 "renew aa:bb:cc:dd:ee:01 10.3.0.1\n")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()["applied"], 1)
+        self.assertEqual(len(response.get_json()["errors"]), 2)
+
+
+class FeedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = MemorySessionStore()
+        self.store.touch(client_key("10.3.1.1"), time.time())
+        self.store.set_acked(client_key("10.3.1.1"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testLeaseDiff(self):
+        ip1 = ipaddress.ip_address("10.3.1.1")
+        ip2 = ipaddress.ip_address("10.3.1.2")
+        ip3 = ipaddress.ip_address("10.3.1.3")
+        old = {ip1: ("aa:01", "100"), ip2: ("aa:02", "100")}
+        new = {ip1: ("aa:01", "200"), ip3: ("aa:03", "100")}
+        self.assertEqual(sorted(dhcp.diff_leases(old, new)), [
+            ("add", ip3, "aa:03"),
+            ("del", ip2, "aa:02"),
+            ("old", ip1, "aa:01"),
+        ])
+
+    def testLeaseFileRenewalClearsAck(self):
+        path = os.path.join(self.tmpdir, "dnsmasq.leases")
+        with open(path, "w") as leases:
+            leases.write("100 aa:bb:cc:dd:ee:01 10.3.1.1 phone *\n")
+        watcher = dhcp.LeaseFileWatcher(path, self.store)
+        self.assertEqual(watcher.poll(), 0)
+        self.assertTrue(self.store.is_acked(client_key("10.3.1.1")))
+
+        with open(path, "w") as leases:
+            leases.write("200 aa:bb:cc:dd:ee:01 10.3.1.1 phone *\n")
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        self.assertEqual(watcher.poll(), 1)
+        self.assertFalse(self.store.is_acked(client_key("10.3.1.1")))
+
+    def testDHCPv6LeasesAreSkipped(self):
+        path = os.path.join(self.tmpdir, "dnsmasq.leases")
+        with open(path, "w") as leases:
+            leases.write("100 aa:bb:cc:dd:ee:01 10.3.1.1 phone *\n"
+                         "duid 00:01:00:01:2c:5e:1a:4b:aa:bb:cc:dd:ee:ff\n"
+                         "100 1 2001:db8::3 laptop 00:01:00:01\n"
+                         "100 1 2001:db8::4 tablet 00:01:00:02\n")
+        self.assertEqual(dhcp.read_leases(path), {
+            ipaddress.ip_address("10.3.1.1"): ("aa:bb:cc:dd:ee:01", "100")})
+
+    def testSocketFeed(self):
+        path = os.path.join(self.tmpdir, "dhcp.sock")
+        self.assertTrue(dhcp.EventSocketServer(path, self.store).start())
+        # A second worker leaves the socket to the first
+        self.assertFalse(dhcp.EventSocketServer(path, self.store).start())
+
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sender.connect(path)
+        sender.sendall(b"old aa:bb:cc:dd:ee:01 10.3.1.1\n")
+        sender.close()
+        for _ in range(100):
+            if not self.store.is_acked(client_key("10.3.1.1")):
+                break
+            time.sleep(0.01)
+        self.assertFalse(self.store.is_acked(client_key("10.3.1.1")))
+
+
+class IdentityTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.store = MemorySessionStore()
+        self.identities = ClientIdentities()
+        self.phone = mac_key("AA:BB:CC:DD:EE:01")
+        self.ip1 = ipaddress.ip_address("10.3.2.1")
+        self.ip2 = ipaddress.ip_address("10.3.2.2")
+
+    def _apply(self, *events):
+        return dhcp.apply_events(self.store, events, self.identities)
+
+    def testMacKeys(self):
+        self.assertTrue(is_mac_key(self.phone))
+        self.assertFalse(is_mac_key(client_key("10.3.2.1")))
+        self.assertFalse(is_mac_key(client_key("2001:db8::1")))
+        self.assertEqual(describe_key(self.phone), "aa:bb:cc:dd:ee:01")
+        self.assertEqual(describe_key(client_key("10.3.2.1")), "10.3.2.1")
+        self.assertIsNone(mac_key("not a mac"))
+        self.assertEqual(mac_key("aa-bb-cc-dd-ee-01"), self.phone)
+        # DHCPv6 IAIDs and the like are in the same place as MACs
+        for not_mac in ("1", "0x10", "aabbccddee01", "aa:bb:cc:dd:ee",
+                        "aa:bb:cc:dd:ee:01:02", "aa:bb-cc:dd:ee:01",
+                        "aa:bb:cc:dd:ee:01\n", None):
+            self.assertIsNone(mac_key(not_mac), not_mac)
+
+    def testIAIDsDoNotShareASession(self):
+        # Two DHCPv6 clients with IAID 1 stay keyed by their addresses
+        ip3 = ipaddress.ip_address("2001:db8::3")
+        ip4 = ipaddress.ip_address("2001:db8::4")
+        self._apply(("add", ip3, "1"), ("add", ip4, "1"))
+        self.assertEqual(self.identities.session_key(client_key(ip3)),
+                         client_key(ip3))
+        self.assertEqual(self.identities.session_key(client_key(ip4)),
+                         client_key(ip4))
+
+    def testSessionFollowsDeviceToNewAddress(self):
+        self._apply(("add", self.ip1, "aa:bb:cc:dd:ee:01"))
+        self.assertEqual(
+            self.identities.session_key(client_key(self.ip1)), self.phone)
+        now = time.time()
+        self.store.touch(self.phone, now)
+        self.store.set_acked(self.phone)
+        self._apply(("del", self.ip1, "aa:bb:cc:dd:ee:01"),
+                    ("add", self.ip2, "aa:bb:cc:dd:ee:01"))
+        self.assertEqual(
+            self.identities.session_key(client_key(self.ip2)), self.phone)
+        self.assertEqual(self.identities.session_key(client_key(self.ip1)),
+                         client_key(self.ip1))
+        # Rejoining brings the popup back, as with an existing lease
+        self.assertEqual(self.store.last_seen(self.phone), now)
+        self.assertFalse(self.store.is_acked(self.phone))
+
+    def testNewDeviceDoesNotInheritAddress(self):
+        self.store.touch(client_key(self.ip1), time.time())
+        self.store.set_acked(client_key(self.ip1))
+        self._apply(("add", self.ip1, "aa:bb:cc:dd:ee:02"))
+        key = self.identities.session_key(client_key(self.ip1))
+        self.assertEqual(key, mac_key("aa:bb:cc:dd:ee:02"))
+        self.assertEqual(self.store.last_seen(key), 0)
+        self.assertEqual(self.store.last_seen(client_key(self.ip1)), 0)
+
+    def testRenewalCarriesAddressSessionForward(self):
+        self.store.touch(client_key(self.ip1), 1000.0)
+        self.store.set_acked(client_key(self.ip1))
+        self._apply(("old", self.ip1, "aa:bb:cc:dd:ee:01"))
+        self.assertEqual(self.store.last_seen(self.phone), 1000.0)
+        # Renewals still clear the ack to raise the Android sign in sheet
+        self.assertFalse(self.store.is_acked(self.phone))
+        self.assertEqual(len(self.store), 1)
+
+    def testOneWorkersEventsDoNotBind(self):
+        # With a shared store, the other workers wouldn't see the binding
+        self.assertEqual(
+            dhcp.apply_events(self.store, [("add", self.ip1,
+                                            "aa:bb:cc:dd:ee:01")],
+                              self.identities, bind=False), 1)
+        self.assertEqual(len(self.identities), 0)
+
+    def testMacKeyingNeedsEveryWorkerToSeeLeases(self):
+        shared = SharedStore()
+        self.assertTrue(dhcp.can_key_by_mac({}, self.store))
+        self.assertFalse(dhcp.can_key_by_mac({}, shared))
+        self.assertTrue(dhcp.can_key_by_mac(
+            {"DHCP_LEASES_FILE": "/var/lib/misc/dnsmasq.leases"}, shared))
+        self.assertTrue(dhcp.events_bind(self.store))
+        self.assertFalse(dhcp.events_bind(shared))
+
+    def testLeaseFileSeedsIdentities(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "dnsmasq.leases")
+            with open(path, "w") as leases:
+                leases.write("100 aa:bb:cc:dd:ee:01 10.3.2.1 phone *\n")
+            dhcp.LeaseFileWatcher(path, self.store,
+                                  identities=self.identities)
+            self.assertEqual(
+                self.identities.session_key(client_key(self.ip1)),
+                self.phone)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testProbesUseDeviceSession(self):
+        client = app.test_client()
+        headers = {"User-Agent": X11_UA}
+        client.post("/handle_dhcp_events",
+                    data="add aa:bb:cc:dd:ee:09 10.3.3.1\n")
+        client.get("/generate_204", headers=headers,
+                   environ_base={"REMOTE_ADDR": "10.3.3.1"})
+        client.post("/generate_204", headers=headers,
+                    environ_base={"REMOTE_ADDR": "10.3.3.1"})
+        # The phone's lease moves to another address
+        client.post("/handle_dhcp_event",
+                    data={"operation": "add", "dhcp_ip": "10.3.3.2",
+                          "mac": "aa:bb:cc:dd:ee:09"})
+        self.assertFalse(session_store.is_acked(mac_key("aa:bb:cc:dd:ee:09")))
+        # Pressing OK at the new address acks the phone, not the address
+        client.get("/generate_204", headers=headers,
+                   environ_base={"REMOTE_ADDR": "10.3.3.2"})
+        client.post("/generate_204", headers=headers,
+                    environ_base={"REMOTE_ADDR": "10.3.3.2"})
+        self.assertTrue(session_store.is_acked(mac_key("aa:bb:cc:dd:ee:09")))
+        self.assertFalse(session_store.is_acked(client_key("10.3.3.2")))
+        response = client.get("/generate_204", headers=headers,
+                              environ_base={"REMOTE_ADDR": "10.3.3.2"})
+        self.assertEqual(response.status_code, 204)
+        session_store.remove(mac_key("aa:bb:cc:dd:ee:09"))
+        client_identities.update({client_key("10.3.3.1"): None,
+                                  client_key("10.3.3.2"): None})
+
+
+if __name__ == '__main__':
+    unittest.main()
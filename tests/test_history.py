@@ -0,0 +1,134 @@
+import unittest
+
+from captiveportal import app
+from captiveportal.history import EVENT_BYTES, ProbeHistory
+from captiveportal.sessions import client_key
+from captiveportal.views import probe_history, session_store
+
+X11_UA = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 " \
+         "(KHTML, like Gecko) Chrome/52.0.2743.82 Safari/537.36"
+
+
+class ProbeHistoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.history = ProbeHistory(4 * EVENT_BYTES)
+        self.first = client_key("10.8.0.1")
+        self.second = client_key("10.8.0.2")
+
+    def _record(self, when, key, decision="welcome"):
+        self.history.record(when, key, "handle_default_android", "x11",
+                            decision, False)
+
+    def testClientChain(self):
+        self._record(100.0, self.first)
+        self._record(101.0, self.second)
+        self._record(102.0, self.first, "204")
+        events = self.history.events(self.first)
+        self.assertEqual([event["time"] for event in events], [102.0, 100.0])
+        self.assertEqual(events[0]["ip"], "10.8.0.1")
+        self.assertEqual(events[0]["decision"], "204")
+        self.assertEqual(events[0]["ua_class"], "x11")
+        self.assertEqual(self.history.events(client_key("10.8.0.3")), [])
+
+    def testOldestEventsAreOverwritten(self):
+        for index in range(6):
+            self._record(100.0 + index, self.first)
+        self._record(106.0, self.second)
+        self.assertEqual(len(self.history), 4)
+        self.assertEqual([event["time"]
+                          for event in self.history.events(self.first)],
+                         [105.0, 104.0, 103.0])
+        self.assertEqual(len(self.history.events(self.second)), 1)
+        # Fully overwritten clients are forgotten
+        for index in range(4):
+            self._record(110.0 + index, self.second)
+        self.assertEqual(self.history.events(self.first), [])
+
+    def testClientsSharingABucket(self):
+        # More clients than buckets, so some chains hold several clients
+        keys = [client_key("10.8.0.%d" % (index,)) for index in range(1, 9)]
+        for index, key in enumerate(keys):
+            self._record(100.0 + index, key)
+        for index, key in enumerate(keys[-4:]):
+            self.assertEqual([event["time"]
+                              for event in self.history.events(key)],
+                             [104.0 + index])
+        self.assertEqual(self.history.events(keys[0]), [])
+
+    def testClientsWithoutKeys(self):
+        # Not mistaken for the client whose key is 0
+        self._record(100.0, None)
+        self._record(101.0, client_key("0.0.0.0"))
+        self.assertEqual([event["ip"] for event in self.history.events()],
+                         ["0.0.0.0", None])
+        self.assertEqual([event["time"] for event in
+                          self.history.events(client_key("0.0.0.0"))], [101.0])
+
+    def testMemoryIsAllocatedUpFront(self):
+        history = ProbeHistory(1024 * EVENT_BYTES)
+        arrays = (history._time, history._prev, history._key_high,
+                  history._key_low, history._endpoint, history._ua_class,
+                  history._decision, history._flags, history._buckets)
+        used = sum(len(values) * getattr(values, "itemsize", 1)
+                   for values in arrays)
+        self.assertLessEqual(used, 1024 * EVENT_BYTES)
+        for index in range(3000):
+            history.record(100.0 + index, client_key("10.9.%d.%d" % (
+                index // 256, index % 256)), "x", "x11", "204", False)
+        self.assertEqual(sum(len(values) * getattr(values, "itemsize", 1)
+                             for values in arrays), used)
+
+    def testTimeWindow(self):
+        for index in range(4):
+            self._record(100.0 + index, self.first if index % 2
+                         else self.second)
+        self.assertEqual(
+            [event["time"] for event in
+             self.history.events(since=101.0, until=102.5)],
+            [102.0, 101.0])
+        self.assertEqual(
+            [event["time"] for event in
+             self.history.events(self.first, since=101.5)], [103.0])
+        self.assertEqual(len(self.history.events(limit=2)), 2)
+
+    def testZeroBudgetRecordsNothing(self):
+        history = ProbeHistory(0)
+        history.record(100.0, self.first, "x", "x11", "204", True)
+        self.assertEqual(history.events(), [])
+
+
+class HistoryEndpointTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def tearDown(self):
+        session_store.remove(client_key("10.8.1.1"))
+
+    def testAndroidDecisionsAreQueryable(self):
+        headers = {"User-Agent": X11_UA}
+        environ = {"REMOTE_ADDR": "10.8.1.1"}
+        self.client.get("/generate_204", headers=headers, environ_base=environ)
+        self.client.post("/generate_204", headers=headers,
+                         environ_base=environ)
+        self.client.get("/gen_204", headers=headers, environ_base=environ)
+        events = self.client.get("/_history?ip=10.8.1.1").get_json()["events"]
+        self.assertEqual([(event["endpoint"], event["decision"],
+                           event["acked"]) for event in events],
+                         [("handle_fallback_android", "204", True),
+                          ("handle_default_android", "204", True),
+                          ("handle_default_android", "welcome", False)])
+        self.assertTrue(all(event["ua_class"] == "x11" for event in events))
+        self.assertGreaterEqual(len(probe_history), 3)
+
+    def testOnlyServedToLocalhost(self):
+        response = self.client.get("/_history",
+                                   environ_base={"REMOTE_ADDR": "10.8.1.1"})
+        self.assertNotIn(b"events", response.data)
+        self.assertEqual(self.client.get("/_history?ip=nope").status_code,
+                         400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from captiveportal import journal
+from captiveportal.journal import JournaledSessionStore
+from captiveportal.sessions import MemorySessionStore, client_key
+
+
+class JournaledSessionStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "sessions.journal")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _store(self):
+        return JournaledSessionStore(MemorySessionStore(), self.path,
+                                     flush_interval=3600)
+
+    def testStateSurvivesRestart(self):
+        now = time.time()
+        store = self._store()
+        store.touch(client_key("10.0.0.1"), now)
+        store.set_acked(client_key("10.0.0.1"))
+        store.touch(client_key("10.0.0.2"), now)
+        store.remove(client_key("10.0.0.2"))
+        # Nothing is written on the request path
+        self.assertFalse(os.path.exists(self.path))
+        store.flush()
+
+        restarted = self._store()
+        self.assertEqual(restarted.last_seen(client_key("10.0.0.1")), now)
+        self.assertTrue(restarted.is_acked(client_key("10.0.0.1")))
+        self.assertEqual(restarted.last_seen(client_key("10.0.0.2")), 0)
+
+    def testExpiredClientsAreNotReloaded(self):
+        store = self._store()
+        store.touch(client_key("10.0.0.1"), 1000.0)
+        store.flush()
+        self.assertEqual(len(self._store()), 0)
+
+    def testJournalIsCompacted(self):
+        old_min_bytes = journal.MIN_COMPACTION_BYTES
+        journal.MIN_COMPACTION_BYTES = 0
+        try:
+            store = self._store()
+            for _ in range(100):
+                store.touch(client_key("10.0.0.1"), time.time())
+            store.flush()
+        finally:
+            journal.MIN_COMPACTION_BYTES = old_min_bytes
+        # Only the latest state of the one client is left
+        self.assertEqual(os.path.getsize(self.path), 25)
+        self.assertEqual(len(self._store()), 1)
+
+    def testUnwritableJournalKeepsChanges(self):
+        store = JournaledSessionStore(
+            MemorySessionStore(), os.path.join(self.path, "missing"),
+            flush_interval=3600)
+        store.touch(client_key("10.0.0.1"), time.time())
+        with self.assertRaises(OSError):
+            store.flush()
+        # The writer thread logs the error and carries on
+        store._flush_or_log()  # pylint: disable=protected-access
+        store.touch(client_key("10.0.0.2"), time.time())
+        store.path = self.path
+        store.flush()
+        self.assertEqual(len(self._store()), 2)
+
+    def testPendingChangesAreBounded(self):
+        old_max = journal.MAX_PENDING_RECORDS
+        journal.MAX_PENDING_RECORDS = 10
+        try:
+            store = JournaledSessionStore(
+                MemorySessionStore(), os.path.join(self.path, "missing"),
+                flush_interval=3600)
+            for i in range(25):
+                store.touch(client_key("10.0.1.%d" % (i,)), time.time())
+            with self.assertRaises(OSError):
+                store.flush()
+        finally:
+            journal.MAX_PENDING_RECORDS = old_max
+        self.assertEqual(store.stats()["journal_dropped"], 15)
+        store.path = self.path
+        store.flush()
+        # The newest changes were kept
+        self.assertEqual(self._store().last_seen(client_key("10.0.1.0")), 0)
+        self.assertNotEqual(
+            self._store().last_seen(client_key("10.0.1.24")), 0)
+
+
+    def testRespawnedWorkerReloadsJournal(self):
+        now = time.time()
+        master = self._store()
+        master.touch(client_key("10.0.2.1"), now)
+        master.flush()
+        # A worker forked from the master acks a phone, then dies
+        worker = self._store()
+        worker.set_acked(client_key("10.0.2.1"))
+        worker.touch(client_key("10.0.2.2"), now)
+        worker.flush()
+        # Its replacement forks from the master, with the master's state
+        respawned = master
+        respawned.reload()
+        self.assertTrue(respawned.is_acked(client_key("10.0.2.1")))
+        self.assertEqual(respawned.last_seen(client_key("10.0.2.2")), now)
+        # So compacting from it keeps what the first worker journaled
+        respawned._compact()  # pylint: disable=protected-access
+        self.assertTrue(self._store().is_acked(client_key("10.0.2.1")))
+
+
+if __name__ == '__main__':
+    unittest.main()
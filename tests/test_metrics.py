@@ -0,0 +1,86 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from captiveportal import app
+from captiveportal.metrics import Metrics
+from captiveportal.sessions import MemorySessionStore, client_key
+from captiveportal.useragent import UserAgentCache
+from captiveportal.views import session_store
+
+X11_UA = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 " \
+         "(KHTML, like Gecko) Chrome/52.0.2743.82 Safari/537.36"
+
+
+class MetricsEndpointTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def testProbeDecisionsAreCounted(self):
+        remote = {"REMOTE_ADDR": "10.2.0.1"}
+        self.client.get("/generate_204", headers={"User-Agent": X11_UA},
+                        environ_base=remote)
+        self.client.post("/generate_204", headers={"User-Agent": X11_UA},
+                         environ_base=remote)
+        self.client.get("/generate_204", headers={"User-Agent": X11_UA},
+                        environ_base=remote)
+        body = self.client.get("/_metrics").get_data(as_text=True)
+        self.assertIn('captiveportal_decisions_total{handler="android",'
+                      'decision="204"}', body)
+        self.assertIn('captiveportal_requests_total{'
+                      'endpoint="handle_default_android",status="204"}', body)
+        self.assertIn('captiveportal_request_duration_seconds_bucket{'
+                      'endpoint="handle_default_android",le="+Inf"}', body)
+        self.assertIn('captiveportal_session_store{stat="size"}', body)
+        self.assertIn("captiveportal_ua_cache_hit_ratio", body)
+        session_store.remove(client_key("10.2.0.1"))
+
+    def testMetricsAreLocalOnly(self):
+        response = self.client.get("/_metrics",
+                                   environ_base={"REMOTE_ADDR": "10.2.0.2"})
+        self.assertIn(b"ConnectBox", response.data)
+        self.assertNotIn(b"captiveportal_", response.data)
+
+
+class MetricsAggregationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _metrics(self):
+        return Metrics(UserAgentCache(), MemorySessionStore(), self.tmpdir)
+
+    def testOtherWorkersSnapshotsAreAdded(self):
+        other = self._metrics()
+        other.observe_request("handle_ncsi_txt", 200, 0.001)
+        other.count_decision("android", "204")
+        # Pretend the snapshot came from another live worker
+        with open(os.path.join(self.tmpdir, "%d.json" % (os.getppid(),)),
+                  "w") as snapshot:
+            json.dump(other.snapshot(), snapshot)
+
+        metrics = self._metrics()
+        metrics.observe_request("handle_ncsi_txt", 200, 0.002)
+        totals = metrics.aggregate()
+        self.assertEqual(totals["workers"], 2)
+        self.assertEqual(totals["requests"][("handle_ncsi_txt", 200)], 2)
+        self.assertEqual(totals["decisions"][("android", "204")], 1)
+        self.assertAlmostEqual(totals["latencies"]["handle_ncsi_txt"][-1],
+                               0.003)
+
+    def testDeadWorkersSnapshotsAreDropped(self):
+        path = os.path.join(self.tmpdir, "%d.json" % (2 ** 22 + 1,))
+        with open(path, "w") as snapshot:
+            json.dump(self._metrics().snapshot(), snapshot)
+        self.assertEqual(self._metrics().aggregate()["workers"], 1)
+        self.assertFalse(os.path.exists(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import unittest
+
+from captiveportal import portal, settings
+from captiveportal.sessions import MemorySessionStore, client_key
+from captiveportal.useragent import parse
+
+X11_UA = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 " \
+         "(KHTML, like Gecko) Chrome/52.0.2743.82 Safari/537.36"
+WISPR_UA = "CaptiveNetworkSupport-346.50.1 wispr"
+
+DAY = settings.current.MAX_TIME_WITHOUT_SHOWING_CP_SECS
+START = 1.5e9
+
+
+class ExpiryJitterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.old_settings = settings.current
+        settings.install(
+            settings.current._replace(SESSION_EXPIRY_JITTER_SECS=3600))
+
+    def tearDown(self):
+        settings.install(self.old_settings)
+
+    def testJitterIsFixedPerClientAndSpread(self):
+        jitters = [portal.expiry_jitter(client_key("10.9.0.%d" % (i,)))
+                   for i in range(1, 201)]
+        self.assertEqual(jitters[0],
+                         portal.expiry_jitter(client_key("10.9.0.1")))
+        self.assertTrue(all(0 <= jitter < 3600 for jitter in jitters))
+        # Spread over the whole hour, not bunched together
+        self.assertLess(min(jitters), 600)
+        self.assertGreater(max(jitters), 3000)
+
+    def testSessionExpiresAfterItsJitter(self):
+        store = MemorySessionStore(ttl=3 * DAY)
+        key = client_key("10.9.0.1")
+        store.touch(key, START)
+        expires = START + DAY + portal.expiry_jitter(key)
+        self.assertFalse(
+            portal.is_new_captive_portal_session(store, key, expires - 1))
+        self.assertTrue(
+            portal.is_new_captive_portal_session(store, key, expires + 1))
+
+
+class RedisplayAdmissionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.store = MemorySessionStore(ttl=3 * DAY)
+        self.admission = portal.TokenBucket(rate=1, burst=1)
+
+    def testTokenBucket(self):
+        self.assertTrue(self.admission.admit(100.0))
+        self.assertFalse(self.admission.admit(100.5))
+        self.assertTrue(self.admission.admit(101.5))
+        self.assertEqual(self.admission.deferred, 1)
+
+    def testExpiredAndroidSessionsAreDeferred(self):
+        profile = parse(X11_UA)
+        now = START + 2 * DAY
+        for index in (1, 2):
+            key = client_key("10.9.1.%d" % (index,))
+            self.store.touch(key, START)
+            self.store.set_acked(key)
+        first = portal.decide_android(self.store, client_key("10.9.1.1"),
+                                      profile, "GET", now, self.admission)
+        self.assertEqual(first, portal.DECISION_WELCOME)
+        # Over the limit: still acked, gets its 204, and isn't renewed
+        second = portal.decide_android(self.store, client_key("10.9.1.2"),
+                                       profile, "GET", now, self.admission)
+        self.assertEqual(second, portal.DECISION_204)
+        self.assertEqual(self.store.last_seen(client_key("10.9.1.2")), START)
+
+    def testExpiredWisprSessionsAreDeferred(self):
+        profile = parse(WISPR_UA)
+        now = START + 2 * DAY
+        self.admission.admit(now)
+        key = client_key("10.9.2.1")
+        self.store.touch(key, START)
+        self.assertEqual(
+            portal.decide_ios_macos(self.store, key, profile, now,
+                                    self.admission),
+            portal.DECISION_SUCCESS)
+
+    def testNewClientsAreNeverDeferred(self):
+        profile = parse(WISPR_UA)
+        self.admission.admit(START)
+        self.assertEqual(
+            portal.decide_ios_macos(self.store, client_key("10.9.3.1"),
+                                    profile, START, self.admission),
+            portal.DECISION_CONNECTED)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from flask import Flask, render_template
+
+from captiveportal import precompiled
+
+
+class PrecompiledTemplatesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        # A separate app, so that the portal's own loader isn't touched
+        self.app = Flask("captiveportal")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _render(self):
+        with self.app.test_request_context():
+            return render_template("success.html")
+
+    def testPrecompiledTemplatesRenderTheSame(self):
+        expected = self._render()
+        precompiled.compile_templates(self.app, self.tmpdir)
+        fresh = Flask("captiveportal")
+        self.assertTrue(precompiled.install(fresh, self.tmpdir))
+        self.app = fresh
+        self.assertEqual(self._render(), expected)
+        self.assertTrue(fresh.jinja_env.get_template(
+            "success.html").filename.startswith(self.tmpdir))
+
+    def testStaleTemplatesAreIgnored(self):
+        precompiled.compile_templates(self.app, self.tmpdir)
+        manifest = os.path.join(self.tmpdir, "manifest.json")
+        with open(manifest) as manifest_file:
+            text = manifest_file.read()
+        with open(manifest, "w") as manifest_file:
+            manifest_file.write(text.replace('"jinja2": "', '"jinja2": "0'))
+        self.assertFalse(precompiled.install(Flask("captiveportal"),
+                                             self.tmpdir))
+        self.assertFalse(precompiled.install(Flask("captiveportal"),
+                                             os.path.join(self.tmpdir, "x")))
+
+
+if __name__ == '__main__':
+    unittest.main()
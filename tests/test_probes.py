@@ -0,0 +1,58 @@
+import unittest
+
+from captiveportal import app
+from captiveportal.sessions import client_key
+from captiveportal.useragent import parse
+from captiveportal.views import response_cache, session_store
+
+
+class ProbeFastPathTestCase(unittest.TestCase):
+
+    X11_UA = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 " \
+             "(KHTML, like Gecko) Chrome/52.0.2743.82 Safari/537.36"
+    WISPR_UA = "CaptiveNetworkSupport-346.50.1 wispr"
+
+    def setUp(self):
+        self.client = app.test_client()
+        self.environ = {"REMOTE_ADDR": "10.6.0.1"}
+
+    def tearDown(self):
+        session_store.remove(client_key("10.6.0.1"))
+
+    def testAckedAndroidAgentGetsBare204(self):
+        headers = {"User-Agent": self.X11_UA}
+        response = self.client.get("/generate_204", headers=headers,
+                                   environ_base=self.environ)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["ETag"],
+                         response_cache.connected(parse(self.X11_UA)).etag)
+        self.assertEqual(response.headers["Vary"], "User-Agent")
+        # The OK press falls through to the Flask view
+        self.client.post("/generate_204", headers=headers,
+                         environ_base=self.environ)
+        response = self.client.get("/gen_204", headers=headers,
+                                   environ_base=self.environ)
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(response.data, b"")
+
+    def testWisprAgentGetsSuccessAfterPortal(self):
+        headers = {"User-Agent": self.WISPR_UA}
+        response = self.client.get("/hotspot-detect.html", headers=headers,
+                                   environ_base=self.environ)
+        self.assertIn(b"Connected to ConnectBox", response.data)
+        response = self.client.get("/hotspot-detect.html", headers=headers,
+                                   environ_base=self.environ)
+        self.assertEqual(response.data, response_cache.success().body)
+        self.assertEqual(response.headers["Content-Length"],
+                         response_cache.success().content_length)
+        self.assertEqual(response.headers["Vary"], "User-Agent")
+
+    def testHeadHasNoBody(self):
+        response = self.client.head("/.well-known/captive-portal")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Content-Type"], "application/json")
+        self.assertEqual(response.data, b"")
+
+
+if __name__ == '__main__':
+    unittest.main()
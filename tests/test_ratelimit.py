@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from captiveportal import app, settings
+from captiveportal.ratelimit import RateLimiter
+from captiveportal.sessions import client_key
+from captiveportal.views import session_store
+
+
+class RateLimiterTestCase(unittest.TestCase):
+
+    def testBurstThenRate(self):
+        limiter = RateLimiter(rate=2, burst=3, slots=64)
+        key = client_key("10.7.0.1")
+        self.assertEqual([limiter.check(key, 100.0) for _ in range(3)],
+                         [0, 0, 0])
+        self.assertAlmostEqual(limiter.check(key, 100.0), 0.5)
+        # Other clients have their own allowance
+        self.assertEqual(limiter.check(client_key("10.7.0.2"), 100.0), 0)
+        self.assertEqual(limiter.check(key, 100.5), 0)
+        self.assertGreater(limiter.check(key, 100.5), 0)
+
+    def testZeroRateAllowsEverything(self):
+        limiter = RateLimiter(rate=0, burst=1, slots=64)
+        self.assertFalse(any(limiter.check(1, 100.0) for _ in range(100)))
+
+    def testRetryAfterIsWholeSeconds(self):
+        limiter = RateLimiter(rate=1, burst=1, slots=64)
+        self.assertEqual(limiter.retry_after(0.2), "1")
+        self.assertEqual(limiter.retry_after(2.5), "3")
+
+    def testNeighbouringSubnetsGetTheirOwnSlots(self):
+        limiter = RateLimiter(rate=1, burst=1, slots=8192)
+        self.assertNotEqual(limiter._slot(client_key("10.0.0.1")),
+                            limiter._slot(client_key("10.0.32.1")))
+        # A /16 of clients is spread over the whole table
+        slots = set(limiter._slot(client_key("10.0.%d.%d" % (high, low)))
+                    for high in range(256) for low in range(1, 255))
+        self.assertGreater(len(slots), 8192 * 0.9)
+        # IPv6 clients that differ only in their prefix
+        self.assertNotEqual(limiter._slot(client_key("2001:db8:0:1::1")),
+                            limiter._slot(client_key("2001:db8:0:2::1")))
+
+    def testSlotsAreRoundedUpToAPowerOfTwo(self):
+        self.assertEqual(RateLimiter(rate=1, burst=1, slots=1000).slots, 1024)
+        self.assertEqual(RateLimiter(rate=1, burst=1, slots=64).slots, 64)
+
+    def testFileIsShared(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "ratelimit")
+            first = RateLimiter(rate=1, burst=1, slots=64, path=path)
+            second = RateLimiter(rate=1, burst=1, slots=64, path=path)
+            self.assertEqual(first.check(7, 100.0), 0)
+            self.assertGreater(second.check(7, 100.0), 0)
+            first.close()
+            second.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class CatchAllSheddingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.old_settings = settings.current
+        settings.install(settings.current._replace(CATCH_ALL_RATE=0.01,
+                                                   CATCH_ALL_BURST=2))
+        self.client = app.test_client()
+        self.environ = {"REMOTE_ADDR": "10.7.1.1"}
+
+    def tearDown(self):
+        settings.install(self.old_settings)
+        session_store.remove(client_key("10.7.1.1"))
+
+    def testOverLimitCatchAllGets503(self):
+        for _ in range(2):
+            response = self.client.get("/app/update-check",
+                                       environ_base=self.environ)
+            self.assertEqual(response.status_code, 200)
+        response = self.client.get("/app/update-check",
+                                   environ_base=self.environ)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.data, b"")
+        self.assertGreaterEqual(int(response.headers["Retry-After"]), 1)
+        response = self.client.post("/app/telemetry",
+                                    environ_base=self.environ)
+        self.assertEqual(response.status_code, 503)
+
+    def testProbesAreNeverLimited(self):
+        for _ in range(3):
+            self.client.get("/app/update-check", environ_base=self.environ)
+        for path in ("/generate_204", "/hotspot-detect.html", "/ncsi.txt",
+                     "/.well-known/captive-portal"):
+            response = self.client.get(path, environ_base=self.environ)
+            self.assertEqual(response.status_code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
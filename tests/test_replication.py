@@ -0,0 +1,224 @@
+import time
+import unittest
+
+from captiveportal import portal, replication
+from captiveportal.identity import mac_key
+from captiveportal.replication import ReplicatedSessionStore, \
+    decode_batch, encode_batch
+from captiveportal.sessions import MemorySessionStore, client_key, \
+    create_session_store
+from captiveportal.useragent import parse
+
+SECRET = b"shared secret"
+X11_UA = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 " \
+         "(KHTML, like Gecko) Chrome/52.0.2743.82 Safari/537.36"
+
+
+class EncodingTestCase(unittest.TestCase):
+
+    def testBatchRoundTrip(self):
+        changes = [
+            (replication.OP_TOUCH, 0x40, client_key("10.8.0.1"), 1000.0),
+            (replication.OP_ACK, 0, client_key("2001:db8::1"), 1000.25),
+            (replication.OP_REMOVE, 0, mac_key("aa:bb:cc:dd:ee:01"), 1002.0),
+        ]
+        datagrams = encode_batch(b"node0001", changes, SECRET)
+        self.assertEqual(len(datagrams), 1)
+        node_id, decoded = decode_batch(datagrams[0], SECRET)
+        self.assertEqual(node_id, b"node0001")
+        self.assertEqual(decoded, changes)
+
+    def testIPv4KeysAreShort(self):
+        one = encode_batch(b"node0001", [
+            (replication.OP_TOUCH, 0, client_key("10.8.0.1"), 1000.0)],
+                           SECRET)[0]
+        two = encode_batch(b"node0001", [
+            (replication.OP_TOUCH, 0, client_key("10.8.0.1"), 1000.0),
+            (replication.OP_TOUCH, 0, client_key("10.8.0.2"), 1000.0)],
+                           SECRET)[0]
+        self.assertEqual(len(two) - len(one), 9)
+
+    def testLargeBatchesAreSplit(self):
+        changes = [(replication.OP_TOUCH, 0, key, 1000.0 + key)
+                   for key in range(1000)]
+        datagrams = encode_batch(b"node0001", changes, SECRET)
+        self.assertGreater(len(datagrams), 1)
+        decoded = []
+        for datagram in datagrams:
+            self.assertLessEqual(len(datagram),
+                                 replication.MAX_DATAGRAM_BYTES)
+            decoded.extend(decode_batch(datagram, SECRET)[1])
+        self.assertEqual(decoded, changes)
+
+    def testForeignDatagramsAreIgnored(self):
+        store = ReplicatedSessionStore(MemorySessionStore(), [], SECRET)
+        self.assertEqual(store.receive(b"GET / HTTP/1.1\r\n\r\n"), 0)
+        datagram = encode_batch(b"node0001", [
+            (replication.OP_TOUCH, 0, client_key("10.8.0.1"), 1000.0)],
+                                SECRET)[0]
+        self.assertEqual(store.receive(datagram[:-1]), 0)
+        # Forged, or signed with another secret
+        forged = encode_batch(b"node0001", [
+            (replication.OP_TOUCH, 0, client_key("10.8.0.1"), 1000.0)],
+                              b"guessed")[0]
+        self.assertEqual(store.receive(forged), 0)
+        self.assertEqual(store.last_seen(client_key("10.8.0.1")), 0)
+        self.assertEqual(store.receive(datagram), 1)
+
+    def testSecretIsRequired(self):
+        with self.assertRaises(ValueError):
+            ReplicatedSessionStore(MemorySessionStore(), [], "")
+
+    def testCreateSessionStore(self):
+        store = create_session_store({
+            "SESSION_REPLICATION_PEERS": "127.0.0.1:43771, 127.0.0.1:43772",
+            "SESSION_REPLICATION_SECRET": "secret",
+            "SESSION_REPLICATION_LISTEN": "127.0.0.1:43774",
+        })
+        self.assertIsInstance(store, ReplicatedSessionStore)
+        self.assertEqual(store.peers, [("127.0.0.1", 43771),
+                                       ("127.0.0.1", 43772)])
+        self.assertEqual(store.stats()["replication_sent"], 0)
+
+
+class MergeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.store = ReplicatedSessionStore(MemorySessionStore(), [], SECRET)
+        self.key = client_key("10.8.1.1")
+
+    def _receive(self, *changes):
+        return self.store.receive(
+            encode_batch(b"peer0001", list(changes), SECRET)[0])
+
+    def testNewerChangesWin(self):
+        now = time.time()
+        self.store.touch(self.key, now)
+        self.assertEqual(
+            self._receive((replication.OP_TOUCH, 0, self.key, now - 10)), 0)
+        self.assertEqual(self.store.last_seen(self.key), now)
+        self._receive((replication.OP_TOUCH, 0, self.key, now + 10))
+        self.assertAlmostEqual(self.store.last_seen(self.key), now + 10,
+                               places=2)
+
+    def testOlderClearDoesNotUndoAck(self):
+        self.store.touch(self.key, time.time())
+        self.store.set_acked(self.key)
+        self._receive((replication.OP_CLEAR_ACK, 0, self.key,
+                       time.time() - 10))
+        self.assertTrue(self.store.is_acked(self.key))
+        self._receive((replication.OP_CLEAR_ACK, 0, self.key,
+                       time.time() + 10))
+        self.assertFalse(self.store.is_acked(self.key))
+
+    def testRemovalIsNotUndoneByOlderTouch(self):
+        now = time.time()
+        self.store.touch(self.key, now - 20)
+        self._receive((replication.OP_REMOVE, 0, self.key, now - 10))
+        self.assertEqual(self.store.last_seen(self.key), 0)
+        self._receive((replication.OP_TOUCH, 0, self.key, now - 15))
+        self.assertEqual(self.store.last_seen(self.key), 0)
+
+    def testAckedTouchMakesUpForLostAck(self):
+        self._receive((replication.OP_TOUCH, 0x40, self.key, time.time()))
+        self.assertTrue(self.store.is_acked(self.key))
+
+    def testAckedTouchDoesNotOverrideClear(self):
+        now = time.time()
+        self.store.touch(self.key, now)
+        self.store.clear_ack(self.key)
+        self._receive((replication.OP_TOUCH, 0x40, self.key, now + 10))
+        self.assertFalse(self.store.is_acked(self.key))
+
+    def testFlushSendsLatestChangePerClient(self):
+        sent = []
+        self.store.peers = [("127.0.0.1", 9)]
+        self.store._send_sock = FakeSocket(sent)
+        self.store.touch(self.key, 1000.0)
+        self.store.touch(self.key, 1001.0)
+        self.store.set_acked(self.key)
+        self.store.flush()
+        self.assertEqual(len(sent), 1)
+        changes = decode_batch(sent[0], SECRET)[1]
+        self.assertEqual([(op, flags, key) for op, flags, key, _ in changes],
+                         [(replication.OP_ACK, 0, self.key),
+                          (replication.OP_TOUCH, 0x40, self.key)])
+        self.assertEqual(changes[1][3], 1001.0)
+        # Nothing left to send
+        self.store.flush()
+        self.assertEqual(len(sent), 1)
+
+    def testNewAndroidSessionReachesPeers(self):
+        sent = []
+        self.store.peers = [("127.0.0.1", 9)]
+        self.store._send_sock = FakeSocket(sent)
+        peer = ReplicatedSessionStore(MemorySessionStore(), [], SECRET)
+        now = time.time()
+        peer.touch(self.key, now - 86400 * 3)
+        # An expired session is removed, then the new one touched
+        self.store.touch(self.key, now - 86400 * 3)
+        portal.decide_android(self.store, self.key, parse(X11_UA), "GET",
+                              now)
+        self.store.flush()
+        for datagram in sent:
+            peer.receive(datagram)
+        self.assertAlmostEqual(peer.last_seen(self.key), now, places=2)
+
+
+class FakeSocket(object):
+
+    def __init__(self, sent):
+        self.sent = sent
+
+    def sendto(self, data, address):
+        self.sent.append(data)
+
+
+class LocalhostPeersTestCase(unittest.TestCase):
+    """Three boxes on one network, as three stores on localhost ports"""
+
+    PORTS = (43771, 43772, 43773)
+
+    def setUp(self):
+        self.stores = []
+        for port in self.PORTS:
+            peers = ["127.0.0.1:%d" % (other,) for other in self.PORTS
+                     if other != port]
+            store = ReplicatedSessionStore(
+                MemorySessionStore(), peers, SECRET,
+                "127.0.0.1:%d" % (port,),
+                flush_interval=3600)
+            if not store.start():
+                self.tearDown()
+                self.skipTest("UDP port %d is in use" % (port,))
+            self.stores.append(store)
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+
+    def _wait_for(self, condition):
+        for _ in range(200):
+            if condition():
+                return True
+            time.sleep(0.01)
+        return False
+
+    def testRoamingPhoneKeepsItsAck(self):
+        first, second, third = self.stores
+        key = client_key("10.8.2.1")
+        first.touch(key, time.time())
+        first.set_acked(key)
+        first.flush()
+        self.assertTrue(self._wait_for(lambda: second.is_acked(key) and
+                                       third.is_acked(key)))
+        # The phone's lease is renewed at the box it roamed to
+        time.sleep(0.01)
+        third.clear_ack(key)
+        third.flush()
+        self.assertTrue(self._wait_for(lambda: not first.is_acked(key) and
+                                       not second.is_acked(key)))
+
+
+if __name__ == '__main__':
+    unittest.main()
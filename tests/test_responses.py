@@ -0,0 +1,138 @@
+import unittest
+
+from flask import render_template
+
+from captiveportal import app, settings
+from captiveportal.responses import if_none_match_tags
+from captiveportal.sessions import client_key
+from captiveportal.useragent import parse
+from captiveportal.views import metrics, response_cache, session_store
+
+X11_UA = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 " \
+         "(KHTML, like Gecko) Chrome/52.0.2743.82 Safari/537.36"
+IOS_UA = "Mozilla/5.0 (iPhone; CPU iPhone OS 10_3_1 like Mac OS X) " \
+         "AppleWebKit/603.1.30 (KHTML, like Gecko) Mobile/14E304"
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        response_cache.invalidate()
+
+    def tearDown(self):
+        response_cache.invalidate()
+
+    def testConnectedPageServedFromCache(self):
+        with app.test_client() as c:
+            first = c.get("/ncsi.txt")
+            second = c.get("/ncsi.txt")
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(first.headers["ETag"], second.headers["ETag"])
+        self.assertEqual(first.headers["Content-Length"],
+                         str(len(first.data)))
+        # The variant depends on the User-Agent
+        self.assertEqual(first.headers["Vary"], "User-Agent")
+
+    def testCaptivePortalAPIDoesNotVary(self):
+        with app.test_client() as c:
+            response = c.get("/.well-known/captive-portal")
+        self.assertNotIn("Vary", response.headers)
+
+    def testCachedBodyMatchesTemplate(self):
+        with app.test_request_context("/"):
+            self.assertEqual(response_cache.success().body,
+                             render_template("success.html").encode("utf-8"))
+
+    def testSettingsChangeRebuildsPages(self):
+        original = settings.current
+        try:
+            with app.test_client() as c:
+                c.get("/ncsi.txt")
+                settings.install(original._replace(
+                    CONNECTBOX_URL="http://example.org"))
+                self.assertIn(b"http://example.org", c.get("/ncsi.txt").data)
+        finally:
+            settings.install(original)
+
+    def testInlineAssets(self):
+        original = settings.current
+        settings.install(original._replace(INLINE_ASSETS=True))
+        try:
+            with app.test_client() as c:
+                body = c.get("/ncsi.txt").data
+        finally:
+            settings.install(original)
+        self.assertIn(b'<img src="data:image/gif;base64,R0lGOD', body)
+        self.assertNotIn(b"/static/", body)
+
+
+class ConditionalRequestTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+        self.environ = {"REMOTE_ADDR": "10.7.0.1"}
+
+    def tearDown(self):
+        session_store.remove(client_key("10.7.0.1"))
+
+    def testIfNoneMatchTags(self):
+        self.assertEqual(if_none_match_tags('W/"a", "b",'), ['"a"', '"b"'])
+        self.assertEqual(if_none_match_tags(""), [])
+
+    def testProbeRevalidationGets304(self):
+        page = response_cache.connected(parse(X11_UA))
+        saved = metrics.bytes_saved["handle_default_android"]
+        response = self.client.get(
+            "/generate_204", environ_base=self.environ,
+            headers={"User-Agent": X11_UA, "If-None-Match": page.etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b"")
+        self.assertEqual(response.headers["ETag"], page.etag)
+        self.assertEqual(response.headers["Vary"], "User-Agent")
+        self.assertEqual(metrics.bytes_saved["handle_default_android"],
+                         saved + len(page.body))
+
+    def testStaleETagGetsFullPage(self):
+        response = self.client.get(
+            "/ncsi.txt", environ_base=self.environ,
+            headers={"User-Agent": X11_UA, "If-None-Match": '"stale"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"Connected to ConnectBox", response.data)
+
+    def testCatchAllMatchesVariantWithoutUserAgent(self):
+        # The variant named is found by its ETag, whatever the User-Agent
+        page = response_cache.connected(parse(IOS_UA))
+        response = self.client.get(
+            "/some/page", environ_base=self.environ,
+            headers={"User-Agent": X11_UA, "Accept": "text/html",
+                     "If-None-Match": 'W/"other", W/%s' % (page.etag,)})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers["ETag"], page.etag)
+
+    def testFlaskViewsAnswerConditionalRequests(self):
+        page = response_cache.connected(parse(X11_UA))
+        response = self.client.get(
+            "/kindle-wifi/wifistub.html", environ_base=self.environ,
+            headers={"User-Agent": X11_UA, "If-None-Match": page.etag})
+        self.assertEqual(response.status_code, 304)
+        # POSTs aren't conditional
+        response = self.client.post(
+            "/kindle-wifi/wifistub.html", environ_base=self.environ,
+            headers={"User-Agent": X11_UA, "If-None-Match": page.etag})
+        self.assertEqual(response.status_code, 200)
+        api = response_cache.captive_portal_api()
+        response = self.client.get("/.well-known/captive-portal",
+                                   headers={"If-None-Match": api.etag})
+        self.assertEqual(response.status_code, 304)
+
+    def testBytesSavedAreExported(self):
+        api = response_cache.captive_portal_api()
+        self.client.get("/.well-known/captive-portal",
+                        headers={"If-None-Match": api.etag})
+        body = self.client.get("/_metrics").get_data(as_text=True)
+        self.assertIn('captiveportal_not_modified_bytes_saved_total{'
+                      'endpoint="captive_portal_api"}', body)
+
+
+if __name__ == '__main__':
+    unittest.main()
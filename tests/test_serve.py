@@ -0,0 +1,113 @@
+import gc
+import os
+import signal
+import sys
+import unittest
+
+from captiveportal import app, preload, serve, settings, views
+from captiveportal.journal import JournaledSessionStore
+from captiveportal.replication import ReplicatedSessionStore
+from captiveportal.serve import PortalApplication, PortalArbiter, \
+    gunicorn_options
+from captiveportal.sessions import MemorySessionStore, client_key
+from captiveportal.views import response_cache, session_store
+
+
+class ReloadRecorder(JournaledSessionStore):
+    """A journaled store that only records being reloaded"""
+
+    # pylint: disable=super-init-not-called
+    def __init__(self, reloaded):
+        self.store = MemorySessionStore()
+        self.reloaded = reloaded
+
+    def reload(self):
+        self.reloaded.append(True)
+
+
+class ServeTestCase(unittest.TestCase):
+
+    def testKeepAliveWorkers(self):
+        options = gunicorn_options(app.config, ["unix:/tmp/portal.sock"])
+        self.assertEqual(options["bind"], ["unix:/tmp/portal.sock"])
+        # sync workers don't keep connections alive
+        self.assertEqual(options["worker_class"], "gthread")
+        self.assertGreater(options["keepalive"], 0)
+
+    def testPreloadIsConfigurable(self):
+        options = gunicorn_options(app.config)
+        self.assertTrue(options["preload_app"])
+        self.assertFalse(
+            gunicorn_options(app.config, preload_app=False)["preload_app"])
+        self.assertTrue(callable(options["post_fork"]))
+
+    def testWarmAndFreeze(self):
+        preload.warm()
+        self.assertIsNotNone(response_cache._pages)
+        self.assertIn("ua_parser.user_agent_parser", sys.modules)
+        try:
+            self.assertEqual(preload.freeze(), hasattr(gc, "freeze"))
+        finally:
+            if hasattr(gc, "unfreeze"):
+                gc.unfreeze()
+
+    def testBackgroundTasksStartAfterFork(self):
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # The child serves a request, which starts its own tasks
+            from captiveportal import views
+            app.test_client().get("/ncsi.txt")
+            os.write(write_end, str(views._background_pid).encode())
+            os._exit(0)
+        os.close(write_end)
+        started_in = int(os.read(read_end, 32))
+        os.close(read_end)
+        os.waitpid(pid, 0)
+        self.assertEqual(started_in, pid)
+
+    def testSighupKeepsTheWorkers(self):
+        options = gunicorn_options(app.config, ["unix:/tmp/portal.sock"],
+                                   preload_app=False)
+        arbiter = PortalArbiter(PortalApplication(app, options))
+        signalled = []
+        arbiter.WORKERS = {1001: None, 1002: None}
+        arbiter.kill_worker = lambda pid, sig: signalled.append((pid, sig))
+        arbiter.reload = lambda: self.fail("The workers were replaced")
+        original = settings.current
+        os.environ["CAPTIVEPORTAL_CONNECTBOX_HOSTNAME"] = "Hung up"
+        try:
+            arbiter.handle_hup()
+            self.assertEqual(settings.current.CONNECTBOX_HOSTNAME, "Hung up")
+        finally:
+            del os.environ["CAPTIVEPORTAL_CONNECTBOX_HOSTNAME"]
+            settings.install(original)
+        self.assertEqual(sorted(signalled), [(1001, signal.SIGHUP),
+                                             (1002, signal.SIGHUP)])
+
+    def testWorkersReloadTheJournal(self):
+        reloaded = []
+        store = views.session_store
+        start = serve.start_background_tasks
+        views.session_store = ReplicatedSessionStore(
+            ReloadRecorder(reloaded), [], "secret")
+        serve.start_background_tasks = lambda: reloaded.append("started")
+        try:
+            serve._post_fork(None, None)  # pylint: disable=protected-access
+        finally:
+            views.session_store = store
+            serve.start_background_tasks = start
+        self.assertEqual(reloaded, [True, "started"])
+
+    def testClientAddressOverUnixSocket(self):
+        # gunicorn has no peer address for a Unix socket connection, the
+        #  client address comes from nginx
+        app.test_client().get("/ncsi.txt", environ_base={"REMOTE_ADDR": ""},
+                              headers={"X-Forwarded-For": "10.5.0.1"})
+        self.assertNotEqual(session_store.last_seen(client_key("10.5.0.1")),
+                            0)
+        session_store.remove(client_key("10.5.0.1"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,268 @@
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from captiveportal import sessions
+from captiveportal.sessions import MemorySessionStore, MmapSessionStore, \
+    client_key, pack_key
+
+
+def _ack_in_other_process(path, client_ip):
+    store = MmapSessionStore(path)
+    store.touch(client_key(client_ip), 1000.0)
+    store.set_acked(client_key(client_ip))
+    store.close()
+
+
+class SessionStoreTests(object):
+    """Behaviour shared by every session store backend"""
+
+    CAPACITY = 64
+
+    def testUnknownClient(self):
+        self.assertEqual(self.store.last_seen(client_key("10.0.0.1")), 0)
+        self.assertFalse(self.store.is_acked(client_key("10.0.0.1")))
+
+    def testTouchAndAck(self):
+        self.store.touch(client_key("10.0.0.1"), 1000.0)
+        self.store.set_acked(client_key("10.0.0.1"))
+        self.assertEqual(self.store.last_seen(client_key("10.0.0.1")),
+                         1000.0)
+        self.assertTrue(self.store.is_acked(client_key("10.0.0.1")))
+        self.store.clear_ack(client_key("10.0.0.1"))
+        self.assertFalse(self.store.is_acked(client_key("10.0.0.1")))
+        self.assertEqual(self.store.last_seen(client_key("10.0.0.1")),
+                         1000.0)
+
+    def testRemove(self):
+        self.store.touch(client_key("10.0.0.1"), 1000.0)
+        self.store.touch(client_key("10.0.0.2"), 1000.0)
+        self.store.remove(client_key("10.0.0.1"))
+        self.assertEqual(self.store.last_seen(client_key("10.0.0.1")), 0)
+        self.assertEqual(self.store.last_seen(client_key("10.0.0.2")),
+                         1000.0)
+        self.assertEqual(len(self.store), 1)
+
+    def testCapacityIsEnforced(self):
+        now = time.time()
+        for i in range(self.CAPACITY * 2):
+            self.store.touch(client_key("10.0.2.%d" % (i,)), now + i)
+        stats = self.store.stats()
+        self.assertEqual(stats["size"], self.CAPACITY)
+        self.assertEqual(stats["evicted"], self.CAPACITY)
+        # The most recently seen client is never the one evicted
+        self.assertEqual(
+            self.store.last_seen(client_key("10.0.2.%d" % (i,))), now + i)
+
+    def testMappedAddressesShareAKey(self):
+        self.store.touch(client_key("::ffff:10.0.0.1"), 1000.0)
+        self.assertEqual(self.store.last_seen(client_key("10.0.0.1")),
+                         1000.0)
+        self.store.touch(client_key("fe80::1"), 2000.0)
+        self.assertEqual(
+            self.store.last_seen(client_key("fe80:0:0:0:0:0:0:1")), 2000.0)
+
+    def testExpiredEntriesAreEvictedIncrementally(self):
+        for i in range(4):
+            self.store.touch(client_key("10.0.3.%d" % (i,)), 1000.0)
+        # Every new client expires a few of the old ones
+        for i in range(self.CAPACITY // 2):
+            self.store.touch(client_key("10.0.4.%d" % (i,)), time.time())
+        self.assertEqual(self.store.stats()["expired"], 4)
+        self.assertEqual(self.store.last_seen(client_key("10.0.3.0")), 0)
+
+
+class MemorySessionStoreTestCase(SessionStoreTests, unittest.TestCase):
+
+    def setUp(self):
+        self.store = MemorySessionStore(capacity=self.CAPACITY, ttl=3600)
+
+    def testAckDoesNotPostponeExpiry(self):
+        old = client_key("10.0.6.1")
+        self.store.touch(old, 1000.0)
+        self.store.touch(client_key("10.0.6.2"), 1001.0)
+        # Acks don't reorder the clients, so the old one is still first
+        self.store.set_acked(old, 1002.0)
+        self.store.clear_ack(old, 1002.0)
+        self.store.set_acked(old, 1002.0)
+        self.store.touch(client_key("10.0.6.3"), 1000.5 + 3600)
+        self.assertEqual(self.store.last_seen(old), 0)
+        self.assertEqual(self.store.stats()["expired"], 1)
+
+    def testPeerTouchesKeepTheOrder(self):
+        now = time.time()
+        self.store.touch(client_key("10.0.6.1"), now)
+        # A peer's touch of another client, from a while ago
+        self.store.touch(client_key("10.0.6.2"), now - 7200)
+        self.store.touch(client_key("10.0.6.3"), now)
+        self.assertEqual(self.store.last_seen(client_key("10.0.6.2")), 0)
+        self.assertEqual(self.store.last_seen(client_key("10.0.6.1")), now)
+
+    def testConcurrentWriters(self):
+        errors = []
+
+        def churn(thread):
+            try:
+                for i in range(2000):
+                    key = client_key("10.0.5.%d" % ((thread * 7 + i) % 100,))
+                    self.store.touch(key, time.time())
+                    if i % 3 == 0:
+                        self.store.remove(key)
+            except Exception as error:  # pylint: disable=broad-except
+                errors.append(error)
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=churn, args=(thread,))
+                       for thread in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(errors, [])
+        linked = 0
+        # pylint: disable=protected-access
+        slot = self.store._head
+        while slot != -1:
+            linked += 1
+            slot = self.store._next[slot]
+        self.assertEqual(linked, len(self.store))
+        self.assertLessEqual(len(self.store), self.CAPACITY)
+
+
+class MmapSessionStoreTestCase(SessionStoreTests, unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "sessions")
+        self.store = MmapSessionStore(self.path, capacity=self.CAPACITY,
+                                      ttl=3600)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmpdir)
+
+    def testStateIsSharedBetweenProcesses(self):
+        """An ack recorded by one worker is seen by the others"""
+        worker = multiprocessing.Process(target=_ack_in_other_process,
+                                         args=(self.path, "10.0.0.7"))
+        worker.start()
+        worker.join()
+        self.assertTrue(self.store.is_acked(client_key("10.0.0.7")))
+        self.assertEqual(self.store.last_seen(client_key("10.0.0.7")), 1000.0)
+
+    def testReadsRetryWhenAWriterStartsMidCopy(self):
+        key = client_key("10.0.0.8")
+        self.store.touch(key, 1000.0)
+        store = self.store
+        real_record = sessions._RECORD  # pylint: disable=protected-access
+
+        class TornRecord(type(real_record)):
+            torn = False
+
+            def unpack_from(self, buffer, offset=0):
+                record = real_record.unpack_from(buffer, offset)
+                if TornRecord.torn:
+                    return record
+                TornRecord.torn = True
+                # Another worker rewrites the record while it's copied:
+                #  the start of the copy is old and the end is new
+                # pylint: disable=protected-access
+                slot = (offset - sessions._HEADER_SIZE) // real_record.size
+                store._write(slot, record[1], pack_key(key), 2000.0)
+                return record[:3] + (2000.0 + 0.5,)
+
+        sessions._RECORD = TornRecord(real_record.format)
+        try:
+            self.assertEqual(self.store.last_seen(key), 2000.0)
+        finally:
+            sessions._RECORD = real_record
+
+    def testProbeChainSurvivesRemoval(self):
+        now = time.time()
+        clients = ["10.0.1.%d" % (i,) for i in range(40)]
+        for client_ip in clients:
+            self.store.touch(client_key(client_ip), now)
+        for client_ip in clients[::2]:
+            self.store.remove(client_key(client_ip))
+        for client_ip in clients[1::2]:
+            self.assertEqual(self.store.last_seen(client_key(client_ip)), now)
+
+    def testChurnLeavesNoTombstones(self):
+        now = time.time()
+        present = {}
+        for i in range(self.CAPACITY * 20):
+            key = client_key("10.1.%d.%d" % (i // 256, i % 256))
+            self.store.touch(key, now + i)
+            present[key] = now + i
+            if i % 5 == 0:
+                self.store.remove(key)
+                del present[key]
+        # pylint: disable=protected-access
+        used, tombstones = self.store._header()[:2]
+        self.assertEqual(tombstones, 0)
+        self.assertEqual(used, len(self.store.items()))
+        # So an unknown client's lookup still stops at an empty slot soon
+        empty = sum(1 for slot in range(self.store.slots)
+                    if not self.store._read(slot)[1])
+        self.assertEqual(empty, self.store.slots - used)
+        # Every entry is still reachable from its home slot
+        for key, last_seen, _ in self.store.items():
+            self.assertEqual(self.store.last_seen(key), present[key])
+            self.assertEqual(last_seen, present[key])
+
+    def testOldTombstonesAreSwept(self):
+        now = time.time()
+        keys = [client_key("10.0.2.%d" % (i,)) for i in range(40)]
+        for key in keys:
+            self.store.touch(key, now)
+        # As an older version removed entries
+        # pylint: disable=protected-access
+        counters = self.store._header()
+        for key in keys[::2]:
+            slot = self.store._find(pack_key(key))[0]
+            self.store._write_locked(slot, sessions._FLAG_TOMBSTONE,
+                                     sessions._EMPTY_KEY, 0.0)
+            counters[0] -= 1
+            counters[1] += 1
+        self.store._set_header(counters)
+        for key in keys[1::2]:
+            self.assertEqual(self.store.last_seen(key), now)
+        for i in range(self.store.slots):
+            self.store.touch(keys[1], now)
+            self.store.remove(client_key("10.0.3.1"))
+        self.assertEqual(self.store._header()[1], 0)
+        for key in keys[1::2]:
+            self.assertEqual(self.store.last_seen(key), now)
+
+    def testLookupRetriesWhileEntriesMove(self):
+        key = client_key("10.0.0.9")
+        self.store.touch(key, 1000.0)
+        store = self.store
+        real_search = store._search  # pylint: disable=protected-access
+        calls = []
+
+        def search(packed):
+            calls.append(packed)
+            if len(calls) == 1:
+                # The entry was moved behind the search as it went past
+                # pylint: disable=protected-access
+                store._set_moves(store._moves() + 2)
+                return None, None
+            return real_search(packed)
+
+        store._search = search
+        self.assertEqual(self.store.last_seen(key), 1000.0)
+        self.assertEqual(len(calls), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import unittest
+
+from captiveportal import app, settings
+
+
+class SettingsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "settings.cfg")
+        self.original = settings.current
+
+    def tearDown(self):
+        settings.install(self.original)
+        os.environ.pop("CAPTIVEPORTAL_SETTINGS", None)
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, text):
+        with open(self.path, "w") as settings_file:
+            settings_file.write(text)
+
+    def testDefaults(self):
+        loaded = settings.load(environ={})
+        self.assertEqual(loaded.MAX_ASSUMED_CP_SESSION_TIME_SECS, 300)
+        self.assertEqual(loaded.CONNECTBOX_URL, "http://gowifi.org")
+        with self.assertRaises(AttributeError):
+            loaded.CONNECTBOX_URL = "http://example.org"
+
+    def testFileThenEnvironment(self):
+        self._write('CONNECTBOX_HOSTNAME = "Library"\n'
+                    'UA_CACHE_SIZE = 64\n'
+                    'NOT_A_SETTING = 1\n')
+        loaded = settings.load(environ={
+            "CAPTIVEPORTAL_SETTINGS": self.path,
+            "CAPTIVEPORTAL_UA_CACHE_SIZE": "128",
+            "CAPTIVEPORTAL_INLINE_ASSETS": "yes",
+        })
+        self.assertEqual(loaded.CONNECTBOX_HOSTNAME, "Library")
+        self.assertEqual(loaded.UA_CACHE_SIZE, 128)
+        self.assertIs(loaded.INLINE_ASSETS, True)
+        self.assertFalse(hasattr(loaded, "NOT_A_SETTING"))
+
+    def testMissingFileIsSkipped(self):
+        loaded = settings.load(environ={
+            "CAPTIVEPORTAL_SETTINGS": os.path.join(self.tmpdir, "missing.cfg"),
+            "CAPTIVEPORTAL_UA_CACHE_SIZE": "128",
+        })
+        self.assertEqual(loaded.UA_CACHE_SIZE, 128)
+        self.assertEqual(loaded.CONNECTBOX_URL, "http://gowifi.org")
+
+    def testBadTypesFailLoudly(self):
+        with self.assertRaises(ValueError):
+            settings.load(environ={
+                "CAPTIVEPORTAL_MAX_TIME_WITHOUT_SHOWING_CP_SECS": "a day"})
+        self._write('CONNECTBOX_URL = 42\n')
+        with self.assertRaises(ValueError):
+            settings.load(environ={"CAPTIVEPORTAL_SETTINGS": self.path})
+
+    def testFileChangeIsReloaded(self):
+        self._write('CONNECTBOX_HOSTNAME = "Before"\n')
+        os.environ["CAPTIVEPORTAL_SETTINGS"] = self.path
+        settings.reload()
+        watcher = settings.SettingsWatcher(self.path)
+        client = app.test_client()
+        self.assertIn(b"Connected to Before", client.get("/ncsi.txt").data)
+
+        self._write('CONNECTBOX_HOSTNAME = "After"\n')
+        os.utime(self.path, (time.time() + 10, time.time() + 10))
+        self.assertTrue(watcher.poll())
+        self.assertEqual(app.config["CONNECTBOX_HOSTNAME"], "After")
+        self.assertIn(b"Connected to After", client.get("/ncsi.txt").data)
+
+    def testBrokenFileKeepsCurrentSettings(self):
+        self._write('CONNECTBOX_HOSTNAME = \n')
+        os.environ["CAPTIVEPORTAL_SETTINGS"] = self.path
+        self.assertFalse(settings.reload())
+        self.assertIs(settings.current, self.original)
+
+    def testSighupReloads(self):
+        # The handler was installed when the app was imported
+        self._write('CONNECTBOX_HOSTNAME = "Hung up"\n')
+        os.environ["CAPTIVEPORTAL_SETTINGS"] = self.path
+        os.kill(os.getpid(), signal.SIGHUP)
+        self.assertEqual(settings.current.CONNECTBOX_HOSTNAME, "Hung up")
+
+    def testSighupHandlerNeedsTheMainThread(self):
+        installed = []
+        handler = signal.getsignal(signal.SIGHUP)
+        with self.assertLogs("captiveportal.settings", "WARNING"):
+            thread = threading.Thread(target=lambda: installed.append(
+                settings.install_sighup_handler()))
+            thread.start()
+            thread.join()
+        self.assertEqual(installed, [False])
+        self.assertIs(signal.getsignal(signal.SIGHUP), handler)
+
+
+if __name__ == '__main__':
+    unittest.main()
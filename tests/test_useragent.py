@@ -0,0 +1,138 @@
+import os
+import subprocess
+import sys
+import unittest
+
+from captiveportal import app
+from captiveportal.useragent import DeviceProfile, UserAgentCache, \
+    current_user_agent
+
+
+# Every UA used in test_captiveportal.py, plus a few that must fall through
+#  to ua_parser. The fast path must make the same decisions as ua_parser on
+#  all of them.
+UA_CORPUS = (
+    "",
+    "CaptiveNetworkSupport-325.10.1 wispr",
+    "CaptiveNetworkSupport-346.50.1 wispr",
+    "CaptiveNetworkSupport-1.0 wispr",
+    "Mozilla/5.0 (iPad; CPU OS 9_2_1 like Mac OS X) AppleWebKit/601.1.46 "
+    "(KHTML, like Gecko) Mobile/13D15",
+    "Mozilla/5.0 (iPad; CPU OS 10_3_1 like Mac OS X) AppleWebKit/603.1.30 "
+    "(KHTML, like Gecko) Mobile/14E304",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 12_0 like Mac OS X) "
+    "AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/16A366",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 14_0 like Mac OS X) "
+    "AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/18A373",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_4) AppleWebKit/603.1.30 "
+    "(KHTML, like Gecko)",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_0) AppleWebKit/605.1.15 "
+    "(KHTML, like Gecko)",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 11_0) AppleWebKit/605.1.15 "
+    "(KHTML, like Gecko)",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 13_0) AppleWebKit/605.1.15 "
+    "(KHTML, like Gecko)",
+    "Dalvik/2.1.0 (Linux; U; Android 5.0.1; Lenovo TB3-710F Build/LRX21M)",
+    "Dalvik/2.1.0 (Linux; U; Android 7.1.1; Pixel Build/NOF26V)",
+    "Mozilla/5.0 (Linux; Android 5.0.1; Lenovo TB3-710F Build/LRX21M; wv) "
+    "AppleWebKit/537.36 (KHTML, like Gecko) Version/4.0 "
+    "Chrome/45.0.2454.95 Safari/537.36",
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/52.0.2743.82 Safari/537.36",
+    "Mozilla/5.0 (Linux; Android 6.0.1; Nexus 7 Build/MOB30X; wv) "
+    "AppleWebKit/537.36 (KHTML, like Gecko) Version/4.0 "
+    "Chrome/61.0.3163.98 Safari/537.36",
+    "Mozilla/5.0 (Linux; Android 7.0; Vivo XL2 Build/NRD90M; wv) "
+    "AppleWebKit/537.36 (KHTML, like Gecko) Version/4.0 "
+    "Chrome/67.0.3396.87 Mobile Safari/537.36",
+    "Mozilla/5.0 (Linux; Android 7.1.1; G8231 Build/41.2.A.0.219; wv) "
+    "AppleWebKit/537.36 (KHTML, like Gecko) Version/4.0 "
+    "Chrome/59.0.3071.125 Mobile Safari/537.36",
+    "Mozilla/5.0 (Linux; Android 8.0.0; Mi A1 Build/OPR1.170623.026; wv) "
+    "AppleWebKit/537.36 (KHTML, like Gecko) Version/4.0 "
+    "Chrome/67.0.3396.87 Mobile Safari/537.36",
+    "Mozilla/5.0 (Linux; Android 9; Pixel Build/PPR1.180610.009; wv) "
+    "AppleWebKit/537.36 (KHTML, like Gecko) Version/4.0 "
+    "Chrome/70.0.3538.64 Mobile Safari/537.36",
+    # python-requests' default UA, used by the Windows and Kindle tests
+    "python-requests/2.22.0",
+    "Microsoft NCSI",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+)
+
+
+class UserAgentCacheTestCase(unittest.TestCase):
+
+    DALVIK_UA = "Dalvik/2.1.0 (Linux; U; Android 7.1.1; Pixel Build/NOF26V)"
+    X11_UA = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 " \
+             "(KHTML, like Gecko) Chrome/52.0.2743.82 Safari/537.36"
+
+    def testRepeatedUAIsOnlyParsedOnce(self):
+        cache = UserAgentCache(maxsize=4)
+        first = cache.get(self.DALVIK_UA)
+        second = cache.get(self.DALVIK_UA)
+        self.assertIs(first, second)
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(first.os_family, "Android")
+        self.assertTrue(first.is_dalvik)
+
+    def testCacheIsBounded(self):
+        cache = UserAgentCache(maxsize=2)
+        cache.get("a")
+        cache.get("b")
+        # Touch "a" so that "b" is the least recently used entry
+        cache.get("a")
+        cache.get("c")
+        self.assertEqual(len(cache), 2)
+        cache.get("a")
+        self.assertEqual(cache.hits, 2)
+        cache.get("b")
+        self.assertEqual(cache.misses, 4)
+
+    def testParsedOncePerRequest(self):
+        with app.test_request_context(headers={"User-Agent": self.X11_UA}):
+            user_agent = current_user_agent()
+            self.assertIs(user_agent, current_user_agent())
+            self.assertFalse(user_agent.is_android)
+
+
+class DeviceProfileTestCase(unittest.TestCase):
+
+    def testFastPathMatchesUAParser(self):
+        for ua_str in UA_CORPUS:
+            fast = DeviceProfile.from_fast_path(ua_str)
+            if fast is None:
+                continue
+            slow = DeviceProfile.from_ua_parser(ua_str)
+            for attr in ("os_family", "os_major", "os_minor", "icon_type",
+                         "link_type", "show_ok"):
+                self.assertEqual(getattr(fast, attr), getattr(slow, attr),
+                                 "%s differs for %r" % (attr, ua_str))
+
+    def testProbeAgentsUseFastPath(self):
+        for ua_str in UA_CORPUS:
+            if ua_str.startswith(("python-requests", "Microsoft",
+                                  "Mozilla/5.0 (Windows")):
+                self.assertIsNone(DeviceProfile.from_fast_path(ua_str))
+            else:
+                self.assertIsNotNone(DeviceProfile.from_fast_path(ua_str),
+                                     "%r not on the fast path" % (ua_str,))
+
+    def testUaParserIsOnlyLoadedOnFastPathMiss(self):
+        script = (
+            "import sys\n"
+            "from captiveportal.useragent import parse\n"
+            "parse('CaptiveNetworkSupport-346.50.1 wispr')\n"
+            "print('ua_parser.user_agent_parser' in sys.modules)\n"
+            "parse('Microsoft NCSI')\n"
+            "print('ua_parser.user_agent_parser' in sys.modules)\n")
+        output = subprocess.check_output(
+            [sys.executable, "-c", script], universal_newlines=True,
+            cwd=os.path.join(os.path.dirname(__file__), ".."))
+        self.assertEqual(output.split(), ["False", "True"])
+
+
+if __name__ == '__main__':
+    unittest.main()